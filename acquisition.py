@@ -1,7 +1,117 @@
-from picamera2 import Picamera2
+from picamera2 import MappedArray, Picamera2
 from picamera2.encoders import H264Encoder
+from picamera2.outputs import FileOutput, Output
 from libcamera import controls
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import os
+import struct
+import threading
 import time
+import numpy as np
+
+from image_transfer import StereoVideoStreamer
+from instrumentation import observe, set_frame, stage
+
+SKEW_BUCKETS_US = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 20000, 40000)
+
+#Warm-up is over once AE and AWB have settled: AeLocked when the pipeline reports it, otherwise
+#exposure, gain and colour gains changing by less than SETTLE_TOLERANCE for SETTLE_FRAMES frames
+SETTLE_TOLERANCE = 0.02
+SETTLE_FRAMES = 3
+
+#V4L2 control that makes a running encoder emit an IDR frame next (linux/v4l2-controls.h)
+V4L2_CID_MPEG_VIDEO_FORCE_KEY_FRAME = 0x009909e5
+VIDIOC_S_CTRL = 0xc008561c
+
+
+def _request_idr(encoder):
+    """
+    Ask a running V4L2 H.264 encoder for an IDR frame. Returns False if the request could not
+    be made; the stream then recovers at the next periodic keyframe (at most iperiod frames).
+    """
+    device = getattr(encoder, "vd", None)
+    if device is None:
+        return False
+    try:
+        fcntl.ioctl(device, VIDIOC_S_CTRL, struct.pack("Ii", V4L2_CID_MPEG_VIDEO_FORCE_KEY_FRAME, 1))
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def _settled(metadata, previous):
+    if previous is None:
+        return False
+    if metadata.get("AeLocked") is False:
+        return False
+    for key in ("ExposureTime", "AnalogueGain", "ColourGains"):
+        now, before = metadata.get(key), previous.get(key)
+        if now is None or before is None:
+            continue
+        for a, b in zip(np.atleast_1d(now), np.atleast_1d(before)):
+            if abs(a - b) > SETTLE_TOLERANCE * max(abs(b), 1e-6):
+                return False
+    return True
+
+
+class _EyeOutput(Output):
+    """
+    Encoder output that hands each encoded frame of one eye to a StereoVideoStreamer.
+    """
+    def __init__(self, streamer, side):
+        super().__init__()
+        self.streamer = streamer
+        self.side = side
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        self.streamer.push(self.side, frame, keyframe, timestamp)
+
+
+class _CameraRing:
+    """
+    Fixed-size ring of preallocated frame slots filled by one camera thread.
+    Each slot carries a sequence number that is -1 while it is being written, so readers
+    can detect a slot that was overwritten while they copied it.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.slots = [None] * size
+        self.timestamps = [0] * size
+        self.seqs = [-1] * size
+        self.paired = [False] * size
+        self.count = 0
+        self.unmatched = 0  # frames overwritten without ever being paired
+
+    def write(self, request, stream):
+        index = self.count % self.size
+        if self.seqs[index] >= 0 and not self.paired[index]:
+            self.unmatched += 1
+        self.seqs[index] = -1
+        self.paired[index] = False
+        with MappedArray(request, stream) as m:
+            if self.slots[index] is None or self.slots[index].shape != m.array.shape:
+                self.slots[index] = np.empty_like(m.array)
+            np.copyto(self.slots[index], m.array)
+        self.timestamps[index] = request.get_metadata().get("SensorTimestamp", 0)
+        self.seqs[index] = self.count
+        self.count += 1
+        return index
+
+    def closest(self, timestamp):
+        """
+        Slot index whose timestamp is nearest to timestamp, or None if the ring is empty.
+        """
+        best, best_skew = None, None
+        for index in range(min(self.count, self.size)):
+            if self.seqs[index] < 0:
+                continue
+            skew = abs(self.timestamps[index] - timestamp)
+            if best_skew is None or skew < best_skew:
+                best, best_skew = index, skew
+        return best
+
 
 class StereoCameraAcquisition:
     def __init__(self, left_camera_id=0, right_camera_id=1, frame_rate=30):
@@ -17,38 +127,320 @@ class StereoCameraAcquisition:
         self.left_config_video = self.left_camera.create_video_configuration(main={"size": (1920, 1080)}, controls=self.ctrls)
         self.right_config_video = self.right_camera.create_video_configuration(main={"size": (1920, 1080)}, controls=self.ctrls)
         
-        self.encoder = H264Encoder(bitrate=1000000)
-        self.encoder.sync_enable = True
+        # one hardware encoder per eye; sync_enable holds both back until the cameras are in sync
+        self.left_encoder = self._create_encoder()
+        self.right_encoder = self._create_encoder()
+        self._recording_stop = threading.Event()
 
-    def configure_cameras(self):
-        self.left_camera.configure(self.left_config_still)
-        self.right_camera.configure(self.right_config_still)
-        
-    def start(self):
-        self.left_camera.start(self.left_config_still)
-        self.right_camera.start(self.right_config_still)
-        time.sleep(2)  # Allow cameras to warm up
-        
-    def initialize_cameras(self):
-        self.left_camera.stop()
-        self.right_camera.stop()
-        self.configure_cameras()
-        self.start()
-
-    def capture_stereo_image(self, left_filename="left_image.jpg", right_filename="right_image.jpg"):
-        reqL = self.left_camera.capture_sync_request()
-        reqR = self.right_camera.capture_sync_request()
-        print(f"Captured stereo images: {left_filename}, {right_filename}")
-        return reqL, reqR
+        # issues the left and right capture requests at the same time
+        self._capture_pool = ThreadPoolExecutor(max_workers=2)
+        self._frame_seq = 0
+
+        # continuous capture state (see start_continuous)
+        self.max_skew_ns = None
+        self._rings = None
+        self._capture_threads = []
+        self._capture_stop = threading.Event()
+        self._pair_ready = threading.Condition()
+        self._latest = None  # (left slot, left seq, right slot, right seq, skew_ns)
+        self._skews = deque(maxlen=1000)
+        self._pairs_matched = 0
+
+        # persistent session: the cameras keep streaming between shots and switch modes in place
+        self.left_config_preview = self.left_camera.create_preview_configuration(main={"size": (1280, 720)}, controls=self.ctrls)
+        self.right_config_preview = self.right_camera.create_preview_configuration(main={"size": (1280, 720)}, controls=self.ctrls)
+        self.session_mode = None  # "still", "preview", "video" while the cameras are streaming
+        self.ready_timeout = 5.0
+        self._session_started = None
+        self.time_to_ready_ms = None
+        self.time_to_first_pair_ms = None
+        self._last_shot = None
+        self._shot_intervals = deque(maxlen=1000)
+
+    def _configs(self, mode):
+        return {"still": (self.left_config_still, self.right_config_still),
+                "preview": (self.left_config_preview, self.right_config_preview),
+                "video": (self.left_config_video, self.right_config_video)}[mode]
+
+    def configure_cameras(self, mode="still"):
+        left_config, right_config = self._configs(mode)
+        self.left_camera.configure(left_config)
+        self.right_camera.configure(right_config)
+
+    def start(self, mode="still"):
+        """
+        Start streaming in mode and wait until auto exposure / white balance have settled.
+        """
+        self._session_started = time.perf_counter()
+        self.time_to_first_pair_ms = None
+        self._last_shot = None
+        self._shot_intervals.clear()
+        left_config, right_config = self._configs(mode)
+        self.left_camera.start(left_config)
+        self.right_camera.start(right_config)
+        self.session_mode = mode
+        self.wait_until_ready()
+        self.time_to_ready_ms = (time.perf_counter() - self._session_started) * 1000.0
+
+    def wait_until_ready(self, timeout=None):
+        """
+        Block until both cameras report settled AE/AWB on SETTLE_FRAMES consecutive frames
+        (instead of a fixed warm-up sleep). Returns False if timeout passes first.
+        """
+        timeout = self.ready_timeout if timeout is None else timeout
+        start = time.perf_counter()
+        previous, streak = [None, None], [0, 0]
+        while time.perf_counter() - start < timeout:
+            futures = [self._capture_pool.submit(camera.capture_metadata)
+                       for camera in (self.left_camera, self.right_camera)]
+            for side, future in enumerate(futures):
+                metadata = future.result()
+                streak[side] = streak[side] + 1 if _settled(metadata, previous[side]) else 0
+                previous[side] = metadata
+            if min(streak) >= SETTLE_FRAMES:
+                return True
+        print(f"Cameras did not settle within {timeout:.1f} s, continuing anyway")
+        return False
+
+    def initialize_cameras(self, mode="still"):
+        """
+        Make sure the session streams in mode: a no-op when it already does, an in-place
+        mode switch when another mode is running and a full start otherwise.
+        """
+        if self.session_mode == mode:
+            return
+        if self.session_mode in ("still", "preview") and mode in ("still", "preview"):
+            self.switch_mode(mode)
+            return
+        self.stop()
+        self.configure_cameras(mode)
+        self.start(mode)
+
+    def switch_mode(self, mode):
+        """
+        Switch both running cameras to another configuration without stopping them;
+        AE/AWB state carries over, so only a short settle check follows.
+        """
+        if self.session_mode is None:
+            raise RuntimeError("Cameras are not running; call initialize_cameras() first")
+        left_config, right_config = self._configs(mode)
+        futures = [self._capture_pool.submit(self.left_camera.switch_mode, left_config),
+                   self._capture_pool.submit(self.right_camera.switch_mode, right_config)]
+        for future in futures:
+            future.result()
+        self.session_mode = mode
+        self.wait_until_ready(timeout=1.0)
+
+    def session_stats(self):
+        """
+        Warm-up and latency figures for the current session, in ms.
+        """
+        intervals = np.array(self._shot_intervals, dtype=np.float64)
+        return {
+            "mode": self.session_mode,
+            "time_to_ready_ms": self.time_to_ready_ms,
+            "time_to_first_pair_ms": self.time_to_first_pair_ms,
+            "shots": len(intervals) + (1 if self._last_shot is not None else 0),
+            "shot_to_shot_p50_ms": float(np.percentile(intervals, 50)) if intervals.size else None,
+            "shot_to_shot_p99_ms": float(np.percentile(intervals, 99)) if intervals.size else None,
+        }
+
+    def _record_shot(self):
+        now = time.perf_counter()
+        if self.time_to_first_pair_ms is None and self._session_started is not None:
+            self.time_to_first_pair_ms = (now - self._session_started) * 1000.0
+            observe("time_to_first_pair_ms", self.time_to_first_pair_ms)
+        if self._last_shot is not None:
+            interval = (now - self._last_shot) * 1000.0
+            self._shot_intervals.append(interval)
+            observe("shot_to_shot_ms", interval)
+        self._last_shot = now
+
+    def capture_stereo_image(self, left_filename="left_image.jpg", right_filename="right_image.jpg",
+                             max_skew_ns=None, max_retries=3):
+        """
+        Capture both cameras concurrently. Returns (reqL, reqR, info) where info has the
+        SensorTimestamp skew (left - right) in ns, the capture latency in ms and the attempt count.
+        Pairs further apart than max_skew_ns (default half a frame period) are released and
+        recaptured up to max_retries times; the last attempt is returned either way.
+        """
+        if max_skew_ns is None:
+            max_skew_ns = 500_000_000 // self.framerate
+        seq = self._frame_seq
+        self._frame_seq += 1
+        set_frame(seq)
+        start = time.perf_counter()
+        with stage("capture"):
+            for attempt in range(1, max_retries + 2):
+                futL = self._capture_pool.submit(self.left_camera.capture_sync_request)
+                futR = self._capture_pool.submit(self.right_camera.capture_sync_request)
+                reqL, reqR = futL.result(), futR.result()
+                skew = (reqL.get_metadata().get("SensorTimestamp", 0)
+                        - reqR.get_metadata().get("SensorTimestamp", 0))
+                if abs(skew) <= max_skew_ns or attempt > max_retries:
+                    break
+                reqL.release()
+                reqR.release()
+        observe("capture_skew_us", abs(skew) / 1000.0, SKEW_BUCKETS_US)
+        self._record_shot()
+        info = {"seq": seq, "skew_ns": skew, "latency_ms": (time.perf_counter() - start) * 1000.0,
+                "attempts": attempt}
+        print(f"Captured stereo images: {left_filename}, {right_filename} "
+              f"(skew {skew / 1000:.0f} us, {info['latency_ms']:.1f} ms, {attempt} attempt(s))")
+        return reqL, reqR, info
         
-    def capture_video(self, left_filename="left_video.h264", right_filename="right_video.h264", duration=10):
-        self.left_camera.start_recording(self.encoder, left_filename)
-        self.right_camera.start_recording(self.encoder, right_filename)
-        self.encoder.sync.wait()
-        time.sleep(duration)
-        self.left_camera.stop_recording()
-        self.right_camera.stop_recording()
-        print(f"Captured stereo videos: {left_filename}, {right_filename}")
+    def start_continuous(self, ring_size=4, max_skew_ns=2_000_000, stream="main"):
+        """
+        Stream both cameras in video mode on background threads into fixed-size rings and
+        pair frames by SensorTimestamp. Frames whose closest partner is more than
+        max_skew_ns away are never paired. Use get_latest_pair() to read the newest pair.
+        """
+        self.stop_continuous()
+        self.initialize_cameras("video")
+
+        self.max_skew_ns = max_skew_ns
+        self._rings = (_CameraRing(ring_size), _CameraRing(ring_size))
+        self._latest = None
+        self._skews.clear()
+        self._pairs_matched = 0
+        self._capture_stop.clear()
+        self._capture_threads = [
+            threading.Thread(target=self._capture_loop, args=(self.left_camera, 0, stream), daemon=True),
+            threading.Thread(target=self._capture_loop, args=(self.right_camera, 1, stream), daemon=True),
+        ]
+        for t in self._capture_threads:
+            t.start()
+
+    def _capture_loop(self, camera, side, stream):
+        ring, other = self._rings[side], self._rings[1 - side]
+        while not self._capture_stop.is_set():
+            request = camera.capture_request()
+            try:
+                index = ring.write(request, stream)
+            finally:
+                # the camera buffer goes straight back to libcamera; only the ring copy is kept
+                request.release()
+            self._match(side, ring, index, other)
+
+    def _match(self, side, ring, index, other):
+        timestamp = ring.timestamps[index]
+        partner = other.closest(timestamp)
+        with self._pair_ready:
+            if partner is None or abs(other.timestamps[partner] - timestamp) > self.max_skew_ns:
+                return
+            skew = ring.timestamps[index] - other.timestamps[partner]
+            pair = (index, ring.seqs[index], partner, other.seqs[partner])
+            if pair[3] < 0:  # partner slot is being overwritten
+                return
+            ring.paired[index] = other.paired[partner] = True
+            if side == 1:
+                pair = (pair[2], pair[3], pair[0], pair[1])
+                skew = -skew
+            if self._latest is not None and pair[1] <= self._latest[1] and pair[3] <= self._latest[3]:
+                return
+            self._latest = pair + (skew,)
+            self._skews.append(abs(skew))
+            observe("capture_skew_us", abs(skew) / 1000.0, SKEW_BUCKETS_US)
+            self._pairs_matched += 1
+            self._pair_ready.notify_all()
+
+    def get_latest_pair(self, timeout=1.0, copy=True, newer_than=None):
+        """
+        Newest matched pair as (left, right, info) where info holds both SensorTimestamps,
+        the skew (left - right) in ns and the frame sequence numbers. Returns None if no
+        pair (newer than the left sequence number newer_than) arrives within timeout.
+        copy=False returns views into the ring that stay valid for about ring_size - 1 frames.
+        """
+        deadline = time.monotonic() + timeout
+        stale = None  # (left_seq, right_seq) of a pair whose slots were recycled while being read
+        while True:
+            with self._pair_ready:
+                while (self._latest is None or (newer_than is not None and self._latest[1] <= newer_than)
+                       or (self._latest[1], self._latest[3]) == stale):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._pair_ready.wait(remaining):
+                        return None
+                left_index, left_seq, right_index, right_seq, skew = self._latest
+            ringL, ringR = self._rings
+            info = {"left_timestamp": ringL.timestamps[left_index], "right_timestamp": ringR.timestamps[right_index],
+                    "skew_ns": skew, "left_seq": left_seq, "right_seq": right_seq}
+            left, right = ringL.slots[left_index], ringR.slots[right_index]
+            if copy:
+                left, right = left.copy(), right.copy()
+            # if either slot was recycled while it was read, wait for a newer pair and retry
+            if ringL.seqs[left_index] == left_seq and ringR.seqs[right_index] == right_seq:
+                return left, right, info
+            stale = (left_seq, right_seq)
+
+    def skew_stats(self):
+        """
+        Pairing statistics for continuous capture; skews are absolute and in microseconds.
+        """
+        skews = np.array(self._skews, dtype=np.float64) / 1000.0
+        return {
+            "pairs": self._pairs_matched,
+            "unmatched_frames": sum(ring.unmatched for ring in self._rings) if self._rings else 0,
+            "mean_skew_us": float(skews.mean()) if skews.size else 0.0,
+            "p99_skew_us": float(np.percentile(skews, 99)) if skews.size else 0.0,
+            "max_skew_us": float(skews.max()) if skews.size else 0.0,
+        }
+
+    def stop_continuous(self):
+        self._capture_stop.set()
+        for t in self._capture_threads:
+            t.join(timeout=2)
+        self._capture_threads = []
+
+    def _create_encoder(self, bitrate=1000000):
+        # repeat SPS/PPS with every keyframe (once a second) so a client can join a stream mid-way
+        encoder = H264Encoder(bitrate=bitrate, repeat=True, iperiod=self.framerate)
+        encoder.sync_enable = True
+        return encoder
+
+    def capture_video(self, left_filename="left_video.h264", right_filename="right_video.h264", duration=10,
+                      server=None):
+        """
+        Record both eyes with their own encoders, started together once the cameras are synchronized.
+        Without a server the streams go to the .h264 files with a pts timestamp file next to each;
+        with a server (ImageServerHost / AsyncImageServerHost) timestamp-paired frames are streamed
+        instead and nothing is written to disk.
+        duration=None records until stop_recording() is called from another thread.
+        """
+        self._recording_stop.clear()
+        self.left_encoder = self._create_encoder()
+        self.right_encoder = self._create_encoder()
+        streamer = None
+        if server is None:
+            outputs = (FileOutput(left_filename, pts=os.path.splitext(left_filename)[0] + ".pts"),
+                       FileOutput(right_filename, pts=os.path.splitext(right_filename)[0] + ".pts"))
+        else:
+            streamer = StereoVideoStreamer(server, 1_000_000_000 // self.framerate,
+                                           on_keyframe_needed=self._request_idr_frames)
+            outputs = (_EyeOutput(streamer, 0), _EyeOutput(streamer, 1))
+
+        self.stop()
+        self.left_camera.start_recording(self.left_encoder, outputs[0], config=self.left_config_video)
+        self.right_camera.start_recording(self.right_encoder, outputs[1], config=self.right_config_video)
+        self.left_encoder.sync.wait()
+        self.right_encoder.sync.wait()
+        try:
+            self._recording_stop.wait(duration)
+        finally:
+            self.left_camera.stop_recording()
+            self.right_camera.stop_recording()
+            if streamer is not None:
+                streamer.close()
+        if streamer is None:
+            print(f"Captured stereo videos: {left_filename}, {right_filename}")
+        else:
+            print(f"Streamed {streamer.sent} stereo video frames ({streamer.dropped} dropped)")
+
+    def _request_idr_frames(self):
+        _request_idr(self.left_encoder)
+        _request_idr(self.right_encoder)
+
+    def stop_recording(self):
+        self._recording_stop.set()
         
     def display_preview(self):
         self.left_camera.start_preview()
@@ -59,6 +451,8 @@ class StereoCameraAcquisition:
         self.right_camera.stop_preview()
         
     def stop(self):
+        self.stop_continuous()
+        self.session_mode = None
         self.left_camera.stop()
         self.right_camera.stop()
         
@@ -68,18 +462,24 @@ class StereoCameraAcquisition:
 if __name__ == "__main__":
     stereo_system = StereoCameraAcquisition()
     running = True
+    # one warm session for all shots; only video recording restarts the cameras
     stereo_system.initialize_cameras()
+    stereo_system.display_preview()
     while running:
-        stereo_system.display_preview()
         response = input("Press Enter to capture images, 'v' for video, or 'exit' to quit: ")
         if response == 'exit':
             running = False
         elif response == 'v':
             stereo_system.stop_preview()
             stereo_system.capture_video()
+            stereo_system.initialize_cameras()
+            stereo_system.display_preview()
         else:
-            stereo_system.stop_preview()
-            stereo_system.capture_stereo_image()
-            stereo_system.stop()
+            reqL, reqR, info = stereo_system.capture_stereo_image()
+            reqL.release()
+            reqR.release()
+            print(stereo_system.session_stats())
+    stereo_system.stop_preview()
+    stereo_system.stop()
 
 
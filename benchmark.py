@@ -0,0 +1,299 @@
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from calibration_store import CalibrationBundle
+from stereo_class import CameraCalibration, StereoSystem
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+RESOLUTIONS = ((640, 360), (1280, 720), (1920, 1080))
+SCENES = ("plane", "slant", "steps")
+DISPARITY_MODES = ("single", "tiled", "hierarchical")
+
+#Synthetic rig used for the calibration benchmark (units: metres)
+FOCAL_PX = 1400.0
+BASELINE = 0.12
+
+
+def synthetic_pair(width, height, scene="slant", seed=0):
+    """
+    Rectified stereo pair with known left disparity. A random multi-scale texture is the
+    right image and the left image is warped from it, so left(x, y) = right(x - d, y).
+    Disparity ranges scale with width (up to ~100 px at 1920).
+    Returns (left, right, disparity, valid) where valid marks pixels that see the right image.
+    """
+    rng = np.random.default_rng(seed)
+    texture = cv2.resize(rng.integers(0, 256, (height // 4, width // 4), dtype=np.uint8), (width, height),
+                         interpolation=cv2.INTER_CUBIC)
+    texture = cv2.add(texture, rng.integers(0, 40, (height, width), dtype=np.uint8))
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    scale = width / 1920.0
+    if scene == "plane":
+        disparity = np.full((height, width), 40.0 * scale, np.float32)
+    elif scene == "slant":
+        disparity = (20.0 + 60.0 * xs / width + 20.0 * ys / height) * scale
+    elif scene == "steps":
+        disparity = np.choose((xs * 4 // width).astype(np.int32), [30.0, 60.0, 45.0, 90.0]).astype(np.float32) * scale
+    else:
+        raise ValueError(f"Unknown scene: {scene}")
+    left = cv2.remap(texture, xs - disparity, ys, cv2.INTER_LINEAR)
+    valid = xs - disparity >= 0
+    return left, texture, disparity, valid
+
+
+def disparity_errors(estimate, truth, valid, threshold=1.0):
+    """
+    Bad-pixel rate (|error| > threshold px, missing estimates count as bad), end-point error
+    over pixels with an estimate, and estimate density, all over the ground-truth valid pixels.
+    """
+    estimated = valid & np.isfinite(estimate) & (estimate >= 0)
+    error = np.abs(estimate - truth)
+    bad = valid & (~estimated | (error > threshold))
+    total = max(int(valid.sum()), 1)
+    return {
+        "bad_pixel_percent": 100.0 * bad.sum() / total,
+        "epe_px": float(error[estimated].mean()) if estimated.any() else None,
+        "density_percent": 100.0 * estimated.sum() / total,
+    }
+
+
+def _render_board(K, rvec, tvec, size, chessboard_size, square_size):
+    """
+    Render a chessboard seen by a pinhole camera; chessboard_size counts inner corners.
+    """
+    cols, rows = chessboard_size[0] + 1, chessboard_size[1] + 1
+    image = np.full((size[1], size[0]), 150, np.uint8)
+    border = np.float32([[-1, -1, 0], [cols, -1, 0], [cols, rows, 0], [-1, rows, 0]]) * square_size
+    shift = 4  # sub-pixel polygon precision: coordinates in 1/16 px
+
+    def fill(corners, value):
+        projected, _ = cv2.projectPoints(corners - square_size, rvec, tvec, K, None)
+        cv2.fillConvexPoly(image, np.round(projected.reshape(-1, 2) * (1 << shift)).astype(np.int32), value,
+                           cv2.LINE_AA, shift)
+
+    fill(border, 255)
+    for r in range(rows):
+        for c in range(cols):
+            if (r + c) % 2 == 0:
+                fill(np.float32([[c, r, 0], [c + 1, r, 0], [c + 1, r + 1, 0], [c, r + 1, 0]]) * square_size, 0)
+    return cv2.GaussianBlur(image, (3, 3), 0)
+
+
+def synthetic_calibration_pairs(size=(1920, 1080), count=12, chessboard_size=(7, 7), square_size=0.03):
+    """
+    PNG-encoded (left, right) chessboard views of a synthetic rig with FOCAL_PX and BASELINE.
+    """
+    K = np.array([[FOCAL_PX, 0, size[0] / 2], [0, FOCAL_PX, size[1] / 2], [0, 0, 1]])
+    rng = np.random.default_rng(1)
+    board_centre = np.array([(chessboard_size[0] - 1) / 2, (chessboard_size[1] - 1) / 2, 0]) * square_size
+    pairs = []
+    for _ in range(count):
+        rvec = rng.uniform(-0.35, 0.35, 3)
+        R, _ = cv2.Rodrigues(rvec)
+        centre = np.array([rng.uniform(-0.15, 0.15), rng.uniform(-0.08, 0.08), rng.uniform(0.7, 1.0)])
+        tvec = centre - R @ board_centre
+        left = _render_board(K, rvec, tvec, size, chessboard_size, square_size)
+        right = _render_board(K, rvec, tvec - np.array([BASELINE, 0, 0]), size, chessboard_size, square_size)
+        pairs.append((cv2.imencode(".png", left)[1].tobytes(), cv2.imencode(".png", right)[1].tobytes()))
+    return pairs
+
+
+def _max_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+
+
+def time_stage(func, repeats=10, warmup=1):
+    """
+    Run func repeatedly and return latency/throughput stats plus the peak Python-visible
+    allocation (tracemalloc, includes numpy buffers) of one extra traced run.
+    """
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000.0)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    samples = np.array(samples)
+    return {
+        "repeats": repeats,
+        "p50_ms": float(np.percentile(samples, 50)),
+        "p99_ms": float(np.percentile(samples, 99)),
+        "mean_ms": float(samples.mean()),
+        "throughput_fps": float(1000.0 / samples.mean()) if samples.mean() > 0 else None,
+        "peak_traced_mb": peak / (1024.0 * 1024.0),
+        "max_rss_mb": _max_rss_mb(),
+    }
+
+
+def _identity_rectification(stereo, width, height):
+    #The synthetic pairs are already rectified; identity maps still exercise the full remap cost
+    K = np.array([[FOCAL_PX * width / 1920.0, 0, width / 2], [0, FOCAL_PX * width / 1920.0, height / 2], [0, 0, 1]])
+    maps = cv2.initUndistortRectifyMap(K, None, np.eye(3), K, (width, height), cv2.CV_16SC2)
+    Q = np.array([[1, 0, 0, -width / 2], [0, 1, 0, -height / 2], [0, 0, 0, K[0, 0]], [0, 0, 1 / BASELINE, 0]])
+    stereo.set_rectification(maps, maps, Q)
+
+
+def benchmark_stereo(resolutions=RESOLUTIONS, scenes=SCENES, modes=DISPARITY_MODES, repeats=10):
+    """
+    Time every StereoSystem stage per resolution and scene and score each disparity mode
+    against the ground truth.
+    """
+    results = []
+    tmp_dir = tempfile.mkdtemp(prefix="stereo_bench_")
+    for width, height in resolutions:
+        for scene in scenes:
+            left, right, truth, valid = synthetic_pair(width, height, scene)
+            left_bgr, right_bgr = cv2.cvtColor(left, cv2.COLOR_GRAY2BGR), cv2.cvtColor(right, cv2.COLOR_GRAY2BGR)
+            base = {"resolution": f"{width}x{height}", "scene": scene}
+
+            stereo = StereoSystem()
+            _identity_rectification(stereo, width, height)
+            stereo.configure_rectification(grayscale=True)
+            results.append(dict(base, stage="rectify_pair", **time_stage(
+                lambda: stereo.rectify_pair(left_bgr, right_bgr), repeats)))
+
+            disparity = None
+            for mode in modes:
+                system = StereoSystem(disparity_mode=mode)
+                row = dict(base, stage="compute_disparity", mode=mode, **time_stage(
+                    lambda: system.compute_disparity(left, right), repeats))
+                _, estimate, _ = system.compute_disparity(left, right)
+                row.update(disparity_errors(estimate, truth, valid))
+                results.append(row)
+                if mode == "single":
+                    disparity = estimate.copy()
+                if system.disparity_engine is not None:
+                    system.disparity_engine.close()
+
+            depth = np.empty(disparity.shape, np.float32)
+            results.append(dict(base, stage="disparity_to_depth", **time_stage(
+                lambda: stereo.disparity_to_depth(disparity, out=depth), repeats)))
+            ply_path = os.path.join(tmp_dir, "cloud.ply")
+            results.append(dict(base, stage="export_point_cloud", **time_stage(
+                lambda: stereo.export_point_cloud(ply_path, disparity, left_bgr), max(1, repeats // 4))))
+            print(f"{width}x{height} {scene}: done")
+    return results
+
+
+def benchmark_calibration(size=(1920, 1080), count=12, repeats=3, detection_scales=(1.0, 0.5)):
+    """
+    Time chessboard detection, mono/stereo calibration and bundle save/load on synthetic views,
+    and report the recovered baseline against BASELINE.
+    """
+    pairs = synthetic_calibration_pairs(size, count)
+    base = {"resolution": f"{size[0]}x{size[1]}", "scene": f"chessboard x{count}"}
+    results = []
+    calib = None
+    for scale in detection_scales:
+        def detect():
+            nonlocal calib
+            calib = CameraCalibration(chessboard_size=(7, 7), square_size=0.03, detection_scale=scale)
+            return calib.add_chessboard_corners_batch(pairs)
+        row = dict(base, stage="add_chessboard_corners_batch", detection_scale=scale, **time_stage(detect, repeats, 0))
+        row["accepted_pairs"] = len(calib.objpoints)
+        results.append(row)
+
+    results.append(dict(base, stage="calibrate_cameras", **time_stage(
+        lambda: calib.calibrate_cameras(size), repeats, 0)))
+    row = dict(base, stage="stereo_calibrate_and_rectify", **time_stage(
+        lambda: calib.stereo_calibrate_and_rectify(size), repeats, 0))
+    row.update(rms_stereo=float(calib.rms_stereo), baseline_error_percent=float(
+        100.0 * abs(np.linalg.norm(calib.T) - BASELINE) / BASELINE))
+    results.append(row)
+
+    bundle = CalibrationBundle.from_calibration(calib, "benchmark", size, 0.0)
+    cache_dir = tempfile.mkdtemp(prefix="stereo_bench_cal_")
+    results.append(dict(base, stage="bundle_save", **time_stage(lambda: bundle.save(cache_dir), repeats, 0)))
+    results.append(dict(base, stage="bundle_load", **time_stage(lambda: CalibrationBundle.load(cache_dir), repeats)))
+    return results
+
+
+def run_benchmarks(out_path="benchmark_results.json", resolutions=RESOLUTIONS, repeats=10, calibration=True):
+    """
+    Run the suite and write machine-readable results (plus environment info) to out_path.
+    """
+    results = benchmark_stereo(resolutions, repeats=repeats)
+    if calibration:
+        results += benchmark_calibration(repeats=max(1, repeats // 3))
+    report = {
+        "created": time.time(),
+        "environment": {"python": platform.python_version(), "numpy": np.__version__, "opencv": cv2.__version__,
+                        "machine": platform.machine(), "cpus": os.cpu_count(),
+                        "opencv_threads": cv2.getNumThreads()},
+        "results": results,
+    }
+    with open(out_path, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"Wrote {len(results)} results to {out_path}")
+    return report
+
+
+def _result_key(row):
+    return (row["stage"], row["resolution"], row["scene"], row.get("mode"), row.get("detection_scale"))
+
+
+def compare_results(baseline_path, current_path, time_tolerance=0.2, error_tolerance=0.5):
+    """
+    List regressions between two result files: p50 latency up by more than time_tolerance
+    (fraction) or bad-pixel rate up by more than error_tolerance (percentage points).
+    """
+    with open(baseline_path) as f:
+        baseline = {_result_key(row): row for row in json.load(f)["results"]}
+    with open(current_path) as f:
+        current = json.load(f)["results"]
+    regressions = []
+    for row in current:
+        old = baseline.get(_result_key(row))
+        if old is None:
+            continue
+        if row["p50_ms"] > old["p50_ms"] * (1.0 + time_tolerance):
+            regressions.append((_result_key(row), "p50_ms", old["p50_ms"], row["p50_ms"]))
+        if "bad_pixel_percent" in row and row["bad_pixel_percent"] > old["bad_pixel_percent"] + error_tolerance:
+            regressions.append((_result_key(row), "bad_pixel_percent", old["bad_pixel_percent"],
+                                row["bad_pixel_percent"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    #Usage: python benchmark.py [out.json] [repeats] [WxH,WxH,...]
+    #       python benchmark.py --compare baseline.json current.json
+    if len(sys.argv) > 1 and sys.argv[1] == "--compare":
+        regressions = compare_results(sys.argv[2], sys.argv[3])
+        for key, metric, old, new in regressions:
+            print(f"REGRESSION {key}: {metric} {old:.2f} -> {new:.2f}")
+        sys.exit(1 if regressions else 0)
+    out_path = sys.argv[1] if len(sys.argv) > 1 else "benchmark_results.json"
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    resolutions = RESOLUTIONS
+    if len(sys.argv) > 3:
+        resolutions = [tuple(int(v) for v in res.split("x")) for res in sys.argv[3].split(",")]
+    report = run_benchmarks(out_path, resolutions, repeats)
+    for row in report["results"]:
+        label = " ".join(str(row[k]) for k in ("stage", "mode", "detection_scale") if row.get(k) is not None)
+        extra = ""
+        if "bad_pixel_percent" in row:
+            epe = "n/a" if row["epe_px"] is None else f"{row['epe_px']:.2f}"
+            extra = f"  bad {row['bad_pixel_percent']:.1f}%  EPE {epe}"
+        print(f"{row['resolution']:>9} {row['scene']:>14} {label:<40} p50 {row['p50_ms']:8.1f} ms  "
+              f"p99 {row['p99_ms']:8.1f} ms{extra}")
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+#Bump whenever the bundle layout or the calibration pipeline changes so old bundles are recomputed
+BUNDLE_VERSION = 2
+LATEST_FILE = "LATEST"
+MANIFEST_FILE = "bundle.json"
+
+#Small calibration matrices stored in every bundle
+MATRIX_NAMES = ("ML", "DL", "MR", "DR", "ML_opt", "MR_opt",
+                "R", "T", "E", "F", "RL", "RR", "PL", "PR", "Q")
+#Precomputed CV_16SC2 rectification maps (loaded memory-mapped)
+MAP_NAMES = ("left_map1", "left_map2", "right_map1", "right_map2")
+
+
+def calibration_key(image_pairs, chessboard_size, square_size, image_size, alpha, detection_scale=1.0):
+    """
+    Hash of everything that determines a calibration result, including the corner
+    detection_scale since coarse-to-fine detection can refine to slightly different corners.
+    File paths are hashed by path, size and modification time so the key is cheap to
+    compute at startup; encoded image bytes are hashed by content.
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps({
+        "version": BUNDLE_VERSION,
+        "chessboard_size": list(chessboard_size),
+        "square_size": float(square_size),
+        "image_size": list(image_size) if image_size is not None else None,
+        "alpha": float(alpha),
+        "detection_scale": float(detection_scale),
+    }, sort_keys=True).encode())
+    for pair in image_pairs:
+        for image in pair:
+            if isinstance(image, (str, os.PathLike)):
+                path = os.path.abspath(os.fspath(image))
+                st = os.stat(path)
+                h.update(f"{path}|{st.st_size}|{st.st_mtime_ns}".encode())
+            else:
+                h.update(hashlib.sha256(memoryview(image)).digest())
+    return h.hexdigest()[:16]
+
+
+class CalibrationBundle:
+    """
+    Versioned on-disk calibration result: intrinsics, stereo extrinsics, rectification
+    matrices, image size, board geometry, RMS errors and the precomputed rectification maps.
+    A bundle is a directory with a JSON manifest and one .npy file per array; the maps
+    are loaded memory-mapped so opening a bundle takes milliseconds.
+    """
+    def __init__(self, key, image_size, chessboard_size, square_size, alpha, rms, arrays,
+                 roi_left=None, roi_right=None):
+        self.key = key
+        self.image_size = tuple(image_size)
+        self.chessboard_size = tuple(chessboard_size)
+        self.square_size = square_size
+        self.alpha = alpha
+        self.rms = rms
+        self.arrays = arrays
+        #Valid pixel ROIs (x, y, w, h) of the rectified images
+        self.roi_left = tuple(roi_left) if roi_left is not None else None
+        self.roi_right = tuple(roi_right) if roi_right is not None else None
+
+    @classmethod
+    def from_calibration(cls, calib, key, image_size, alpha=0.0):
+        """
+        Build a bundle from a CameraCalibration that has run stereo_calibrate_and_rectify.
+        """
+        arrays = {name: np.asarray(getattr(calib, name)) for name in MATRIX_NAMES + MAP_NAMES}
+        rms = {"left": calib.rms_left, "right": calib.rms_right, "stereo": calib.rms_stereo}
+        return cls(key, image_size, calib.chessboard_size, calib.square_size, alpha, rms, arrays,
+                   calib.roi_left, calib.roi_right)
+
+    def save(self, root):
+        """
+        Write the bundle to root/<key>/ and point root/LATEST at it.
+        The directory is written under a temporary name first so readers never see a partial bundle.
+        """
+        os.makedirs(root, exist_ok=True)
+        final_dir = os.path.join(root, self.key)
+        tmp_dir = f"{final_dir}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        for name, array in self.arrays.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(array))
+        manifest = {
+            "version": BUNDLE_VERSION,
+            "key": self.key,
+            "created": time.time(),
+            "image_size": list(self.image_size),
+            "chessboard_size": list(self.chessboard_size),
+            "square_size": self.square_size,
+            "alpha": self.alpha,
+            "rms": self.rms,
+            "roi_left": [int(v) for v in self.roi_left] if self.roi_left is not None else None,
+            "roi_right": [int(v) for v in self.roi_right] if self.roi_right is not None else None,
+            "arrays": sorted(self.arrays),
+        }
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(tmp_dir, final_dir)
+        with open(os.path.join(root, LATEST_FILE), "w") as f:
+            f.write(self.key)
+        return final_dir
+
+    @classmethod
+    def load(cls, path, key=None):
+        """
+        Load a bundle directory, or the bundle named by key (or LATEST) inside a cache root.
+        Returns None if nothing usable is found or the bundle was written by another version.
+        """
+        if not os.path.isfile(os.path.join(path, MANIFEST_FILE)):
+            if key is None:
+                latest = os.path.join(path, LATEST_FILE)
+                if not os.path.isfile(latest):
+                    return None
+                with open(latest) as f:
+                    key = f.read().strip()
+            path = os.path.join(path, key)
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        if not os.path.isfile(manifest_path):
+            return None
+
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get("version") != BUNDLE_VERSION:
+            print(f"Ignoring calibration bundle {path}: version {manifest.get('version')} != {BUNDLE_VERSION}")
+            return None
+        if key is not None and manifest["key"] != key:
+            return None
+
+        arrays = {}
+        for name in manifest["arrays"]:
+            mmap_mode = "r" if name in MAP_NAMES else None
+            arrays[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+        return cls(manifest["key"], manifest["image_size"], manifest["chessboard_size"],
+                   manifest["square_size"], manifest["alpha"], manifest["rms"], arrays,
+                   manifest.get("roi_left"), manifest.get("roi_right"))
+
+    def apply_to_calibration(self, calib):
+        """
+        Restore the saved results onto a CameraCalibration instance.
+        """
+        for name, array in self.arrays.items():
+            setattr(calib, name, array)
+        calib.rms_left = self.rms.get("left")
+        calib.rms_right = self.rms.get("right")
+        calib.rms_stereo = self.rms.get("stereo")
+        calib.roi_left = self.roi_left
+        calib.roi_right = self.roi_right
+
+    def left_maps(self):
+        return self.arrays["left_map1"], self.arrays["left_map2"]
+
+    def right_maps(self):
+        return self.arrays["right_map1"], self.arrays["right_map2"]
@@ -1,21 +1,199 @@
-from image_transfer import ImageClient
+from image_transfer import CODEC_H264, CODEC_RAW, FLAG_DISPARITY, FLAG_KEYFRAME, FLAG_RECTIFIED, ImageClient
+from encoding import H264Decoder, unpack_disparity
 from stereo_class import CameraCalibration, StereoSystem
+from calibration_store import CalibrationBundle
+from pipeline import StreamingPipeline
 import numpy as np
 import cv2
+import time
 
 class StereoClientDevice:
-    def __init__(self, server_host='localhost', server_port=8080, testing_flag=False):
+    def __init__(self, server_host='localhost', server_port=8080, testing_flag=False,
+                 calibration_dir="calibration_cache", calibration_images=None, image_size=(1920, 1080)):
         self.client = ImageClient(server_host, server_port)
         self.calib = CameraCalibration()
         self.stereo = StereoSystem()
         self.testing = testing_flag
 
-    
+        #Calibration inputs; the saved bundle is reused unless these change
+        self.calibration_dir = calibration_dir
+        self.calibration_images = calibration_images
+        self.image_size = image_size
+
+        #One stateful decoder per eye for live H.264 video, created on the first video frame.
+        #The decoders need every frame since the last keyframe, so after a gap in the sequence
+        #numbers (a pair dropped by the server or a pipeline queue) frames are skipped until the
+        #next keyframe pair
+        self._video_decoders = None
+        self._video_next_seq = None
+        self._video_need_keyframe = True
+        self.video_frames_skipped = 0
+
+    def load_calibration(self):
+        """
+        Load rectification from the calibration cache, calibrating only if the
+        calibration image pairs changed since the saved bundle was written.
+        Returns the bundle, or None if there is nothing to load or calibrate from.
+        """
+        if self.calibration_images:
+            bundle = self.calib.load_or_calibrate(self.calibration_images, self.image_size, self.calibration_dir)
+        else:
+            bundle = CalibrationBundle.load(self.calibration_dir)
+            if bundle is None:
+                print(f"No calibration bundle in {self.calibration_dir}, running without rectification")
+                return None
+            bundle.apply_to_calibration(self.calib)
+        self.stereo.load_rectification(bundle)
+        return bundle
+
+    #Pipeline stages: each takes and returns the frame dict
+    def _receive_stage(self):
+        received = self.client.receive_frame()
+        frame = {"received": received}
+        if received.seq is not None:
+            frame["seq"] = received.seq
+        return frame
+
+    def _decode_stage(self, frame):
+        received = frame["received"]
+        if received.flags & FLAG_DISPARITY:
+            # edge depth frame: the Pi already matched the pair, so only unpack the disparity
+            frame["disparity"], frame["valid"] = unpack_disparity(received.left.decode(), received.right.decode(),
+                                                                  invalid=self.stereo.min_disp - 1)
+            frame["rectified"] = True
+            frame.pop("received").release()
+            return frame
+        if received.left.codec == CODEC_H264:
+            if not self._video_in_sync(received):
+                self.video_frames_skipped += 1
+                frame.pop("received").release()
+                return None
+            if self._video_decoders is None:
+                self._video_decoders = (H264Decoder(), H264Decoder())
+            frame["left"] = self._video_decoders[0].decode(received.left.payload)
+            frame["right"] = self._video_decoders[1].decode(received.right.payload)
+        else:
+            frame["left"], frame["right"] = received.left.decode(), received.right.decode()
+        frame["rectified"] = bool(received.flags & FLAG_RECTIFIED)
+        if received.left.codec != CODEC_RAW:
+            # raw images are views into the receive buffers, released after rectification
+            frame.pop("received").release()
+        if frame["left"] is None or frame["right"] is None:
+            print("Failed to decode frame", frame["seq"])
+            if "received" in frame:
+                frame.pop("received").release()
+            return None
+        return frame
+
+    def _video_in_sync(self, received):
+        """
+        Whether an H.264 pair can be decoded: True from a keyframe pair onwards until the
+        sequence numbers show that a pair went missing.
+        """
+        if self._video_next_seq is not None and received.seq != self._video_next_seq:
+            self._video_need_keyframe = True
+        self._video_next_seq = None if received.seq is None else received.seq + 1
+        if received.flags & FLAG_KEYFRAME:
+            self._video_need_keyframe = False
+        return not self._video_need_keyframe
+
+    @staticmethod
+    def _release_frame(frame):
+        #Pipeline drop callback: hand a discarded frame's receive buffers back to the pool
+        received = frame.pop("received", None)
+        if received is not None:
+            received.release()
+
+    def _match_device_rectification(self, shape):
+        """
+        Frames rectified on the Pi may be downscaled; configure the same output scale
+        here so self.stereo.Q matches their geometry.
+        """
+        if self.stereo.left_map1 is None:
+            return
+        scale = shape[1] / self.stereo.left_map1.shape[1]
+        if abs(scale - self.stereo.rect_scale) > 1e-3:
+            self.stereo.configure_rectification(grayscale=True, scale=scale,
+                                                buffer_count=self.stereo.rect_buffer_count)
+
+    def _rectify_stage(self, frame):
+        if "disparity" in frame:
+            self._match_device_rectification(frame["disparity"].shape)
+        elif frame.get("rectified"):
+            self._match_device_rectification(frame["left"].shape)
+            if "received" in frame:
+                frame["left"], frame["right"] = frame["left"].copy(), frame["right"].copy()
+        elif self.stereo.left_map1 is not None:
+            frame["left"], frame["right"] = self.stereo.rectify_pair(frame["left"], frame["right"])
+        elif frame["left"].ndim == 3:
+            frame["left"] = cv2.cvtColor(frame["left"], cv2.COLOR_BGR2GRAY)
+            frame["right"] = cv2.cvtColor(frame["right"], cv2.COLOR_BGR2GRAY)
+        elif "received" in frame:
+            frame["left"], frame["right"] = frame["left"].copy(), frame["right"].copy()
+        received = frame.pop("received", None)
+        if received is not None:
+            received.release()
+        return frame
+
+    def _disparity_stage(self, frame):
+        if "disparity" in frame:
+            return frame
+        _, frame["disparity"], _ = self.stereo.compute_disparity(frame["left"], frame["right"])
+        return frame
+
+    def _depth_stage(self, frame):
+        if self.stereo.Q is not None:
+            frame["depth"] = self.stereo.disparity_to_depth(frame["disparity"])
+        return frame
+
+    def run_pipeline(self, queue_size=2, drop_policy="drop_oldest", display=True, duration=None):
+        """
+        Pipelined runtime: receive -> decode -> rectify -> disparity -> depth, each stage on
+        its own thread with bounded queues. drop_policy decides what happens to stale frames
+        when a downstream stage falls behind (see pipeline.DROP_POLICIES).
+        duration: stop after this many seconds (e.g. for load tests); None runs until 'q' or disconnect
+        """
+        deadline = None if duration is None else time.monotonic() + duration
+        self.load_calibration()
+        self.client.save_images = False
+        self.client.connect()
+
+        #Rectified frames wait in up to three queues plus the two stages and the consumer holding them
+        self.stereo.configure_rectification(grayscale=True, buffer_count=3 * queue_size + 3)
+        pipeline = StreamingPipeline(self._receive_stage, [
+            ("decode", self._decode_stage),
+            ("rectify", self._rectify_stage),
+            ("disparity", self._disparity_stage),
+            ("depth", self._depth_stage),
+        ], queue_size=queue_size, drop_policy=drop_policy, on_drop=self._release_frame)
+        pipeline.start()
+        try:
+            while pipeline.running and (deadline is None or time.monotonic() < deadline):
+                frame = pipeline.get(timeout=0.5)
+                if frame is None or not display:
+                    continue
+                disp_vis = cv2.normalize(frame["disparity"], None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+                cv2.imshow("Disparity", disp_vis)
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # disconnect first so the receive stage is not left blocked in recv while stop() joins it
+            self.client.disconnect()
+            pipeline.stop()
+            if display:
+                cv2.destroyAllWindows()
+        for stage in pipeline.report()["stages"]:
+            print(f"{stage['stage']:>10}: {stage['processed']} frames, {stage['dropped']} dropped, {stage['mean_ms']:.1f} ms")
+        return pipeline.report()
+
     def load_local_images(self, left_filename="left_image.jpg", right_filename="right_image.jpg"):
         #load images from local storage
         pass    
         
     def run(self):
+        self.load_calibration()
         if not self.testing:
             self.client.connect()
         else:
@@ -23,16 +201,19 @@ class StereoClientDevice:
 
         while self.client.connected:
             if not self.testing:
-                imgL, imgR = self.client.receive_images()
+                with self.client.receive_frame() as frame:
+                    imgL_cv, imgR_cv = frame.left.decode(cv2.IMREAD_COLOR), frame.right.decode(cv2.IMREAD_COLOR)
+                    if frame.left.codec == CODEC_RAW:
+                        imgL_cv, imgR_cv = imgL_cv.copy(), imgR_cv.copy()
             else:
                 fL = open("C:\\Users\\15877\\OneDrive\\Documents\\GitHub\\StereoVisionCapstone\\LeftCBoard.png", 'rb')
                 imgL = fL.read()
                 fR = open("C:\\Users\\15877\\OneDrive\\Documents\\GitHub\\StereoVisionCapstone\\RightCBoard.png", 'rb')
                 imgR = fR.read()
-            imgL_array = np.frombuffer(imgL,np.uint8)
-            imgR_array = np.frombuffer(imgR,np.uint8)
+                imgL_array = np.frombuffer(imgL,np.uint8)
+                imgR_array = np.frombuffer(imgR,np.uint8)
 
-            imgL_cv, imgR_cv = self.calib.decode_img(imgL_array, imgR_array)
+                imgL_cv, imgR_cv = self.calib.decode_img(imgL_array, imgR_array)
 
             cv2.imshow("Img",imgL_cv)
             cv2.waitKey(0)
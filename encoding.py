@@ -0,0 +1,267 @@
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+
+import cv2
+import numpy as np
+
+from instrumentation import current_frame, set_frame, stage
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # optional fast lossless compressor
+    lz4_frame = None
+
+try:
+    import av
+except ImportError:  # optional, only needed for H.264 video off the Pi's hardware encoders
+    av = None
+
+# Payload codecs carried in the protocol v2 image header
+CODEC_RAW = 0      # numpy array bytes, described by dtype and shape
+CODEC_JPEG = 1
+CODEC_PNG = 2
+CODEC_ENCODED = 3  # any format cv2.imdecode understands (v1 frames, unlabelled bytes)
+CODEC_ZLIB = 4     # zlib-compressed raw array, described by dtype and shape
+CODEC_LZ4 = 5      # lz4-frame-compressed raw array, described by dtype and shape
+CODEC_H264 = 6     # one H.264 access unit from a continuous stream; decode with H264Decoder
+
+CODEC_NAMES = {"raw": CODEC_RAW, "jpeg": CODEC_JPEG, "png": CODEC_PNG, "zlib": CODEC_ZLIB, "lz4": CODEC_LZ4}
+FILE_EXTENSIONS = {CODEC_RAW: ".raw", CODEC_JPEG: ".jpg", CODEC_PNG: ".png", CODEC_ZLIB: ".zlib", CODEC_LZ4: ".lz4",
+                   CODEC_H264: ".h264"}
+
+
+class EncodedImage:
+    """
+    An encoded payload plus the shape and dtype of the array it decodes to.
+    """
+    def __init__(self, payload, codec, shape=None, dtype=None):
+        self.payload = payload
+        self.codec = codec
+        self.shape = tuple(shape) if shape is not None else None
+        self.dtype = np.dtype(dtype) if dtype is not None else None
+
+    @property
+    def nbytes(self):
+        return memoryview(self.payload).nbytes
+
+
+def encode_image(image, codec=CODEC_JPEG, quality=90, level=1):
+    """
+    Encode one numpy image.
+    quality: JPEG quality (0-100)
+    level: PNG / zlib compression level (low is fast)
+    4-channel XBGR frames from the cameras lose their padding channel, which is never used.
+    """
+    if image.ndim == 3 and image.shape[2] == 4:
+        image = image[:, :, :3]
+    if codec == CODEC_JPEG:
+        ok, buf = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    elif codec == CODEC_PNG:
+        ok, buf = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, level])
+    elif codec == CODEC_RAW:
+        return EncodedImage(np.ascontiguousarray(image), codec, image.shape, image.dtype)
+    elif codec == CODEC_ZLIB:
+        data = zlib.compress(np.ascontiguousarray(image), level)
+        return EncodedImage(data, codec, image.shape, image.dtype)
+    elif codec == CODEC_LZ4:
+        if lz4_frame is None:
+            raise ImportError("lz4 codec requires the lz4 package (pip install lz4)")
+        data = lz4_frame.compress(np.ascontiguousarray(image))
+        return EncodedImage(data, codec, image.shape, image.dtype)
+    else:
+        raise ValueError(f"Unknown codec: {codec}")
+    if not ok:
+        raise ValueError(f"Failed to encode image with codec {codec}")
+    return EncodedImage(buf, codec, image.shape, image.dtype)
+
+
+def _encode_for_frame(seq, image, codec, quality, level):
+    #Runs on an encoder thread: tag the timing with the frame that submitted it
+    set_frame(seq)
+    with stage("encode") as timer:
+        encoded = encode_image(image, codec, quality, level)
+        timer.add_bytes(encoded.nbytes)
+    return encoded
+
+
+def pack_disparity(disparity_fixed, invalid_value):
+    """
+    Split a fixed-point disparity map into (disparity with invalid pixels zeroed, bit-packed
+    validity mask) for compact lossless transfer.
+    """
+    valid = disparity_fixed > invalid_value
+    disparity = np.where(valid, disparity_fixed, 0).astype(np.int16)
+    return disparity, np.packbits(valid, axis=1)
+
+
+def unpack_disparity(disparity_fixed, packed_mask, invalid=np.nan):
+    """
+    Inverse of pack_disparity: (disparity in px as float32, validity mask).
+    Invalid pixels are set to invalid (e.g. min_disp - 1 to match StereoSystem.compute_disparity).
+    """
+    valid = np.unpackbits(packed_mask, axis=1, count=disparity_fixed.shape[1]).astype(bool)
+    disparity = disparity_fixed.astype(np.float32) / 16.0
+    disparity[~valid] = invalid
+    return disparity, valid
+
+
+def decode_image(payload, codec, shape=None, dtype=None, flags=cv2.IMREAD_UNCHANGED):
+    """
+    Decode a payload produced by encode_image (or any cv2.imdecode format).
+    Raw payloads are returned as zero-copy views.
+    """
+    if codec == CODEC_RAW:
+        return np.frombuffer(payload, dtype).reshape(shape)
+    if codec == CODEC_ZLIB:
+        return np.frombuffer(zlib.decompress(payload), dtype).reshape(shape)
+    if codec == CODEC_LZ4:
+        if lz4_frame is None:
+            raise ImportError("lz4 codec requires the lz4 package (pip install lz4)")
+        return np.frombuffer(lz4_frame.decompress(payload), dtype).reshape(shape)
+    if codec == CODEC_H264:
+        raise ValueError("H.264 frames depend on earlier frames; decode them with an H264Decoder per stream")
+    return cv2.imdecode(np.frombuffer(payload, np.uint8), flags)
+
+
+class H264Decoder:
+    """
+    Stateful decoder for one H.264 stream received frame by frame (one decoder per eye).
+    Frames before the first keyframe, or after a gap in the stream, decode to None.
+    """
+    def __init__(self):
+        if av is None:
+            raise ImportError("H.264 decoding requires the av package (pip install av)")
+        self._codec = av.CodecContext.create("h264", "r")
+
+    def decode(self, payload):
+        """
+        Feed one access unit; returns the newest decoded BGR frame or None.
+        """
+        image = None
+        try:
+            for packet in self._codec.parse(bytes(payload)):
+                for frame in self._codec.decode(packet):
+                    image = frame.to_ndarray(format="bgr24")
+        except av.error.FFmpegError as e:
+            print("H.264 decode error:", e)
+            return None
+        return image
+
+
+class SoftwareH264Encoder:
+    """
+    Software H.264 encoder for one stream (libx264 through av) framed like the Pi's hardware
+    encoders: one access unit per frame, no B-frames, SPS/PPS repeated on every keyframe.
+    Used where there is no camera, e.g. to replay recorded pairs as live video.
+    """
+    def __init__(self, width, height, fps=30, iperiod=None, bitrate=1000000):
+        if av is None:
+            raise ImportError("H.264 encoding requires the av package (pip install av)")
+        self._codec = av.CodecContext.create("libx264", "w")
+        self._codec.width, self._codec.height = width, height
+        self._codec.pix_fmt = "yuv420p"
+        self._codec.time_base = Fraction(1, fps)
+        self._codec.framerate = Fraction(fps, 1)
+        self._codec.bit_rate = bitrate
+        self._codec.gop_size = iperiod or fps
+        self._codec.options = {"preset": "ultrafast", "tune": "zerolatency", "x264-params": "repeat-headers=1"}
+        self._pts = 0
+        self._force_keyframe = False
+
+    def request_keyframe(self):
+        """
+        Make the next encoded frame an IDR frame.
+        """
+        self._force_keyframe = True
+
+    def encode(self, image):
+        """
+        Encode one BGR or grayscale frame; returns [(access unit bytes, keyframe), ...].
+        """
+        frame = av.VideoFrame.from_ndarray(image, format="gray" if image.ndim == 2 else "bgr24")
+        frame.pts = self._pts
+        self._pts += 1
+        if self._force_keyframe:
+            frame.pict_type = av.video.frame.PictureType.I
+            self._force_keyframe = False
+        return [(bytes(packet), packet.is_keyframe) for packet in self._codec.encode(frame)]
+
+
+class FrameEncoder:
+    """
+    Encodes stereo pairs on a worker pool. Both eyes are encoded at the same time and
+    submit() returns immediately, so encoding overlaps with the next capture.
+    OpenCV and zlib release the GIL while encoding, so threads are enough.
+    """
+    def __init__(self, codec="jpeg", quality=90, level=1, workers=2):
+        self.codec = CODEC_NAMES[codec] if isinstance(codec, str) else codec
+        if self.codec == CODEC_LZ4 and lz4_frame is None:
+            raise ImportError("lz4 codec requires the lz4 package (pip install lz4)")
+        self.quality = quality
+        self.level = level
+        self._pool = ThreadPoolExecutor(max_workers=max(2, workers))
+
+    def submit(self, left, right, codec=None):
+        """
+        Start encoding a pair; returns (left_future, right_future) resolving to EncodedImage.
+        codec overrides the encoder's codec for this pair.
+        """
+        codec = self.codec if codec is None else codec
+        seq = current_frame()
+        return (self._pool.submit(_encode_for_frame, seq, left, codec, self.quality, self.level),
+                self._pool.submit(_encode_for_frame, seq, right, codec, self.quality, self.level))
+
+    def encode_pair(self, left, right):
+        future_left, future_right = self.submit(left, right)
+        return future_left.result(), future_right.result()
+
+    def close(self):
+        self._pool.shutdown()
+
+
+def benchmark_codecs(left, right, codecs=None, link_mbps=20.0, repeats=5, workers=2):
+    """
+    Encode a pair with each codec and report the median pair encode time, bytes on the
+    wire and decode time, which are measured, plus est_transfer_ms and est_latency_ms
+    (encode + transfer + decode), which are estimated from link_mbps and not measured.
+    replay_acquisition.load_test measures throughput over a real connection.
+    """
+    if codecs is None:
+        codecs = [("raw", {}), ("jpeg", {"quality": 90}), ("jpeg", {"quality": 75}), ("png", {}), ("zlib", {})]
+        if lz4_frame is not None:
+            codecs.append(("lz4", {}))
+    results = []
+    for name, options in codecs:
+        encoder = FrameEncoder(name, workers=workers, **options)
+        encode_times, decode_times = [], []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            encL, encR = encoder.encode_pair(left, right)
+            encode_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            for enc in (encL, encR):
+                decode_image(enc.payload, enc.codec, enc.shape, enc.dtype)
+            decode_times.append(time.perf_counter() - start)
+        encoder.close()
+        nbytes = encL.nbytes + encR.nbytes
+        encode_ms = float(np.median(encode_times)) * 1000.0
+        decode_ms = float(np.median(decode_times)) * 1000.0
+        transfer_ms = nbytes * 8 / (link_mbps * 1e6) * 1000.0
+        label = name + "".join(f" {k}={v}" for k, v in options.items())
+        results.append({"codec": label, "encode_ms": encode_ms, "bytes": nbytes, "decode_ms": decode_ms,
+                        "est_transfer_ms": transfer_ms, "est_latency_ms": encode_ms + transfer_ms + decode_ms})
+    return results
+
+
+if __name__ == "__main__":
+    #Usage: python encoding.py left.png right.png [link_mbps]
+    left = cv2.imread(sys.argv[1])
+    right = cv2.imread(sys.argv[2])
+    link_mbps = float(sys.argv[3]) if len(sys.argv) > 3 else 20.0
+    print(f"Pair {left.shape[1]}x{left.shape[0]}, transfer estimated for a {link_mbps} Mbit/s link")
+    for row in benchmark_codecs(left, right, link_mbps=link_mbps):
+        print(f"{row['codec']:>16}: encode {row['encode_ms']:7.1f} ms  {row['bytes'] / 1e6:7.2f} MB  "
+              f"decode {row['decode_ms']:6.1f} ms  est. end-to-end {row['est_latency_ms']:8.1f} ms")
@@ -1,18 +1,114 @@
+import asyncio
+import queue
 import socket
 import threading
 import struct
 import time
 import sys
 import datetime
+from collections import deque
+
+import cv2
+import numpy as np
+
+from instrumentation import set_frame, stage
+from encoding import (CODEC_ENCODED, CODEC_H264, CODEC_JPEG, CODEC_LZ4, CODEC_PNG, CODEC_RAW, CODEC_ZLIB,
+                      EncodedImage, decode_image)
+
+# Protocol v2: one header for the whole stereo pair followed by the payloads.
+#   pair header: magic, version, flags, image count, sequence number
+#   per image:   sensor timestamp (ns), codec, dtype, ndim, shape (3 dims), payload length
+# Protocol v1 (indicator + length + payload per image) is still understood by ImageClient.
+PROTOCOL_MAGIC = b'SVP2'
+PROTOCOL_VERSION = 2
+PAIR_HEADER = struct.Struct('>4sBBHQ')
+IMAGE_HEADER = struct.Struct('>QBBBxIIIQ')
+
+# Payload codecs are defined in encoding.py (CODEC_RAW, CODEC_JPEG, ...)
+
+# Pair header flags
+FLAG_RECTIFIED = 0x01  # images are already rectified (e.g. on the Pi); skip rectification on the client
+FLAG_DISPARITY = 0x02  # left slot: int16 fixed-point disparity, right slot: bit-packed validity mask
+FLAG_KEYFRAME = 0x04   # H.264 pair where both eyes are keyframes; a decoder can start here
+
+# Raw array element types (little-endian on the wire)
+DTYPE_CODES = {0: np.dtype('u1'), 1: np.dtype('<u2'), 2: np.dtype('<i2'),
+               3: np.dtype('<f4'), 4: np.dtype('<f2')}
+DTYPE_IDS = {dtype: code for code, dtype in DTYPE_CODES.items()}
+
+
+def _geometry_fields(shape, dtype):
+    if dtype not in DTYPE_IDS or len(shape) > 3:
+        raise ValueError(f"Unsupported array geometry for transfer: {dtype} {shape}")
+    return (DTYPE_IDS[dtype], len(shape)) + tuple(shape) + (0,) * (3 - len(shape))
+
+
+def _image_entry(image, timestamp_ns, codec):
+    """Header fields and payload view for one image (numpy array, EncodedImage or encoded bytes)."""
+    if isinstance(image, EncodedImage):
+        payload = memoryview(image.payload).cast('B')
+        geometry = _geometry_fields(image.shape, image.dtype) if image.shape is not None else (0,) * 5
+        fields = (timestamp_ns, image.codec) + geometry + (payload.nbytes,)
+    elif isinstance(image, np.ndarray) and codec in (None, CODEC_RAW):
+        image = np.ascontiguousarray(image)
+        payload = memoryview(image).cast('B')
+        fields = (timestamp_ns, CODEC_RAW) + _geometry_fields(image.shape, image.dtype) + (payload.nbytes,)
+    else:
+        payload = memoryview(image).cast('B')
+        fields = (timestamp_ns, CODEC_ENCODED if codec is None else codec, 0, 0, 0, 0, 0, payload.nbytes)
+    return IMAGE_HEADER.pack(*fields), payload
+
+
+def pack_stereo_pair(left, right=None, seq=0, timestamps=None, codec=None, flags=0):
+    """Build the protocol v2 buffers (header, left payload[, right payload]) for one pair.
+    Images may be numpy arrays (sent raw with shape and dtype), EncodedImage objects
+    (sent with their codec and decoded geometry) or encoded bytes.
+    timestamps: (left_ns, right_ns) sensor timestamps, defaults to the current time.
+    """
+    images = [left] if right is None else [left, right]
+    if timestamps is None:
+        now = time.time_ns()
+        timestamps = (now, now)
+    header = [PAIR_HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, flags, len(images), seq)]
+    payloads = []
+    for image, timestamp in zip(images, timestamps):
+        image_header, payload = _image_entry(image, int(timestamp), codec)
+        header.append(image_header)
+        payloads.append(payload)
+    return [b''.join(header)] + payloads
+
+
+def sendmsg_all(sock, buffers):
+    """Send a list of buffers with scatter/gather I/O, normally in a single syscall."""
+    views = [memoryview(b).cast('B') for b in buffers]
+    views = [v for v in views if v.nbytes]
+    if not hasattr(sock, 'sendmsg'):
+        # platforms without sendmsg (Windows)
+        for view in views:
+            sock.sendall(view)
+        return
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= views[0].nbytes:
+            sent -= views[0].nbytes
+            views.pop(0)
+        if views and sent:
+            views[0] = views[0][sent:]
+
 
 class ImageServerHost:
     """Non-blocking image server that accepts a single client and sends images
-    on demand via `send_images(left_bytes, right_bytes=None)`.
-    Images are sent as a 4-byte big-endian length prefix followed by payload.
+    on demand via `send_images(left, right=None)`.
+    With protocol_version=2 (default) a pair is framed by a single header carrying
+    sequence number, timestamps, codec and array geometry, and sent in one sendmsg.
+    With protocol_version=1 each image is sent as an indicator and a 4-byte
+    big-endian length prefix followed by payload.
     """
-    def __init__(self, host='localhost', port=8080):
+    def __init__(self, host='localhost', port=8080, protocol_version=PROTOCOL_VERSION):
         self.host = host
         self.port = port
+        self.protocol_version = protocol_version
+        self._seq = 0
         self.server_socket = None
         self.client_socket = None
         self.connected = False
@@ -78,18 +174,34 @@ class ImageServerHost:
                     self.connected = False
             print("Client disconnected")
 
-    def send_images(self, left_image_bytes, right_image_bytes=None):
+    def send_images(self, left_image_bytes, right_image_bytes=None, seq=None, timestamps=None, codec=None, flags=0):
         """Send one or two images to the connected client.
 
-        Each image is prefixed with a 4-byte big-endian unsigned length.
+        Images may be encoded bytes or numpy arrays (sent raw with their shape and dtype).
+        seq defaults to an incrementing counter, timestamps to the send time (ns) and
+        codec to CODEC_RAW for arrays / CODEC_ENCODED for bytes. Only the payloads
+        are sent with protocol_version=1.
         Raises ConnectionError if no client is connected.
         """
         with self._lock:
             if not self.connected or not self.client_socket:
                 raise ConnectionError("No client connected")
             sock = self.client_socket
+            if seq is None:
+                seq = self._seq
+            self._seq = seq + 1
 
+        set_frame(seq)
         try:
+            if self.protocol_version >= 2:
+                buffers = pack_stereo_pair(left_image_bytes, right_image_bytes, seq, timestamps, codec, flags)
+                with stage("send", sum(memoryview(b).nbytes for b in buffers)):
+                    sendmsg_all(sock, buffers)
+                return
+            if isinstance(left_image_bytes, EncodedImage):
+                left_image_bytes = left_image_bytes.payload
+            if isinstance(right_image_bytes, EncodedImage):
+                right_image_bytes = right_image_bytes.payload
             # send left image and indicator
             sock.sendall(struct.pack('>I', 0))  # Send a single byte to indicate left image
             sock.sendall(struct.pack('>I', len(left_image_bytes)))
@@ -115,11 +227,20 @@ class ImageServerHost:
         self._running = False
         try:
             if self.server_socket:
+                # shutdown wakes the blocked accept(); close alone does not on Linux
+                try:
+                    self.server_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
                 self.server_socket.close()
         except Exception:
             pass
         with self._lock:
             if self.client_socket:
+                try:
+                    self.client_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
                 try:
                     self.client_socket.close()
                 except Exception:
@@ -143,25 +264,487 @@ class ImageServerHost:
             pass
 
 
+def _depends_on_previous(image, codec, flags):
+    """True for an H.264 pair that is not a keyframe pair, i.e. one a decoder can only use
+    if it received every pair since the last keyframe."""
+    codec = image.codec if isinstance(image, EncodedImage) else codec
+    return codec == CODEC_H264 and not flags & FLAG_KEYFRAME
+
+
+class _ClientSession:
+    """Per-client state for AsyncImageServerHost."""
+    def __init__(self, addr, queue_size):
+        self.addr = addr
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.sent = 0
+        self.dropped = 0
+        # H.264 pairs skipped while waiting for a keyframe (after a drop or on joining mid-stream)
+        self.skipped = 0
+        self.need_keyframe = True
+        self.keyframe_requested = False
+
+
+class AsyncImageServerHost:
+    """asyncio image server that accepts any number of clients (viewer, recorder,
+    depth processor, ...) and broadcasts every pair passed to `send_images` to all
+    of them using protocol v2.
+
+    The event loop runs in one background thread; disconnects are noticed by the
+    reader instead of polling. Each client has its own bounded send queue: when a
+    client falls behind, its oldest queued pair is dropped, so one slow consumer
+    never blocks capture or the other clients. Payloads are queued by reference and
+    must not be modified after send_images returns.
+
+    For H.264 streams a drop breaks the client's reference chain, so after dropping
+    a video pair that client gets no more pairs until the next keyframe pair (nor
+    does a client that joins mid-stream), and keyframe_requester (if set, e.g. by
+    StereoVideoStreamer) is called from the event loop to ask the encoders for one.
+    """
+    def __init__(self, host='localhost', port=8080, queue_size=2):
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._sessions = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self.keyframe_requester = None
+
+    @property
+    def connected(self):
+        return bool(self._sessions)
+
+    def start_server(self):
+        self._ready.clear()
+        self._thread = threading.Thread(target=self._run_loop, name="image-server", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._server is None:
+            raise OSError(f"Could not start image server on {self.host}:{self.port}")
+
+    def _run_loop(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle_client, self.host, self.port, reuse_address=True))
+            print(f"Image server started on {self.host}:{self.port}")
+        except OSError as e:
+            print("Error starting image server:", e)
+        finally:
+            self._ready.set()
+        if self._server is not None:
+            self._loop.run_forever()
+        self._loop.close()
+
+    async def _handle_client(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        session = _ClientSession(addr, self.queue_size)
+        self._sessions[writer] = session
+        print(f"Client connected from {addr}")
+        sender = asyncio.ensure_future(self._send_loop(writer, session))
+        try:
+            # clients don't send anything; read() only returns b'' once they disconnect
+            while await reader.read(4096):
+                pass
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            sender.cancel()
+            self._sessions.pop(writer, None)
+            writer.close()
+            print(f"Client {addr} disconnected ({session.sent} pairs sent, {session.dropped} dropped, "
+              f"{session.skipped} skipped)")
+
+    async def _send_loop(self, writer, session):
+        try:
+            while True:
+                buffers, _ = await session.queue.get()
+                writer.writelines(buffers)
+                await writer.drain()
+                session.sent += 1
+        except (ConnectionError, OSError):
+            writer.close()
+
+    def _broadcast(self, buffers, video, dependent):
+        for session in list(self._sessions.values()):
+            if session.queue.full():
+                _, dropped_video = session.queue.get_nowait()
+                session.dropped += 1
+                if dropped_video:
+                    session.need_keyframe = True
+                    session.keyframe_requested = False
+            if video and not dependent:
+                session.need_keyframe = False
+            elif dependent and session.need_keyframe:
+                session.skipped += 1
+                if not session.keyframe_requested and self.keyframe_requester is not None:
+                    session.keyframe_requested = True
+                    self.keyframe_requester()
+                continue
+            session.queue.put_nowait((buffers, video))
+
+    def send_images(self, left_image_bytes, right_image_bytes=None, seq=None, timestamps=None, codec=None, flags=0):
+        """Queue one pair for every connected client; returns without waiting for the network.
+        Same arguments as ImageServerHost.send_images.
+        Raises ConnectionError if no client is connected.
+        """
+        if not self.connected:
+            raise ConnectionError("No client connected")
+        with self._lock:
+            if seq is None:
+                seq = self._seq
+            self._seq = seq + 1
+        set_frame(seq)
+        dependent = _depends_on_previous(left_image_bytes, codec, flags)
+        video = dependent or (flags & FLAG_KEYFRAME) != 0
+        with stage("send_queue"):
+            buffers = pack_stereo_pair(left_image_bytes, right_image_bytes, seq, timestamps, codec, flags)
+            self._loop.call_soon_threadsafe(self._broadcast, buffers, video, dependent)
+
+    def client_stats(self):
+        """Pairs sent, dropped, skipped (waiting for a keyframe) and currently queued for each connected client."""
+        return [{"addr": s.addr, "sent": s.sent, "dropped": s.dropped, "skipped": s.skipped,
+                 "queued": s.queue.qsize()}
+                for s in list(self._sessions.values())]
+
+    async def _shutdown(self):
+        self._server.close()
+        for writer in list(self._sessions):
+            writer.close()
+        await self._server.wait_closed()
+
+    def stop_server(self):
+        if self._loop is None or self._server is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result(timeout=2)
+        except Exception:
+            pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=2)
+        self._server = None
+        try:
+            sys.stdout.flush()
+        except Exception:
+            pass
+
+
+class StereoVideoStreamer:
+    """
+    Pairs the encoded frames of the two eyes by timestamp and sends each pair over an
+    image server as two CODEC_H264 images with the sensor timestamps (ns) in the pair header.
+    Frames without a partner within half a frame period are dropped. After any drop, or
+    while no client is connected, pairs are skipped until the next keyframe pair so the
+    client's decoders never see a gap.
+    Encoded frames come in through push(), e.g. from one picamera2 Output per eye.
+    on_keyframe_needed: callable asking both encoders for an IDR frame; it is called after a
+    drop here or when the server reports that a client lost a pair
+    (AsyncImageServerHost.keyframe_requester), so the stream recovers without waiting for
+    the next periodic keyframe.
+    """
+    def __init__(self, server, frame_period_ns, queue_size=8, on_keyframe_needed=None):
+        self.server = server
+        self.on_keyframe_needed = on_keyframe_needed
+        self.frame_period_ns = frame_period_ns
+        self._last_idr_request = 0
+        if hasattr(server, "keyframe_requester"):
+            server.keyframe_requester = self.request_keyframe
+        self.max_skew_us = frame_period_ns / 2000.0
+        self._pending = (deque(), deque())
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._need_keyframe = True
+        self._seq = 0
+        self.sent = 0
+        self.dropped = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._send_loop, daemon=True)
+        self._thread.start()
+
+    def push(self, side, frame, keyframe, timestamp_us):
+        """
+        Add one encoded frame of eye side (0 left, 1 right) with its timestamp in microseconds.
+        """
+        with self._lock:
+            self._pending[side].append((frame, keyframe, timestamp_us or 0))
+            left, right = self._pending
+            while left and right:
+                skew = left[0][2] - right[0][2]
+                if abs(skew) > self.max_skew_us:
+                    # the older head has no partner; drop it
+                    (left if skew < 0 else right).popleft()
+                    self._drop()
+                    continue
+                self._enqueue(left.popleft(), right.popleft())
+
+    def _drop(self):
+        self.dropped += 1
+        self._need_keyframe = True
+        self.request_keyframe()
+
+    def request_keyframe(self):
+        """
+        Ask both encoders for an IDR frame, at most once per frame period.
+        """
+        now = time.monotonic_ns()
+        if self.on_keyframe_needed is None or now - self._last_idr_request < self.frame_period_ns:
+            return
+        self._last_idr_request = now
+        self.on_keyframe_needed()
+
+    def _enqueue(self, left, right):
+        keyframe = left[1] and right[1]
+        if self._need_keyframe and not keyframe:
+            self.dropped += 1
+            if self.server.connected:
+                self.request_keyframe()
+            return
+        try:
+            self._queue.put_nowait((left, right, keyframe, self._seq))
+            self._need_keyframe = False
+            self._seq += 1
+        except queue.Full:
+            self._drop()
+
+    def _send_loop(self):
+        while self._running or not self._queue.empty():
+            try:
+                left, right, keyframe, seq = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if not self.server.connected:
+                with self._lock:
+                    self._need_keyframe = True
+                continue
+            try:
+                self.server.send_images(EncodedImage(left[0], CODEC_H264), EncodedImage(right[0], CODEC_H264),
+                                        seq=seq, timestamps=(left[2] * 1000, right[2] * 1000),
+                                        flags=FLAG_KEYFRAME if keyframe else 0)
+                self.sent += 1
+            except Exception as e:
+                print("Failed to send video frames:", e)
+                with self._lock:
+                    self._drop()
+
+    def close(self):
+        self._running = False
+        self._thread.join(timeout=2)
+        if getattr(self.server, "keyframe_requester", None) == self.request_keyframe:
+            self.server.keyframe_requester = None
+
+
+class ReceivedImage:
+    """One received image: its pooled payload buffer and the header fields."""
+    def __init__(self, buffer, codec, timestamp_ns=0, shape=None, dtype=None):
+        self.buffer = buffer
+        self.codec = codec
+        self.timestamp_ns = timestamp_ns
+        self.shape = shape
+        self.dtype = dtype
+
+    @property
+    def payload(self):
+        return self.buffer.array
+
+    def decode(self, flags=cv2.IMREAD_UNCHANGED):
+        """Decoded image. Raw arrays are zero-copy views into the receive buffer,
+        so they are only valid until release()."""
+        with stage("decode"):
+            return decode_image(self.buffer.array, self.codec, self.shape, self.dtype, flags)
+
+    def release(self):
+        self.buffer.release()
+
+
+class StereoFrame:
+    """A received stereo pair with its protocol metadata."""
+    def __init__(self, version, seq, flags, left, right):
+        self.version = version
+        self.seq = seq
+        self.flags = flags
+        self.left = left
+        self.right = right
+
+    @property
+    def skew_ns(self):
+        if self.right is None:
+            return 0
+        return self.left.timestamp_ns - self.right.timestamp_ns
+
+    def release(self):
+        for image in (self.left, self.right):
+            if image is not None:
+                image.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class PooledBuffer:
+    """A receive buffer checked out of a BufferPool.
+    `array` is a uint8 numpy view of exactly the received payload. Call release()
+    (or use it as a context manager) once the payload has been consumed so the
+    storage is reused for a later frame; the view must not be used afterwards.
+    """
+    def __init__(self, pool, storage, nbytes):
+        self._pool = pool
+        self._storage = storage
+        self.nbytes = nbytes
+        self.array = storage[:nbytes]
+
+    def release(self):
+        if self._storage is not None:
+            self._pool._recycle(self._storage)
+            self._storage = None
+            self.array = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class BufferPool:
+    """Thread-safe pool of preallocated uint8 receive buffers.
+    Buffers grow to the largest payload seen, so after the first few frames of a
+    stream no more memory is allocated. At most `size` free buffers are kept.
+    """
+    def __init__(self, size=4):
+        self.size = size
+        self._free = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self, nbytes):
+        with self._lock:
+            for _ in range(len(self._free)):
+                storage = self._free.popleft()
+                if storage.nbytes >= nbytes:
+                    return PooledBuffer(self, storage, nbytes)
+                # too small for this payload; drop it and let a bigger one replace it
+        return PooledBuffer(self, np.empty(nbytes, np.uint8), nbytes)
+
+    def _recycle(self, storage):
+        with self._lock:
+            if len(self._free) < self.size:
+                self._free.append(storage)
+
+
 class ImageClient:
     """Client that connects and receives length-prefixed images.
     It will save each image it receives as received_image_<n>.jpg.
+    receive_images() returns the payloads as bytes; receive_images_pooled()
+    receives straight into pooled numpy buffers without intermediate copies.
     """
-    def __init__(self, server_host='localhost', server_port=8080, save_images = True):
+    def __init__(self, server_host='localhost', server_port=8080, save_images = True, buffer_pool_size=4):
         self.sock = None
         self.server_host = server_host
         self.server_port = server_port
         self.save_images = save_images
         self.connected = False
-        
-    def _recv_all(self, n):
-        data = bytearray()
-        while len(data) < n:
-            packet = self.sock.recv(n - len(data))
-            if not packet:
+        self.buffer_pool = BufferPool(buffer_pool_size)
+        self._header = bytearray(max(8, PAIR_HEADER.size + 2 * IMAGE_HEADER.size))
+
+    def _recv_into(self, view):
+        # fill the whole memoryview from the socket without intermediate copies
+        received = 0
+        n = len(view)
+        while received < n:
+            count = self.sock.recv_into(view[received:], n - received)
+            if count == 0:
                 raise ConnectionError('Socket closed while receiving')
-            data.extend(packet)
-        return bytes(data)
+            received += count
+
+    def _recv_all(self, n):
+        data = bytearray(n)
+        self._recv_into(memoryview(data))
+        return data
+
+    def _recv_image_header(self, expected_indicator, side, indicator_read=False):
+        # v1: 4-byte indicator followed by 4-byte payload length
+        header = memoryview(self._header)
+        self._recv_into(header[4:8] if indicator_read else header[:8])
+        indicator, length = struct.unpack_from('>II', self._header)
+        if indicator != expected_indicator:
+            print(f"Expected {side} image indicator, got:", indicator)
+        return length
+
+    def _recv_payload(self, length):
+        buffer = self.buffer_pool.acquire(length)
+        try:
+            self._recv_into(memoryview(buffer.array))
+        except Exception:
+            buffer.release()
+            raise
+        return buffer
+
+    def _receive_v1(self):
+        # the left indicator (0) has already been read as the first 4 bytes
+        left = right = None
+        try:
+            length = self._recv_image_header(0, "left", indicator_read=True)
+            left = ReceivedImage(self._recv_payload(length), CODEC_ENCODED)
+            length = self._recv_image_header(1, "right")
+            right = ReceivedImage(self._recv_payload(length), CODEC_ENCODED)
+        except Exception:
+            if left is not None:
+                left.release()
+            raise
+        return StereoFrame(1, None, 0, left, right)
+
+    def _receive_v2(self):
+        header = memoryview(self._header)
+        self._recv_into(header[4:PAIR_HEADER.size])
+        _, version, flags, count, seq = PAIR_HEADER.unpack_from(self._header)
+        if version != PROTOCOL_VERSION or count not in (1, 2):
+            raise ConnectionError(f"Unsupported stereo frame header (version {version}, {count} images)")
+        end = PAIR_HEADER.size + count * IMAGE_HEADER.size
+        self._recv_into(header[PAIR_HEADER.size:end])
+
+        images = []
+        try:
+            for i in range(count):
+                timestamp, codec, dtype_code, ndim, d0, d1, d2, length = IMAGE_HEADER.unpack_from(
+                    self._header, PAIR_HEADER.size + i * IMAGE_HEADER.size)
+                shape = (d0, d1, d2)[:ndim] if ndim else None
+                dtype = DTYPE_CODES.get(dtype_code) if ndim else None
+                if codec in (CODEC_RAW, CODEC_ZLIB, CODEC_LZ4) and (shape is None or dtype is None):
+                    raise ConnectionError(f"Array codec {codec} without array geometry")
+                if codec == CODEC_RAW and int(np.prod(shape)) * dtype.itemsize != length:
+                    raise ConnectionError(f"Raw image header does not match payload ({dtype_code}, {shape}, {length})")
+                images.append(ReceivedImage(self._recv_payload(length), codec, timestamp, shape, dtype))
+        except Exception:
+            for image in images:
+                image.release()
+            raise
+        return StereoFrame(version, seq, flags, images[0], images[1] if count > 1 else None)
+
+    def receive_frame(self):
+        """Receive one stereo pair into pooled buffers.
+        Understands protocol v2 (detected by its magic) and v1 framing. Returns a
+        StereoFrame; call its release() (or use it as a context manager) once the
+        images have been decoded.
+        """
+        self._recv_into(memoryview(self._header)[:4])
+        # timed from the first header bytes, so waiting for the sender is not counted
+        with stage("receive") as timer:
+            if bytes(self._header[:4]) == PROTOCOL_MAGIC:
+                frame = self._receive_v2()
+            else:
+                frame = self._receive_v1()
+            if frame.seq is not None:
+                set_frame(frame.seq)
+            timer.add_bytes(sum(memoryview(image.payload).nbytes for image in (frame.left, frame.right) if image))
+        if self.save_images and frame.left.codec in (CODEC_JPEG, CODEC_PNG, CODEC_ENCODED):
+            self._save_received(frame.left.payload, frame.right.payload if frame.right else b'')
+        return frame
 
     def connect(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -171,28 +754,23 @@ class ImageClient:
     
     #receive 2 images
     def receive_images(self):
-            # Receive left image indicator
-        indicator_data = self._recv_all(4)
-        indicator = struct.unpack('>I', indicator_data)[0]
-        if indicator != 0:
-            print("Expected left image indicator, got:", indicator)
-        # Receive left image
-        length_data = self._recv_all(4)
-        length = struct.unpack('>I', length_data)[0]
-        left_image_bytes = self._recv_all(length)
-        print(f"Received left image of length {length} bytes")
-
-        # Receive right image indicator
-        indicator_data = self._recv_all(4)
-        indicator = struct.unpack('>I', indicator_data)[0]
-        if indicator != 1:
-            print("Expected right image indicator, got:", indicator)
-        # Receive right image
-        length_data = self._recv_all(4)
-        length = struct.unpack('>I', length_data)[0]
-        right_image_bytes = self._recv_all(length)
-        print(f"Received right image of length {length} bytes")
-        
+        """Receive a stereo pair and return the two payloads as bytes."""
+        with self.receive_frame() as frame:
+            left_image_bytes = bytes(frame.left.payload)
+            right_image_bytes = bytes(frame.right.payload) if frame.right else None
+        print(f"Received images of length {len(left_image_bytes)} and "
+              f"{len(right_image_bytes) if right_image_bytes is not None else 0} bytes")
+        return left_image_bytes, right_image_bytes
+
+    def receive_images_pooled(self):
+        """Receive a stereo pair directly into pooled buffers.
+        Returns (left, right) PooledBuffer objects; use .array for the payload and
+        call .release() on both once they have been decoded.
+        """
+        frame = self.receive_frame()
+        return frame.left.buffer, frame.right.buffer if frame.right else None
+
+    def _save_received(self, left_image_bytes, right_image_bytes):
         try:    
             if self.save_images:
                 timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -205,12 +783,15 @@ class ImageClient:
                 print(f"Saved images as {left_filename} and {right_filename}")
         except Exception as e:
             print("Error saving images:", e)
-            
-        return left_image_bytes, right_image_bytes
         
     def disconnect(self):
         try:
             if self.sock:
+                # shutdown wakes a recv blocked on another thread; close alone may not
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
                 self.sock.close()
                 self.connected = False
         except Exception:
@@ -0,0 +1,242 @@
+import bisect
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+#Instrumentation is off unless enabled here or with STEREO_METRICS=1; when off, stage()
+#returns a shared no-op context manager and observe() returns immediately
+_enabled = os.environ.get("STEREO_METRICS", "") not in ("", "0")
+
+#Histogram bucket upper bounds
+DURATION_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 10000)
+BYTE_BUCKETS = tuple(1 << shift for shift in range(10, 28, 2))  # 1 KiB .. 128 MiB
+TRACE_FRAMES = 64  # per-frame spans kept for the most recent frame sequence ids
+
+_local = threading.local()
+
+
+def enable(on=True):
+    global _enabled
+    _enabled = on
+
+
+def enabled():
+    return _enabled
+
+
+def set_frame(seq):
+    """
+    Tag everything this thread records from now on with frame sequence id seq.
+    """
+    _local.seq = seq
+
+
+def current_frame():
+    return getattr(_local, "seq", None)
+
+
+class Histogram:
+    def __init__(self, name, buckets):
+        self.name = name
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding quantile q (the max for the +Inf bucket).
+        """
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (self.max,), self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        with self._lock:
+            return {"count": self.count, "sum": self.sum, "max": self.max,
+                    "mean": self.sum / self.count if self.count else 0.0,
+                    "p50": self.quantile(0.5), "p99": self.quantile(0.99),
+                    "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], self.counts))}
+
+
+class MetricsRegistry:
+    """
+    Named histograms plus the stage spans of the last TRACE_FRAMES frame sequence ids.
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.traces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def histogram(self, name, buckets=DURATION_BUCKETS_MS):
+        hist = self.histograms.get(name)
+        if hist is None:
+            with self._lock:
+                hist = self.histograms.setdefault(name, Histogram(name, buckets))
+        return hist
+
+    def record_span(self, seq, name, start_ns, duration_ms):
+        with self._lock:
+            spans = self.traces.get(seq)
+            if spans is None:
+                spans = self.traces[seq] = []
+                if len(self.traces) > TRACE_FRAMES:
+                    self.traces.popitem(last=False)
+            spans.append((name, start_ns, duration_ms))
+
+    def frame_trace(self, seq):
+        """
+        [(stage, start time ns, duration ms), ...] recorded for frame seq, in start order.
+        """
+        with self._lock:
+            return sorted(self.traces.get(seq, ()), key=lambda span: span[1])
+
+    def snapshot(self):
+        with self._lock:
+            names = list(self.histograms)
+            traces = {str(seq): list(spans) for seq, spans in self.traces.items()}
+        return {"time": time.time(), "histograms": {name: self.histograms[name].snapshot() for name in names},
+                "traces": traces}
+
+    def prometheus_text(self, prefix="stereo_"):
+        lines = []
+        for name, hist in sorted(self.histograms.items()):
+            metric = prefix + name
+            snap = hist.snapshot()
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in snap["buckets"].items():
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{metric}_sum {snap['sum']}")
+            lines.append(f"{metric}_count {snap['count']}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+
+class _NoopStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add_bytes(self, nbytes):
+        pass
+
+
+_NOOP = _NoopStage()
+
+
+class _Stage:
+    __slots__ = ("name", "nbytes", "_start")
+
+    def __init__(self, name, nbytes):
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def add_bytes(self, nbytes):
+        self.nbytes = (self.nbytes or 0) + nbytes
+
+    def __exit__(self, *exc):
+        duration_ms = (time.perf_counter_ns() - self._start) / 1e6
+        METRICS.histogram(self.name + "_ms").observe(duration_ms)
+        if self.nbytes is not None:
+            METRICS.histogram(self.name + "_bytes", BYTE_BUCKETS).observe(self.nbytes)
+        seq = current_frame()
+        if seq is not None:
+            METRICS.record_span(seq, self.name, self._start, duration_ms)
+        return False
+
+
+def stage(name, nbytes=None):
+    """
+    Context manager timing one pipeline stage into the <name>_ms histogram (and <name>_bytes
+    if nbytes is given or added with add_bytes()), tagged with the thread's current frame.
+    """
+    if not _enabled:
+        return _NOOP
+    return _Stage(name, nbytes)
+
+
+def observe(name, value, buckets=DURATION_BUCKETS_MS):
+    """
+    Record a single value (e.g. a skew or queue depth) into histogram name.
+    """
+    if _enabled:
+        METRICS.histogram(name, buckets).observe(value)
+
+
+class MetricsExporter:
+    """
+    Writes a snapshot of METRICS to path every interval seconds, as JSON or Prometheus
+    text exposition format (for node_exporter's textfile collector). Files are replaced
+    atomically so readers never see a partial snapshot.
+    """
+    def __init__(self, path="stereo_metrics.json", interval=5.0, fmt=None):
+        self.path = path
+        self.interval = interval
+        self.fmt = fmt or ("prometheus" if path.endswith(".prom") else "json")
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            if self.fmt == "prometheus":
+                f.write(METRICS.prometheus_text())
+            else:
+                json.dump(METRICS.snapshot(), f)
+        os.replace(tmp_path, self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                print("Failed to export metrics:", e)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="metrics-exporter", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+        self.write()
+
+
+def start_exporter(path="stereo_metrics.json", interval=5.0, fmt=None):
+    """
+    Enable instrumentation and start a background exporter; returns it (call stop() to flush).
+    """
+    enable(True)
+    return MetricsExporter(path, interval, fmt).start()
@@ -0,0 +1,175 @@
+import queue
+import threading
+import time
+
+from instrumentation import set_frame
+
+#What a stage does when the queue to the next stage is full:
+#  block       - wait for space (nothing is dropped, upstream slows down)
+#  drop_oldest - discard the stalest queued frame so downstream always gets the newest
+#  drop_newest - discard the frame that was just produced
+DROP_POLICIES = ("block", "drop_oldest", "drop_newest")
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy_time = 0.0
+
+    def as_dict(self):
+        mean_ms = self.busy_time * 1000.0 / self.processed if self.processed else 0.0
+        return {"stage": self.name, "processed": self.processed, "dropped": self.dropped,
+                "errors": self.errors, "mean_ms": mean_ms}
+
+
+class StreamingPipeline:
+    """
+    Runs a frame source and a chain of processing stages, each on its own thread,
+    connected by bounded queues. Frames are dicts that each stage updates and returns
+    (return None to discard a frame). Because stages overlap, steady-state throughput
+    is set by the slowest stage rather than the sum of all stages.
+
+    source: callable returning the next frame dict (raising stops the pipeline)
+    stages: list of (name, callable) applied in order
+    on_drop: callable given every frame the pipeline discards (dropped by the policy, failed
+             in a stage or still queued at stop) so it can return pooled buffers it holds
+    """
+    def __init__(self, source, stages, queue_size=2, drop_policy="drop_oldest", on_drop=None):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy: {drop_policy}")
+        self.source = source
+        self.stages = list(stages)
+        self.drop_policy = drop_policy
+        self.on_drop = on_drop
+        #queues[i] feeds stage i; the last queue holds finished frames for get()
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(len(self.stages) + 1)]
+        self.stats = [StageStats("source")] + [StageStats(name) for name, _ in self.stages]
+        self._stop = threading.Event()
+        self._threads = []
+        self._seq = 0
+        self._started = None
+        self._delivered = 0
+        self.error = None
+
+    @property
+    def running(self):
+        return bool(self._threads) and not self._stop.is_set()
+
+    def start(self):
+        self._stop.clear()
+        self._started = time.perf_counter()
+        self._threads = [threading.Thread(target=self._source_loop, name="pipeline-source", daemon=True)]
+        for index, (name, func) in enumerate(self.stages):
+            self._threads.append(threading.Thread(target=self._stage_loop, args=(index, func),
+                                                  name=f"pipeline-{name}", daemon=True))
+        for t in self._threads:
+            t.start()
+
+    def stop(self):
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout=2)
+        self._threads = []
+        for q in self.queues:
+            while True:
+                try:
+                    self._discard(q.get_nowait())
+                except queue.Empty:
+                    break
+
+    def _discard(self, frame):
+        if self.on_drop is not None:
+            self.on_drop(frame)
+
+    def _put(self, q, frame, stats):
+        """
+        Hand a frame to the next queue according to the drop policy.
+        """
+        while not self._stop.is_set():
+            if self.drop_policy == "block":
+                try:
+                    q.put(frame, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+            try:
+                q.put_nowait(frame)
+                return
+            except queue.Full:
+                stats.dropped += 1
+                if self.drop_policy == "drop_newest":
+                    self._discard(frame)
+                    return
+                try:
+                    self._discard(q.get_nowait())
+                except queue.Empty:
+                    pass
+        # stopped before the frame could be queued
+        self._discard(frame)
+
+    def _source_loop(self):
+        stats = self.stats[0]
+        while not self._stop.is_set():
+            start = time.perf_counter()
+            try:
+                frame = self.source()
+            except Exception as e:
+                print("Pipeline source stopped:", e)
+                self.error = e
+                self._stop.set()
+                break
+            stats.busy_time += time.perf_counter() - start
+            if frame is None:
+                continue
+            stats.processed += 1
+            frame.setdefault("seq", self._seq)
+            self._seq += 1
+            self._put(self.queues[0], frame, stats)
+
+    def _stage_loop(self, index, func):
+        stats = self.stats[index + 1]
+        q_in, q_out = self.queues[index], self.queues[index + 1]
+        while not self._stop.is_set():
+            try:
+                frame = q_in.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            start = time.perf_counter()
+            set_frame(frame.get("seq"))
+            try:
+                frame = func(frame)
+            except Exception as e:
+                stats.errors += 1
+                print(f"Pipeline stage {stats.name} failed on frame:", e)
+                self._discard(frame)
+                continue
+            stats.busy_time += time.perf_counter() - start
+            if frame is None:
+                continue
+            stats.processed += 1
+            self._put(q_out, frame, stats)
+
+    def get(self, timeout=None):
+        """
+        Next finished frame, or None if none arrived within timeout.
+        """
+        try:
+            frame = self.queues[-1].get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self._delivered += 1
+        return frame
+
+    def report(self):
+        """
+        Per-stage counters and mean processing time plus delivered frame rate.
+        """
+        elapsed = time.perf_counter() - self._started if self._started else 0.0
+        return {
+            "stages": [s.as_dict() for s in self.stats],
+            "delivered": self._delivered,
+            "fps": self._delivered / elapsed if elapsed > 0 else 0.0,
+        }
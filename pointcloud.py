@@ -0,0 +1,193 @@
+import sys
+
+import numpy as np
+
+#Binary little-endian PLY vertex layouts
+POINT_DTYPE = np.dtype([("x", "<f4"), ("y", "<f4"), ("z", "<f4")])
+COLOR_POINT_DTYPE = np.dtype([("x", "<f4"), ("y", "<f4"), ("z", "<f4"),
+                              ("red", "u1"), ("green", "u1"), ("blue", "u1")])
+
+#The vertex count is unknown until the last chunk is written, so the header holds a
+#fixed-width placeholder that is patched in place on close
+_COUNT_WIDTH = 12
+
+#Voxel keys pack three signed 21-bit grid coordinates into one int64
+_KEY_BITS = 21
+_KEY_OFFSET = 1 << (_KEY_BITS - 1)
+
+
+def iter_points(disparity, Q, color=None, band_rows=64, min_disparity=0.0, max_depth=None):
+    """
+    Yield the valid 3D points of a disparity map band by band as structured arrays
+    (POINT_DTYPE, or COLOR_POINT_DTYPE when color is given), so no full HxWx3 point
+    image is ever built.
+    disparity: float disparity in px, or int16 SGBM fixed point
+    Q: 4x4 reprojection matrix from stereoRectify (possibly adjusted for crop/scale)
+    color: rectified left image (BGR or grayscale) aligned with the disparity
+    min_disparity: disparities at or below this are skipped (SGBM marks invalid as min_disp - 1)
+    """
+    scale = 1.0 / 16.0 if disparity.dtype == np.int16 else 1.0
+    height, width = disparity.shape
+    xs = np.arange(width, dtype=np.float32) * np.float32(Q[0,0]) + np.float32(Q[0,3])
+    dtype = POINT_DTYPE if color is None else COLOR_POINT_DTYPE
+    for row in range(0, height, band_rows):
+        band = disparity[row:row + band_rows]
+        w = band.astype(np.float32) * np.float32(Q[3,2] * scale) + np.float32(Q[3,3])
+        valid = (band * scale > min_disparity) & (w > 0)
+        z = np.float32(Q[2,3]) / w[valid]
+        if max_depth is not None:
+            near = z <= max_depth
+            valid[valid] = near
+            z = z[near]
+        rows, cols = np.nonzero(valid)
+        points = np.empty(z.size, dtype)
+        w = w[valid]
+        points["x"] = xs[cols] / w
+        points["y"] = ((rows + row).astype(np.float32) * np.float32(Q[1,1]) + np.float32(Q[1,3])) / w
+        points["z"] = z
+        if color is not None:
+            pixels = color[row:row + band_rows][valid]
+            if pixels.ndim == 1:
+                points["red"] = points["green"] = points["blue"] = pixels
+            else:
+                points["blue"], points["green"], points["red"] = pixels[:, 0], pixels[:, 1], pixels[:, 2]
+        yield points
+
+
+class PointCloudWriter:
+    """
+    Streams points to a binary PLY file chunk by chunk; use as a context manager.
+    """
+    def __init__(self, path, with_color=True):
+        self.path = path
+        self.dtype = COLOR_POINT_DTYPE if with_color else POINT_DTYPE
+        self.count = 0
+        self._file = open(path, "wb")
+        header = ["ply", "format binary_little_endian 1.0", "element vertex "]
+        self._file.write("\n".join(header).encode("ascii"))
+        self._count_offset = self._file.tell()
+        properties = [f"property {'float' if field.kind == 'f' else 'uchar'} {name}"
+                      for name, (field, _) in self.dtype.fields.items()]
+        self._file.write(("0" * _COUNT_WIDTH + "\n" + "\n".join(properties) + "\nend_header\n").encode("ascii"))
+
+    def write(self, points):
+        if points.dtype != self.dtype:
+            raise ValueError(f"Expected points of dtype {self.dtype}, got {points.dtype}")
+        self._file.write(memoryview(np.ascontiguousarray(points)).cast("B"))
+        self.count += points.size
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.seek(self._count_offset)
+        self._file.write(str(self.count).rjust(_COUNT_WIDTH, "0").encode("ascii"))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class VoxelGrid:
+    """
+    Vectorized voxel-grid downsampler: every occupied voxel becomes the mean of its points
+    (and colours). Points can be added in chunks; each chunk is reduced to per-voxel sums
+    straight away, so memory follows the number of occupied voxels, not the number of points.
+    """
+    def __init__(self, voxel_size, with_color=True):
+        self.voxel_size = float(voxel_size)
+        self.dtype = COLOR_POINT_DTYPE if with_color else POINT_DTYPE
+        self._fields = list(self.dtype.names)
+        self._partials = []
+
+    def _keys(self, points):
+        grid = np.empty((points.size, 3), np.int64)
+        for axis, name in enumerate(("x", "y", "z")):
+            grid[:, axis] = np.floor(points[name] / self.voxel_size)
+        if grid.size and (grid.min() < -_KEY_OFFSET or grid.max() >= _KEY_OFFSET):
+            raise ValueError("Point cloud extent too large for this voxel size; limit it with max_depth")
+        grid += _KEY_OFFSET
+        return (grid[:, 0] << (2 * _KEY_BITS)) | (grid[:, 1] << _KEY_BITS) | grid[:, 2]
+
+    @staticmethod
+    def _reduce(keys, columns, counts):
+        unique, inverse = np.unique(keys, return_inverse=True)
+        sums = [np.bincount(inverse, weights=column, minlength=unique.size) for column in columns]
+        return unique, sums, np.bincount(inverse, weights=counts, minlength=unique.size)
+
+    def add(self, points):
+        if points.size == 0:
+            return
+        columns = [points[name].astype(np.float64) for name in self._fields]
+        self._partials.append(self._reduce(self._keys(points), columns, np.ones(points.size)))
+
+    def result(self):
+        """
+        The downsampled cloud as a structured array of self.dtype.
+        """
+        if not self._partials:
+            return np.empty(0, self.dtype)
+        keys = np.concatenate([partial[0] for partial in self._partials])
+        columns = [np.concatenate([partial[1][i] for partial in self._partials]) for i in range(len(self._fields))]
+        counts = np.concatenate([partial[2] for partial in self._partials])
+        self._partials = []
+        unique, sums, counts = self._reduce(keys, columns, counts)
+        self._partials.append((unique, sums, counts))
+        points = np.empty(unique.size, self.dtype)
+        for name, total in zip(self._fields, sums):
+            mean = total / counts
+            points[name] = np.rint(mean) if self.dtype[name].kind == "u" else mean
+        return points
+
+
+def voxel_downsample(points, voxel_size):
+    """
+    Downsample a structured point array (POINT_DTYPE or COLOR_POINT_DTYPE) to one point per voxel.
+    """
+    grid = VoxelGrid(voxel_size, with_color=points.dtype == COLOR_POINT_DTYPE)
+    grid.add(points)
+    return grid.result()
+
+
+def write_ply(path, disparity, Q, color=None, voxel_size=None, band_rows=64, min_disparity=0.0, max_depth=None):
+    """
+    Export the valid points of a disparity map to a binary PLY file, streaming band by band
+    (or through a VoxelGrid when voxel_size is set). Returns the number of points written.
+    """
+    points = iter_points(disparity, Q, color, band_rows, min_disparity, max_depth)
+    with PointCloudWriter(path, with_color=color is not None) as writer:
+        if voxel_size is None:
+            for chunk in points:
+                writer.write(chunk)
+        else:
+            grid = VoxelGrid(voxel_size, with_color=color is not None)
+            for chunk in points:
+                grid.add(chunk)
+            writer.write(grid.result())
+    return writer.count
+
+
+def read_ply(path):
+    """
+    Read a binary PLY written by PointCloudWriter back into a structured array.
+    """
+    with open(path, "rb") as f:
+        header = []
+        while not header or header[-1] != "end_header":
+            header.append(f.readline().decode("ascii").strip())
+        count = int(next(line for line in header if line.startswith("element vertex")).split()[-1])
+        dtype = COLOR_POINT_DTYPE if any(line.endswith(" red") for line in header) else POINT_DTYPE
+        return np.fromfile(f, dtype, count)
+
+
+if __name__ == "__main__":
+    #Usage: python pointcloud.py disparity.npy Q.npy out.ply [left.png] [voxel_size]
+    import cv2
+    disparity = np.load(sys.argv[1])
+    Q = np.load(sys.argv[2])
+    color = cv2.imread(sys.argv[4]) if len(sys.argv) > 4 else None
+    voxel_size = float(sys.argv[5]) if len(sys.argv) > 5 else None
+    count = write_ply(sys.argv[3], disparity, Q, color, voxel_size)
+    print(f"Wrote {count} points to {sys.argv[3]}")
@@ -0,0 +1,295 @@
+import glob
+import os
+import sys
+import threading
+import time
+
+import cv2
+
+from encoding import SoftwareH264Encoder
+from image_transfer import StereoVideoStreamer
+
+#Replay pacing modes:
+#  fixed - one pair every 1/fps seconds (a camera at that frame rate)
+#  max   - pairs as fast as the consumer takes them (maximum sustainable throughput)
+#  burst - burst_size pairs back to back, then a pause of burst_interval seconds (backpressure)
+RATE_MODES = ("fixed", "max", "burst")
+
+
+class ReplayRequest:
+    """
+    Stand-in for a Picamera2 CompletedRequest holding one stored frame.
+    """
+    def __init__(self, array, timestamp_ns, frame_duration_us):
+        self._array = array
+        self._metadata = {"SensorTimestamp": timestamp_ns, "FrameDuration": frame_duration_us}
+        self.released = False
+
+    def make_array(self, name="main"):
+        # Picamera2 copies out of the camera buffer; do the same so the copy cost is measured
+        return self._array.copy()
+
+    def get_metadata(self):
+        return dict(self._metadata)
+
+    def release(self):
+        self.released = True
+
+
+def load_pairs(source, max_frames=None, size=None):
+    """
+    Load stereo pairs into memory from:
+      - a list of (left, right) arrays or image paths
+      - a directory with left_*/right_* (or L*/R*) images, matched in sorted order
+      - a (left_video, right_video) tuple of video files
+    size: optional (w, h) to resize every frame to
+    """
+    if isinstance(source, str) and os.path.isdir(source):
+        for left_glob, right_glob in (("left_*", "right_*"), ("L*", "R*")):
+            lefts = sorted(glob.glob(os.path.join(source, left_glob)))
+            rights = sorted(glob.glob(os.path.join(source, right_glob)))
+            if lefts and len(lefts) == len(rights):
+                source = list(zip(lefts, rights))
+                break
+        else:
+            raise FileNotFoundError(f"No left_*/right_* image pairs in {source}")
+    elif isinstance(source, tuple) and all(isinstance(s, str) for s in source):
+        capL, capR = cv2.VideoCapture(source[0]), cv2.VideoCapture(source[1])
+        pairs = []
+        while max_frames is None or len(pairs) < max_frames:
+            okL, left = capL.read()
+            okR, right = capR.read()
+            if not (okL and okR):
+                break
+            pairs.append((left, right))
+        capL.release()
+        capR.release()
+        source = pairs
+
+    pairs = []
+    for left, right in source[:max_frames]:
+        if isinstance(left, str):
+            left_path, right_path = left, right
+            left, right = cv2.imread(left_path), cv2.imread(right_path)
+            if left is None or right is None:
+                raise FileNotFoundError(f"Could not read pair {left_path} / {right_path}")
+        if size is not None:
+            left, right = cv2.resize(left, size), cv2.resize(right, size)
+        pairs.append((left, right))
+    if not pairs:
+        raise ValueError("No stereo pairs to replay")
+    return pairs
+
+
+class ReplayStereoAcquisition:
+    """
+    Drop-in replacement for StereoCameraAcquisition that replays stored stereo pairs with
+    synthetic sensor timestamps (one frame period apart, right eye offset by skew_ns), so the
+    server, network and client paths can be load-tested without cameras.
+    """
+    def __init__(self, source, rate="fixed", fps=30, burst_size=8, burst_interval=1.0, loop=True,
+                 skew_ns=0, max_frames=None, size=None):
+        if rate not in RATE_MODES:
+            raise ValueError(f"Unknown rate mode: {rate}")
+        self.pairs = load_pairs(source, max_frames, size)
+        self.rate = rate
+        self.framerate = fps
+        self.burst_size = burst_size
+        self.burst_interval = burst_interval
+        self.loop = loop
+        self.skew_ns = skew_ns
+        self.frame_period_ns = 1_000_000_000 // fps
+        self.frames_delivered = 0
+        self._index = 0
+        self._frame_seq = 0
+        self._started = None
+        self._next_time = None
+        self._clock_ns = 0
+        self._started_ns = 0
+        self._recording_stop = threading.Event()
+
+    #Camera lifecycle: nothing to configure, only the pacing clock is (re)started
+    def configure_cameras(self, mode="still"):
+        pass
+
+    def start(self, mode="still"):
+        self._started = time.perf_counter()
+        self._next_time = self._started
+        self._clock_ns = self._started_ns = time.monotonic_ns()
+
+    def initialize_cameras(self, mode="still"):
+        self.start()
+
+    def stop(self):
+        pass
+
+    def display_preview(self):
+        pass
+
+    def stop_preview(self):
+        pass
+
+    def _wait_for_next(self):
+        if self._started is None:
+            self.start()
+        if self.rate == "max":
+            self._clock_ns = max(self._clock_ns + self.frame_period_ns, time.monotonic_ns())
+            return
+        if self.rate == "burst" and self.frames_delivered and self.frames_delivered % self.burst_size == 0:
+            self._next_time = time.perf_counter() + self.burst_interval
+            # the pause shows up in the sensor timestamps like a real gap between frames
+            self._clock_ns += int(self.burst_interval * 1e9)
+        delay = self._next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        if self.rate == "fixed":
+            self._next_time += 1.0 / self.framerate
+        self._clock_ns += self.frame_period_ns
+
+    def _next_pair(self):
+        if self._index >= len(self.pairs):
+            if not self.loop:
+                raise EOFError("Replay source exhausted")
+            self._index = 0
+        pair = self.pairs[self._index]
+        self._index += 1
+        return pair
+
+    def capture_stereo_image(self, left_filename="left_image.jpg", right_filename="right_image.jpg",
+                             max_skew_ns=None, max_retries=3):
+        """
+        Next stored pair as (reqL, reqR, info) paced by the rate mode, like
+        StereoCameraAcquisition.capture_stereo_image.
+        """
+        start = time.perf_counter()
+        self._wait_for_next()
+        left, right = self._next_pair()
+        seq = self._frame_seq
+        self._frame_seq += 1
+        self.frames_delivered += 1
+        frame_duration_us = self.frame_period_ns // 1000
+        reqL = ReplayRequest(left, self._clock_ns, frame_duration_us)
+        reqR = ReplayRequest(right, self._clock_ns - self.skew_ns, frame_duration_us)
+        info = {"seq": seq, "skew_ns": self.skew_ns, "latency_ms": (time.perf_counter() - start) * 1000.0,
+                "attempts": 1}
+        return reqL, reqR, info
+
+    #Continuous mode: every call paces and returns the next pair
+    def start_continuous(self, ring_size=4, max_skew_ns=2_000_000, stream="main"):
+        self.start()
+
+    def get_latest_pair(self, timeout=1.0, copy=True, newer_than=None):
+        reqL, reqR, info = self.capture_stereo_image()
+        info.update(left_timestamp=reqL.get_metadata()["SensorTimestamp"],
+                    right_timestamp=reqR.get_metadata()["SensorTimestamp"],
+                    left_seq=info["seq"], right_seq=info["seq"])
+        return reqL.make_array() if copy else reqL._array, reqR.make_array() if copy else reqR._array, info
+
+    def skew_stats(self):
+        skew_us = abs(self.skew_ns) / 1000.0
+        return {"pairs": self.frames_delivered, "unmatched_frames": 0, "mean_skew_us": skew_us,
+                "p99_skew_us": skew_us, "max_skew_us": skew_us}
+
+    def stop_continuous(self):
+        pass
+
+    def capture_video(self, left_filename="left_video.h264", right_filename="right_video.h264", duration=10,
+                      server=None):
+        """
+        Replay the stored pairs as stereo H.264 video, paced by the rate mode, like
+        StereoCameraAcquisition.capture_video: without a server the streams and pts files are
+        written, with one the pairs go through a StereoVideoStreamer. Each eye is encoded in
+        software (SoftwareH264Encoder, needs the av package) instead of by the Pi's encoders.
+        duration=None replays until stop_recording() (or the end of the source when loop=False).
+        """
+        self._recording_stop.clear()
+        height, width = self.pairs[0][0].shape[:2]
+        encoders = (SoftwareH264Encoder(width, height, self.framerate),
+                    SoftwareH264Encoder(width, height, self.framerate))
+        streamer = files = None
+        if server is None:
+            files = [open(left_filename, "wb"), open(right_filename, "wb"),
+                     open(os.path.splitext(left_filename)[0] + ".pts", "w"),
+                     open(os.path.splitext(right_filename)[0] + ".pts", "w")]
+            for pts_file in files[2:]:
+                pts_file.write("# timecode format v2\n")
+        else:
+            streamer = StereoVideoStreamer(server, self.frame_period_ns,
+                                           on_keyframe_needed=lambda: [e.request_keyframe() for e in encoders])
+
+        self.start()
+        end = None if duration is None else time.perf_counter() + duration
+        try:
+            while not self._recording_stop.is_set() and (end is None or time.perf_counter() < end):
+                self._wait_for_next()
+                try:
+                    pair = self._next_pair()
+                except EOFError:
+                    break
+                self.frames_delivered += 1
+                timestamps_ns = (self._clock_ns, self._clock_ns - self.skew_ns)
+                for side, (encoder, image, timestamp_ns) in enumerate(zip(encoders, pair, timestamps_ns)):
+                    for payload, keyframe in encoder.encode(image):
+                        if streamer is not None:
+                            streamer.push(side, payload, keyframe, timestamp_ns // 1000)
+                        else:
+                            files[side].write(payload)
+                            files[side + 2].write(f"{(timestamp_ns - self._started_ns) / 1e6:.3f}\n")
+        finally:
+            if streamer is not None:
+                streamer.close()
+            for f in files or ():
+                f.close()
+        if streamer is None:
+            print(f"Replayed stereo videos: {left_filename}, {right_filename}")
+        else:
+            print(f"Streamed {streamer.sent} replayed stereo video frames ({streamer.dropped} dropped)")
+
+    def stop_recording(self):
+        self._recording_stop.set()
+
+    def achieved_fps(self):
+        elapsed = time.perf_counter() - self._started if self._started else 0.0
+        return self.frames_delivered / elapsed if elapsed > 0 else 0.0
+
+
+def load_test(source=None, rate="max", fps=30, duration=10.0, codec="jpeg", port=8090, queue_size=2,
+              drop_policy="drop_oldest", size=(1280, 720)):
+    """
+    Run RaspberryPiStereoSystem on a replay source and a StereoClientDevice pipeline over
+    localhost for duration seconds, and report what each side sustained.
+    source=None replays synthetic textured pairs from benchmark.py.
+    """
+    from client import StereoClientDevice
+    from rpi import RaspberryPiStereoSystem
+
+    if source is None:
+        from benchmark import synthetic_pair
+        source = []
+        for index, scene in enumerate(("plane", "slant", "steps")):
+            left, right, _, _ = synthetic_pair(size[0], size[1], scene, seed=index)
+            source.append((cv2.cvtColor(left, cv2.COLOR_GRAY2BGR), cv2.cvtColor(right, cv2.COLOR_GRAY2BGR)))
+    acquisition = ReplayStereoAcquisition(source, rate=rate, fps=fps, size=size)
+    pi = RaspberryPiStereoSystem(host="127.0.0.1", port=port, codec=codec, acquisition=acquisition)
+    pi_thread = threading.Thread(target=pi.run, daemon=True)
+    pi_thread.start()
+    time.sleep(0.5)
+
+    device = StereoClientDevice("127.0.0.1", port)
+    report = device.run_pipeline(queue_size=queue_size, drop_policy=drop_policy, display=False, duration=duration)
+    pi.running = False
+    pi_thread.join(timeout=5)
+    report["source_fps"] = acquisition.achieved_fps()
+    report["source_frames"] = acquisition.frames_delivered
+    print(f"Replay {rate}: source {report['source_fps']:.1f} fps ({report['source_frames']} pairs), "
+          f"client delivered {report['fps']:.1f} fps")
+    return report
+
+
+if __name__ == "__main__":
+    #Usage: python replay_acquisition.py [fixed|max|burst] [seconds] [codec] [source dir]
+    rate = sys.argv[1] if len(sys.argv) > 1 else "max"
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10.0
+    codec = sys.argv[3] if len(sys.argv) > 3 else "jpeg"
+    source = sys.argv[4] if len(sys.argv) > 4 else None
+    load_test(source, rate=rate, duration=duration, codec=codec)
@@ -1,53 +1,242 @@
-from image_transfer import ImageServerHost
-from acquisition import StereoCameraAcquisition
+import os
+import queue
+import threading
+import time
+
+from encoding import (CODEC_LZ4, CODEC_ZLIB, FILE_EXTENSIONS, EncodedImage, FrameEncoder,
+                      lz4_frame, pack_disparity)
+from image_transfer import FLAG_DISPARITY, FLAG_RECTIFIED, AsyncImageServerHost, ImageServerHost
+from stereo_class import StereoSystem
+from instrumentation import set_frame, stage
 
 
 class RaspberryPiStereoSystem:
-    def __init__(self):
+    #multi_client: serve any number of clients with the asyncio server instead of a single client
+    #codec: "jpeg", "png", "raw", "zlib" or "lz4"; encoding runs on encode_workers threads
+    #trigger: callable returning True when a pair should be captured (e.g. a UI button); None streams continuously
+    #while a client is connected. Only triggered pairs and snapshot() requests are saved locally when
+    #they can't be sent; streamed pairs are dropped instead (counted in frames_dropped)
+    #rectify_on_device: rectify with the saved calibration bundle and send grayscale pairs at output_scale
+    #acquisition: camera source with the StereoCameraAcquisition interface (e.g. a
+    #ReplayStereoAcquisition for load tests); defaults to the Picamera2 cameras
+    #edge_depth: rectify and compute disparity here at depth_scale and send a lossless int16 fixed-point
+    #disparity map plus a packed validity mask instead of the images (see edge_stats for FPS/CPU)
+    def __init__(self, host='192.168.1.100', port=8080, multi_client=False,
+                 codec="jpeg", quality=90, encode_workers=2, trigger=None,
+                 rectify_on_device=False, output_scale=1.0, calibration_dir="calibration_cache",
+                 edge_depth=False, depth_scale=0.5, disparity_mode="tiled", stats_interval=5.0,
+                 acquisition=None):
         self.running = False
 
         # bind to a local IP address reachable on your network
-        self.server = ImageServerHost(host='192.168.1.100', port=8080)
-        self.stereo_system = StereoCameraAcquisition()
+        if multi_client:
+            self.server = AsyncImageServerHost(host=host, port=port)
+        else:
+            self.server = ImageServerHost(host=host, port=port)
+        if acquisition is None:
+            # imported here so the rest of the system runs on machines without picamera2
+            from acquisition import StereoCameraAcquisition
+            acquisition = StereoCameraAcquisition()
+        self.stereo_system = acquisition
+
+        self.encoder = FrameEncoder(codec, quality=quality, workers=encode_workers)
+        self.trigger = trigger
+        self._snapshot = threading.Event()
+        self.frames_dropped = 0
+        # bounds how many captured pairs may wait for encoding/sending
+        self._send_queue = queue.Queue(maxsize=max(1, encode_workers))
+        self._sender_thread = None
+
+        self.stereo = None
+        self.send_flags = 0
+        self.edge_depth = edge_depth
+        if rectify_on_device or edge_depth:
+            self.stereo = StereoSystem(disparity_mode=disparity_mode if edge_depth else "single")
+            self.stereo.load_rectification(calibration_dir)
+            # rectified frames stay referenced while queued, encoded and (for raw codecs) queued for sending
+            in_flight = self._send_queue.maxsize + 2 + (self.server.queue_size if multi_client else 1)
+            self.stereo.configure_rectification(grayscale=True, scale=depth_scale if edge_depth else output_scale,
+                                                parallel=True, buffer_count=in_flight + 1)
+            self.send_flags = FLAG_RECTIFIED
+        if edge_depth:
+            self.send_flags |= FLAG_DISPARITY
+            # disparity must arrive bit-exact, so only lossless codecs are used
+            self.depth_codec = CODEC_LZ4 if lz4_frame is not None else CODEC_ZLIB
 
-    def save_images_locally(self, left_bytes, right_bytes, left_filename="left_image.jpg", right_filename="right_image.jpg"):
+        # edge_stats: fps, cpu_percent (process CPU time / wall time, can exceed 100 with threads),
+        # load average, SoC temperature and mean per-stage ms over the last stats_interval seconds
+        self.stats_interval = stats_interval
+        self.edge_stats = {}
+        self._stage_ms = {}
+        self._frames = 0
+        self._stats_wall = time.perf_counter()
+        self._stats_cpu = time.process_time()
+
+    def save_images_locally(self, left_bytes, right_bytes, left_filename=None, right_filename=None):
+        ext = FILE_EXTENSIONS.get(left_bytes.codec, ".raw") if isinstance(left_bytes, EncodedImage) else ".jpg"
+        left_filename = left_filename or f"left_image{ext}"
+        right_filename = right_filename or f"right_image{ext}"
         with open(left_filename, 'wb') as fL:
-            fL.write(left_bytes)
+            fL.write(left_bytes.payload if isinstance(left_bytes, EncodedImage) else left_bytes)
         with open(right_filename, 'wb') as fR:
-            fR.write(right_bytes)
+            fR.write(right_bytes.payload if isinstance(right_bytes, EncodedImage) else right_bytes)
         print(f"Images saved locally: {left_filename}, {right_filename}")
 
+    def _send_loop(self):
+        # waits for each pair's encoding to finish and sends it while the next pair is captured
+        while self.running or not self._send_queue.empty():
+            try:
+                (future_left, future_right), timestamps, seq, explicit = self._send_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            set_frame(seq)
+            try:
+                with stage("encode_wait"):
+                    left, right = future_left.result(), future_right.result()
+            except Exception as e:
+                print("Failed to encode images:", e)
+                continue
+
+            if self.server.connected:
+                try:
+                    self.server.send_images(left, right, seq=seq, timestamps=timestamps, flags=self.send_flags)
+                    continue
+                except Exception as e:
+                    print("Failed to send images:", e)
+            if explicit:
+                self.save_images_locally(left, right)
+            else:
+                self.frames_dropped += 1
+
+    def snapshot(self):
+        """
+        Capture one pair as soon as possible and save it locally if it can't be sent.
+        """
+        self._snapshot.set()
+
+    def capture_pair(self, explicit=False):
+        """
+        Capture one pair and queue it for encoding; returns once the camera requests are released.
+        explicit: the pair was asked for (trigger or snapshot) and is saved locally if it can't be sent
+        """
+        imgL, imgR, capture_info = self.stereo_system.capture_stereo_image()
+
+        # copy the frames out of the camera buffers and hand the buffers back
+        left = imgL.make_array("main")
+        right = imgR.make_array("main")
+        timestamps = (imgL.get_metadata().get("SensorTimestamp", 0),
+                      imgR.get_metadata().get("SensorTimestamp", 0))
+        imgL.release()
+        imgR.release()
+        self._stage_ms["capture"] = self._stage_ms.get("capture", 0.0) + capture_info["latency_ms"]
+
+        if self.edge_depth:
+            self._send_queue.put((self._edge_depth(left, right), timestamps, capture_info["seq"], explicit))
+            self._update_stats()
+            return
+
+        if self.stereo is not None:
+            # both eyes are remapped in parallel, straight to grayscale at the output scale
+            left, right = self.stereo.rectify_pair(left, right)
+
+        # encoding overlaps with the next capture; put() blocks only if encoding falls behind
+        self._send_queue.put((self.encoder.submit(left, right), timestamps, capture_info["seq"], explicit))
+        self._update_stats()
+
+    def _timed(self, stage_name, start):
+        now = time.perf_counter()
+        self._stage_ms[stage_name] = self._stage_ms.get(stage_name, 0.0) + (now - start) * 1000.0
+        return now
+
+    def _edge_depth(self, left, right):
+        """
+        Rectify and match a pair on the Pi; returns encoder futures for the
+        (fixed-point disparity, packed validity mask) pair that replaces the images.
+        """
+        start = time.perf_counter()
+        left, right = self.stereo.rectify_pair(left, right)
+        start = self._timed("rectify", start)
+        disparity = self.stereo.compute_disparity_fixed(left, right)
+        start = self._timed("disparity", start)
+        # pack_disparity copies, so the engine may reuse its output buffer on the next frame
+        disparity, mask = pack_disparity(disparity, (self.stereo.min_disp - 1) * 16)
+        self._timed("pack", start)
+        return self.encoder.submit(disparity, mask, codec=self.depth_codec)
+
+    def _update_stats(self):
+        self._frames += 1
+        wall = time.perf_counter() - self._stats_wall
+        if wall < self.stats_interval:
+            return
+        cpu = time.process_time() - self._stats_cpu
+        stats = {"fps": self._frames / wall, "cpu_percent": 100.0 * cpu / wall,
+                 "load_avg": os.getloadavg()[0] if hasattr(os, "getloadavg") else None,
+                 "temp_c": None}
+        try:
+            with open("/sys/class/thermal/thermal_zone0/temp") as f:
+                stats["temp_c"] = int(f.read()) / 1000.0
+        except (OSError, ValueError):
+            pass
+        for stage_name, total_ms in self._stage_ms.items():
+            stats[f"{stage_name}_ms"] = total_ms / self._frames
+        self.edge_stats = stats
+        print(" ".join(f"{k}={v:.1f}" for k, v in stats.items() if v is not None))
+
+        self._frames = 0
+        self._stage_ms = {}
+        self._stats_wall = time.perf_counter()
+        self._stats_cpu = time.process_time()
+
     def run(self):
         self.running = True
         self.stereo_system.initialize_cameras()
         # start server in background (non-blocking)
         self.server.start_server()
+        self._sender_thread = threading.Thread(target=self._send_loop, daemon=True)
+        self._sender_thread.start()
 
-        self.stereo_system.display_preview()
-
-        while self.running:
-            # interface with UI to take images when button pressed
-            if ui_button_pressed():
-                self.stereo_system.stop_preview()
-                imgL, imgR = self.stereo_system.capture_stereo_image()
+        if self.trigger is not None:
+            self.stereo_system.display_preview()
 
-                # extract raw bytes from your image objects; adjust as needed
-                left_bytes = imgL.get_array("main")
-                right_bytes = imgR.get_array("main")
+        try:
+            while self.running:
+                if self._snapshot.is_set():
+                    self._snapshot.clear()
+                    self.capture_pair(explicit=True)
+                elif self.trigger is None:
+                    # nothing to stream to: don't capture and encode pairs only to drop them
+                    if not self.server.connected:
+                        time.sleep(0.05)
+                        continue
+                    self.capture_pair()
+                # interface with UI to take images when button pressed
+                elif self.trigger():
+                    self.stereo_system.stop_preview()
+                    self.capture_pair(explicit=True)
+                    self.stereo_system.display_preview()
+        finally:
+            self.stop()
 
-                if self.server.connected:
-                    try:
-                        print("Sending images to client...")
-                        self.server.send_images(left_bytes, right_bytes)
-                    except Exception as e:
-                        print("Failed to send images:", e)
-                        self.save_images_locally(left_bytes, right_bytes)
-                else:
-                    self.save_images_locally(left_bytes, right_bytes)
+    def stream_video(self, duration=None):
+        """
+        Stream live stereo H.264 (one hardware encoder per eye) to connected clients instead
+        of capturing still pairs; runs until duration elapses or stereo_system.stop_recording().
+        """
+        self.server.start_server()
+        try:
+            self.stereo_system.capture_video(duration=duration, server=self.server)
+        finally:
+            self.server.stop_server()
 
-                self.stereo_system.display_preview()
+    def stop(self):
+        self.running = False
+        if self._sender_thread is not None:
+            self._sender_thread.join(timeout=5)
+        self.encoder.close()
+        self.server.stop_server()
+        self.stereo_system.stop()
 
 
 if __name__ == "__main__":
     rpi = RaspberryPiStereoSystem()
-    rpi.run()
\ No newline at end of file
+    rpi.run()
@@ -0,0 +1,263 @@
+import functools
+import glob
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from benchmark import SCENES, _max_rss_mb, disparity_errors, synthetic_pair, time_stage
+from stereo_class import SGBM_PRESETS_FILE, StereoSystem
+
+#Default sweep. max_disparity is the search range in full-resolution pixels; the matcher gets
+#it scaled with the input and rounded up to a multiple of 16. speckle is (window size, range).
+SWEEP = {
+    "sgbm_mode": ("sgbm", "sgbm_3way", "hh4"),
+    "block_size": (3, 5, 7, 9),
+    "max_disparity": (64, 128),
+    "speckle": ((0, 0), (50, 2), (125, 1)),
+    "scale": (1.0, 0.5, 0.25),
+}
+PRESET_NAMES = ("realtime", "balanced", "quality")
+OBJECTIVES = ("p50_ms", "bad_pixel_percent", "peak_rss_mb")
+
+#Per-process dataset for the evaluation pool, set by _init_worker
+_worker_dataset = None
+
+
+def synthetic_dataset(size=(1280, 720), scenes=SCENES):
+    """
+    benchmark.py's synthetic pairs as [(name, left, right, truth, valid), ...].
+    """
+    dataset = []
+    for index, scene in enumerate(scenes):
+        left, right, truth, valid = synthetic_pair(size[0], size[1], scene, seed=index)
+        dataset.append((scene, left, right, truth, valid))
+    return dataset
+
+
+def load_dataset(path, size=None):
+    """
+    Rectified pairs with ground truth from a directory of left_<name>.png, right_<name>.png and
+    disp_<name>.npy (left disparity in px; non-finite or <= 0 marks unknown pixels).
+    """
+    dataset = []
+    for left_path in sorted(glob.glob(os.path.join(path, "left_*"))):
+        name = os.path.splitext(os.path.basename(left_path))[0][len("left_"):]
+        right_paths = glob.glob(os.path.join(path, f"right_{name}.*"))
+        truth_path = os.path.join(path, f"disp_{name}.npy")
+        if not right_paths or not os.path.exists(truth_path):
+            continue
+        left = cv2.imread(left_path, cv2.IMREAD_GRAYSCALE)
+        right = cv2.imread(right_paths[0], cv2.IMREAD_GRAYSCALE)
+        truth = np.load(truth_path).astype(np.float32)
+        if size is not None:
+            factor = size[0] / left.shape[1]
+            left, right = cv2.resize(left, size, interpolation=cv2.INTER_AREA), cv2.resize(right, size, interpolation=cv2.INTER_AREA)
+            truth = cv2.resize(truth, size, interpolation=cv2.INTER_NEAREST) * factor
+        valid = np.isfinite(truth) & (truth > 0)
+        dataset.append((name, left, right, np.nan_to_num(truth), valid))
+    if not dataset:
+        raise FileNotFoundError(f"No left_*/right_*/disp_*.npy samples in {path}")
+    return dataset
+
+
+def sweep_configs(sweep=SWEEP):
+    keys = list(sweep)
+    for values in itertools.product(*(sweep[key] for key in keys)):
+        yield dict(zip(keys, values))
+
+
+def _matcher_settings(config):
+    #Settings in StereoSystem / preset terms for a sweep config
+    window, speckle_range = config["speckle"]
+    return {
+        "sgbm_mode": config["sgbm_mode"],
+        "block_size": config["block_size"],
+        "num_disp": max(16, int(math.ceil(config["max_disparity"] * config["scale"] / 16.0)) * 16),
+        "speckle_window_size": window,
+        "speckle_range": speckle_range,
+        "uniqueness_ratio": config.get("uniqueness_ratio", 7),
+        "scale": config["scale"],
+    }
+
+
+def _proc_status_mb(*keys):
+    #Fields of /proc/self/status in MB (Linux), or None
+    try:
+        with open("/proc/self/status") as f:
+            fields = {line.split(":")[0]: int(line.split()[1]) / 1024.0 for line in f if line.startswith(keys)}
+        return tuple(fields[key] for key in keys)
+    except (OSError, KeyError, ValueError, IndexError):
+        return None
+
+
+def _reset_peak_rss():
+    #Writing 5 to clear_refs resets VmHWM to the current RSS (Linux 4.0+)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _matcher_peak_mb(system, left, right):
+    """
+    Resident memory in MB that one disparity call adds at its peak: VmHWM after the call minus
+    VmRSS before it, with the high-water mark reset first. This must be the process's first
+    matcher call, since buffers the allocator keeps afterwards would count as baseline. Without
+    /proc the ru_maxrss increase is used, which is only valid because each config runs in a
+    fresh process. Returns None where neither is available.
+    """
+    before = _proc_status_mb("VmRSS")
+    if before is not None and _reset_peak_rss():
+        system.compute_disparity_fixed(left, right)
+        return _proc_status_mb("VmHWM")[0] - before[0]
+    before = _max_rss_mb()
+    system.compute_disparity_fixed(left, right)
+    return None if before is None else _max_rss_mb() - before
+
+
+def _init_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def _evaluate(config, repeats=3):
+    """
+    Pool task (one fresh process per config): match every dataset pair at the config's scale,
+    time it and score the disparity, upsampled back to full resolution, against the ground truth.
+    peak_rss_mb is the matcher's working memory, measured on the first call on the largest pair.
+    """
+    settings = _matcher_settings(config)
+    scale = settings.pop("scale")
+    system = StereoSystem(**settings)
+    samples = []
+    for name, left, right, truth, valid in _worker_dataset:
+        if scale != 1.0:
+            left = cv2.resize(left, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            right = cv2.resize(right, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        samples.append((name, left, right, truth, valid))
+    largest = max(samples, key=lambda sample: sample[1].size)
+    peak_rss_mb = _matcher_peak_mb(system, largest[1], largest[2])
+
+    rows = []
+    for name, left, right, truth, valid in samples:
+        timing = time_stage(lambda: system.compute_disparity_fixed(left, right), repeats)
+        _, estimate, _ = system.compute_disparity(left, right)
+        if scale != 1.0:
+            estimate = cv2.resize(estimate, (truth.shape[1], truth.shape[0]), interpolation=cv2.INTER_NEAREST) / scale
+        row = {"sample": name, "p50_ms": timing["p50_ms"], "p99_ms": timing["p99_ms"]}
+        row.update(disparity_errors(estimate, truth, valid))
+        rows.append(row)
+
+    result = dict(config, speckle=list(config["speckle"]), matcher=_matcher_settings(config), samples=rows)
+    for key in ("p50_ms", "p99_ms", "bad_pixel_percent", "density_percent"):
+        result[key] = float(np.mean([row[key] for row in rows]))
+    epes = [row["epe_px"] for row in rows if row["epe_px"] is not None]
+    result["epe_px"] = float(np.mean(epes)) if epes else None
+    result["peak_rss_mb"] = peak_rss_mb
+    return result
+
+
+def pareto_front(results, objectives=OBJECTIVES):
+    """
+    Results not dominated by any other (no worse in every objective, better in one); all
+    objectives are minimized and a missing value (e.g. peak_rss_mb without a memory probe)
+    counts as worst, so such a row never dominates on that objective.
+    """
+    values = np.array([[np.inf if row.get(key) is None else row[key] for key in objectives] for row in results])
+    front = []
+    for index, row in enumerate(results):
+        no_worse = np.all(values <= values[index], axis=1)
+        better = np.any(values < values[index], axis=1)
+        if not np.any(no_worse & better):
+            front.append(row)
+    return sorted(front, key=lambda row: row["p50_ms"])
+
+
+def choose_presets(front, realtime_ms=1000.0 / 30):
+    """
+    Name three points of the Pareto front:
+      realtime - most accurate point within realtime_ms per pair (the fastest if none is)
+      quality  - most accurate point
+      balanced - closest to the ideal of front-best time and accuracy, both normalized to the front's range
+    """
+    fast = [row for row in front if row["p50_ms"] <= realtime_ms]
+    realtime = min(fast, key=lambda row: row["bad_pixel_percent"]) if fast else front[0]
+    quality = min(front, key=lambda row: (row["bad_pixel_percent"], row["p50_ms"]))
+    times = np.array([row["p50_ms"] for row in front])
+    errors = np.array([row["bad_pixel_percent"] for row in front])
+    distance = ((times - times.min()) / max(np.ptp(times), 1e-9)) ** 2 + \
+               ((errors - errors.min()) / max(np.ptp(errors), 1e-9)) ** 2
+    balanced = front[int(np.argmin(distance))]
+    presets = {}
+    for name, row in zip(PRESET_NAMES, (realtime, balanced, quality)):
+        presets[name] = dict(row["matcher"], metrics={key: row[key] for key in
+                                                      ("p50_ms", "p99_ms", "bad_pixel_percent", "epe_px",
+                                                       "density_percent", "peak_rss_mb")})
+    return presets
+
+
+def tune(out_path=SGBM_PRESETS_FILE, dataset=None, size=(1280, 720), sweep=SWEEP, repeats=3,
+         realtime_ms=1000.0 / 30):
+    """
+    Evaluate every sweep config on dataset (default: synthetic pairs of size), then write the
+    Pareto front and the named presets that StereoSystem(preset=...) loads to out_path.
+    Configs run one after another, each in a fresh process, so timings don't contend.
+    Returns the report dict.
+    """
+    if dataset is None:
+        dataset = synthetic_dataset(size)
+    configs = list(sweep_configs(sweep))
+    results = []
+    context = multiprocessing.get_context()
+    with context.Pool(1, initializer=_init_worker, initargs=(dataset,), maxtasksperchild=1) as pool:
+        for index, result in enumerate(pool.imap(functools.partial(_evaluate, repeats=repeats), configs)):
+            results.append(result)
+            rss = "" if result["peak_rss_mb"] is None else f", {result['peak_rss_mb']:.0f} MB"
+            print(f"[{index + 1}/{len(configs)}] {result['sgbm_mode']} block {result['block_size']} "
+                  f"range {result['max_disparity']} speckle {result['speckle'][0]}/{result['speckle'][1]} "
+                  f"x{result['scale']:.2f}: {result['p50_ms']:.1f} ms, bad {result['bad_pixel_percent']:.1f}%{rss}")
+
+    front = pareto_front(results)
+    height, width = dataset[0][1].shape[:2]
+    report = {
+        "version": 1,
+        "created": time.time(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "opencv": cv2.__version__,
+        "dataset": {"samples": [sample[0] for sample in dataset], "resolution": f"{width}x{height}"},
+        "realtime_ms": realtime_ms,
+        "presets": choose_presets(front, realtime_ms),
+        "pareto": front,
+        "results": results,
+    }
+    tmp_path = f"{out_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(report, f, indent=1)
+    os.replace(tmp_path, out_path)
+    return report
+
+
+if __name__ == "__main__":
+    #Usage: python sgbm_tuner.py [out.json] [WxH] [repeats] [dataset dir]
+    out_path = sys.argv[1] if len(sys.argv) > 1 else SGBM_PRESETS_FILE
+    size = tuple(int(v) for v in sys.argv[2].split("x")) if len(sys.argv) > 2 else (1280, 720)
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    dataset = load_dataset(sys.argv[4], size) if len(sys.argv) > 4 else None
+    report = tune(out_path, dataset, size, repeats=repeats)
+    print(f"Pareto front: {len(report['pareto'])} of {len(report['results'])} configs")
+    for name, preset in report["presets"].items():
+        metrics = preset["metrics"]
+        print(f"{name:>9}: {preset['sgbm_mode']} block {preset['block_size']} num_disp {preset['num_disp']} "
+              f"speckle {preset['speckle_window_size']}/{preset['speckle_range']} scale {preset['scale']}  "
+              f"{metrics['p50_ms']:.1f} ms, bad {metrics['bad_pixel_percent']:.1f}%")
@@ -1,13 +1,119 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import cv2
 import numpy as np
 
+from calibration_store import CalibrationBundle, calibration_key
+from disparity import HierarchicalDisparityEngine, TemporalDisparityEngine, TiledDisparityEngine
+from instrumentation import stage
+from pointcloud import write_ply
+
+#Subpixel refinement termination criteria shared by every detection path
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+SGBM_MODES = {
+    "sgbm": cv2.STEREO_SGBM_MODE_SGBM,
+    "sgbm_3way": cv2.STEREO_SGBM_MODE_SGBM_3WAY,
+    "hh": cv2.STEREO_SGBM_MODE_HH,
+    "hh4": cv2.STEREO_SGBM_MODE_HH4,
+}
+
+#Matcher presets written by sgbm_tuner.py; these built-in values are used when there is no
+#presets file. num_disp is in pixels of the scaled (matched) image, scale is the
+#configure_rectification scale the preset was tuned for.
+SGBM_PRESETS_FILE = "sgbm_presets.json"
+SGBM_PRESETS = {
+    "realtime": dict(sgbm_mode="sgbm", block_size=5, num_disp=32, speckle_window_size=50, speckle_range=2,
+                     uniqueness_ratio=7, scale=0.25),
+    "balanced": dict(sgbm_mode="sgbm_3way", block_size=5, num_disp=64, speckle_window_size=125, speckle_range=1,
+                     uniqueness_ratio=7, scale=0.5),
+    "quality": dict(sgbm_mode="sgbm_3way", block_size=7, num_disp=128, speckle_window_size=125, speckle_range=1,
+                    uniqueness_ratio=7, scale=1.0),
+}
+_PRESET_KEYS = ("sgbm_mode", "block_size", "num_disp", "speckle_window_size", "speckle_range", "uniqueness_ratio",
+                "scale")
+
+
+def load_sgbm_preset(name, path=SGBM_PRESETS_FILE):
+    """
+    Matcher settings of preset name from the presets file at path, falling back to SGBM_PRESETS.
+    """
+    if path is not None and os.path.exists(path):
+        with open(path) as f:
+            presets = json.load(f).get("presets", {})
+        if name in presets:
+            return {key: presets[name][key] for key in _PRESET_KEYS if key in presets[name]}
+    if name not in SGBM_PRESETS:
+        raise KeyError(f"Unknown SGBM preset: {name}")
+    return dict(SGBM_PRESETS[name])
+
+
+def _load_gray(image):
+    """
+    Load an image as grayscale from a file path or an encoded buffer (bytes/uint8 array).
+    Returns None if the image can't be read or decoded.
+    """
+    if isinstance(image, (str, os.PathLike)):
+        return cv2.imread(os.fspath(image), cv2.IMREAD_GRAYSCALE)
+    return cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_GRAYSCALE)
+
+
+def _find_corners(gray, chessboard_size, detection_scale=1.0):
+    """
+    Find and subpixel-refine chessboard corners in a grayscale image.
+    detection_scale < 1 searches a downscaled copy first (with the fast-check rejection
+    step so frames without a board return early), scales the corners back up and only
+    runs cornerSubPix at full resolution.
+    Returns the refined corners or None if the board was not found.
+    """
+    if detection_scale >= 1.0:
+        ret, corners = cv2.findChessboardCorners(gray, chessboard_size, None)
+    else:
+        small = cv2.resize(gray, None, fx=detection_scale, fy=detection_scale, interpolation=cv2.INTER_AREA)
+        flags = cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_NORMALIZE_IMAGE + cv2.CALIB_CB_FAST_CHECK
+        ret, corners = cv2.findChessboardCorners(small, chessboard_size, flags)
+        if ret:
+            #Map pixel centres from the small image back to full resolution
+            corners = (corners + 0.5) / detection_scale - 0.5
+    if not ret:
+        return None
+    return cv2.cornerSubPix(gray, corners, (11,11), (-1,-1), SUBPIX_CRITERIA)
+
+
+def _init_detection_worker():
+    #Each worker handles one image, so keep OpenCV from spawning its own threads on top of the pool
+    cv2.setNumThreads(1)
+
+
+def _detect_chessboard(image, chessboard_size, detection_scale=1.0):
+    """
+    Process pool task: load one image and detect its chessboard corners.
+    Returns (corners or None, image size as (w, h) or None, error message or None, detection time in ms).
+    """
+    gray = _load_gray(image)
+    if gray is None:
+        return None, None, "image not loaded", 0.0
+    start = time.perf_counter()
+    corners = _find_corners(gray, chessboard_size, detection_scale)
+    elapsed_ms = (time.perf_counter() - start) * 1000.0
+    size = (gray.shape[1], gray.shape[0])
+    if corners is None:
+        return None, size, "chessboard not found", elapsed_ms
+    return corners, size, None, elapsed_ms
+
+
 class CameraCalibration:
-    def __init__(self, chessboard_size=(7,7), square_size=1.0):
+    def __init__(self, chessboard_size=(7,7), square_size=1.0, detection_scale=1.0):
         """
         Initialize calibration parameters.
+        detection_scale: < 1.0 enables coarse-to-fine corner search on a downscaled copy (e.g. 0.5 for 1080p)
         """
         self.chessboard_size = chessboard_size
         self.square_size = square_size
+        self.detection_scale = detection_scale
 
         # Prepare object points
         self.objp = np.zeros((chessboard_size[1]*chessboard_size[0],3), np.float32)
@@ -38,12 +144,21 @@ class CameraCalibration:
         self.PR = None
         self.Q = None
 
+        # Valid pixel ROIs (x, y, w, h) in the rectified images
+        self.roi_left = None
+        self.roi_right = None
+
         # Rectification maps
         self.left_map1 = None
         self.left_map2 = None
         self.right_map1 = None
         self.right_map2 = None
 
+        # RMS reprojection errors
+        self.rms_left = None
+        self.rms_right = None
+        self.rms_stereo = None
+
     def decode_img(self, img_left, img_right):
         img_left_cv = cv2.imdecode(img_left, cv2.IMREAD_COLOR)
         img_right_cv = cv2.imdecode(img_right, cv2.IMREAD_COLOR)
@@ -67,28 +182,63 @@ class CameraCalibration:
         gray_left = cv2.cvtColor(img_left_array, cv2.COLOR_BGR2GRAY)
         gray_right = cv2.cvtColor(img_right_array, cv2.COLOR_BGR2GRAY)
 
-        ret_left, corners_left = cv2.findChessboardCorners(gray_left, self.chessboard_size, None)
-        ret_right, corners_right = cv2.findChessboardCorners(gray_right, self.chessboard_size, None)
+        # Find corners with subpixel refinement
+        corners_left = _find_corners(gray_left, self.chessboard_size, self.detection_scale)
+        corners_right = _find_corners(gray_right, self.chessboard_size, self.detection_scale)
 
-        if ret_left and ret_right:
+        if corners_left is not None and corners_right is not None:
             self.objpoints.append(self.objp)
-
-            # Subpixel refinement
-            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
-            corners_left = cv2.cornerSubPix(gray_left, corners_left, (11,11), (-1,-1), criteria)
-            corners_right = cv2.cornerSubPix(gray_right, corners_right, (11,11), (-1,-1), criteria)
-
             self.imgpoints_left.append(corners_left)
             self.imgpoints_right.append(corners_right)
 
             if display:
-                cv2.drawChessboardCorners(img_left, self.chessboard_size, corners_left, ret_left)
-                cv2.drawChessboardCorners(img_right, self.chessboard_size, corners_right, ret_right)
-                cv2.imshow("Left Corners", img_left)
-                cv2.imshow("Right Corners", img_right)
+                cv2.drawChessboardCorners(img_left_array, self.chessboard_size, corners_left, True)
+                cv2.drawChessboardCorners(img_right_array, self.chessboard_size, corners_right, True)
+                cv2.imshow("Left Corners", img_left_array)
+                cv2.imshow("Right Corners", img_right_array)
                 cv2.waitKey(500)
-        else:
-            print("Chessboard not found in one or both images.")
+            return True
+
+        print("Chessboard not found in one or both images.")
+        return False
+
+    def add_chessboard_corners_batch(self, image_pairs, max_workers=None):
+        """
+        Detect and store chessboard corners for a list of (left, right) image pairs.
+        Images may be file paths or encoded bytes. Every image is a separate task in a
+        process pool so left and right are detected at the same time. Accepted pairs are
+        appended to objpoints/imgpoints_left/imgpoints_right in input order.
+
+        Returns one report dict per pair: index, accepted, image_size, per-side detection
+        time in ms and, for rejected pairs, the reason for each side.
+        """
+        image_pairs = list(image_pairs)
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_detection_worker) as pool:
+            futures = [
+                (pool.submit(_detect_chessboard, left, self.chessboard_size, self.detection_scale),
+                 pool.submit(_detect_chessboard, right, self.chessboard_size, self.detection_scale))
+                for left, right in image_pairs
+            ]
+            results = [(fut_left.result(), fut_right.result()) for fut_left, fut_right in futures]
+
+        report = []
+        for index, (left, right) in enumerate(results):
+            corners_left, size_left, err_left, ms_left = left
+            corners_right, size_right, err_right, ms_right = right
+            entry = {"index": index, "accepted": False, "image_size": size_left,
+                     "left_ms": ms_left, "right_ms": ms_right}
+            if err_left is None and err_right is None and size_left != size_right:
+                err_right = f"image size {size_right} does not match left {size_left}"
+            if err_left is None and err_right is None:
+                self.objpoints.append(self.objp)
+                self.imgpoints_left.append(corners_left)
+                self.imgpoints_right.append(corners_right)
+                entry["accepted"] = True
+            else:
+                entry["left_error"] = err_left
+                entry["right_error"] = err_right
+            report.append(entry)
+        return report
 
     def calibrate_cameras(self, image_shape, alpha=0.0):
         """
@@ -96,18 +246,18 @@ class CameraCalibration:
         alpha: free scaling parameter (0 = crop, 1 = keep all pixels)
         """
         # Left camera
-        rmsE1, self.ML, self.DL, rvecsL, tvecsL = cv2.calibrateCamera(
+        self.rms_left, self.ML, self.DL, rvecsL, tvecsL = cv2.calibrateCamera(
             self.objpoints, self.imgpoints_left, image_shape, None, None
         )
         self.ML_opt, _ = cv2.getOptimalNewCameraMatrix(self.ML, self.DL, image_shape, alpha, image_shape)
 
         # Right camera
-        rmsE2, self.MR, self.DR, rvecsR, tvecsR = cv2.calibrateCamera(
+        self.rms_right, self.MR, self.DR, rvecsR, tvecsR = cv2.calibrateCamera(
             self.objpoints, self.imgpoints_right, image_shape, None, None
         )
         self.MR_opt, _ = cv2.getOptimalNewCameraMatrix(self.MR, self.DR, image_shape, alpha, image_shape)
 
-        return rmsE1cam, rmsE2cam, rvecsR, rvecsL, tvecsR, tvecsL
+        return self.rms_left, self.rms_right, rvecsR, rvecsL, tvecsR, tvecsL
 
     def stereo_calibrate_and_rectify(self, image_shape):
         """
@@ -116,7 +266,7 @@ class CameraCalibration:
         flags = cv2.CALIB_FIX_INTRINSIC #Fixes intrinsics determined from camera calibration 
         criteria = (cv2.TERM_CRITERIA_MAX_ITER + cv2.TERM_CRITERIA_EPS, 100, 1e-5)
 
-        rmsReprojEstereo, _, _, _, _, self.R, self.T, self.E, self.F = cv2.stereoCalibrate(
+        self.rms_stereo, _, _, _, _, self.R, self.T, self.E, self.F = cv2.stereoCalibrate(
             self.objpoints,
             self.imgpoints_left,
             self.imgpoints_right,
@@ -130,7 +280,7 @@ class CameraCalibration:
         )
 
         # Rectification
-        self.RL, self.RR, self.PL, self.PR, self.Q, _, _ = cv2.stereoRectify(
+        self.RL, self.RR, self.PL, self.PR, self.Q, self.roi_left, self.roi_right = cv2.stereoRectify(
             self.ML_opt, self.DL, self.MR_opt, self.DR, image_shape, self.R, self.T
         )
 
@@ -142,37 +292,94 @@ class CameraCalibration:
             self.MR_opt, self.DR, self.RR, self.PR, image_shape, cv2.CV_16SC2
         )
 
-        return rmsReprojEstereo, self.Q
+        return self.rms_stereo, self.Q
 
     def get_rectification_maps(self):
         """
         Return rectification maps for stereo rectification.
         """
         return self.left_map1, self.left_map2, self.right_map1, self.right_map2
+
+    def load_or_calibrate(self, image_pairs, image_size, cache_dir="calibration_cache", alpha=0.0, max_workers=None):
+        """
+        Load the calibration bundle for these inputs from cache_dir, or run the full
+        calibration (batch corner detection, intrinsics, stereo calibration, rectification
+        maps) and save it there. Only recalibrates when the images, board geometry,
+        image size, alpha or detection_scale change.
+        image_size: (width, height) of the calibration images
+        """
+        image_pairs = list(image_pairs)
+        key = calibration_key(image_pairs, self.chessboard_size, self.square_size, image_size, alpha,
+                              self.detection_scale)
+        bundle = CalibrationBundle.load(cache_dir, key)
+        if bundle is not None:
+            bundle.apply_to_calibration(self)
+            return bundle
+
+        report = self.add_chessboard_corners_batch(image_pairs, max_workers=max_workers)
+        rejected = [entry["index"] for entry in report if not entry["accepted"]]
+        if rejected:
+            print(f"Chessboard not found in pairs {rejected}")
+        if not self.objpoints:
+            raise ValueError("No usable calibration pairs")
+
+        self.calibrate_cameras(image_size, alpha)
+        self.stereo_calibrate_and_rectify(image_size)
+        bundle = CalibrationBundle.from_calibration(self, key, image_size, alpha)
+        bundle.save(cache_dir)
+        return bundle
     
 #STEREO COMPUTATION CLASS
 class StereoSystem:
     #Blocksize 7 (must be odd number between 3 and 11)
-    def __init__(self, min_disp=0, num_disp=128, block_size=7, lambda_val=8000, sigma_color=1.4):
+    #disparity_mode: "single" (one SGBM call), "tiled" (parallel horizontal bands),
+    #"hierarchical" (coarse disparity sets a per-tile search window) or "temporal"
+    #(video: reuse the previous frame's disparity, skip unchanged tiles), see disparity.py
+    #disparity_bands: bands for "tiled" and worker threads for the other modes; with "single", > 1 implies "tiled"
+    #sgbm_mode: key of SGBM_MODES ("sgbm" uses less memory than the default "sgbm_3way")
+    #preset: name of a matcher preset (see load_sgbm_preset); it overrides the matcher arguments and
+    #sets the default configure_rectification scale
+    def __init__(self, min_disp=0, num_disp=128, block_size=7, lambda_val=8000, sigma_color=1.4,
+                 disparity_mode="single", disparity_bands=1, uniqueness_ratio=7, speckle_window_size=125,
+                 speckle_range=1, sgbm_mode="sgbm_3way", preset=None, presets_path=SGBM_PRESETS_FILE):
+        self.preset = preset
+        self.preset_scale = 1.0
+        if preset is not None:
+            settings = load_sgbm_preset(preset, presets_path)
+            self.preset_scale = settings.pop("scale", 1.0)
+            num_disp = settings.get("num_disp", num_disp)
+            block_size = settings.get("block_size", block_size)
+            uniqueness_ratio = settings.get("uniqueness_ratio", uniqueness_ratio)
+            speckle_window_size = settings.get("speckle_window_size", speckle_window_size)
+            speckle_range = settings.get("speckle_range", speckle_range)
+            sgbm_mode = settings.get("sgbm_mode", sgbm_mode)
+        if sgbm_mode not in SGBM_MODES:
+            raise ValueError(f"Unknown SGBM mode: {sgbm_mode}")
         self.min_disp = min_disp
         self.num_disp = num_disp
         self.block_size = block_size
+        self.sgbm_mode = sgbm_mode
 
-        self.matcher_left = cv2.StereoSGBM_create(
+        self.sgbm_params = dict(
             minDisparity=self.min_disp,
             numDisparities=self.num_disp,
             blockSize=self.block_size,
             #Calculation per documentation in SGBM class
             P1=8*3*self.block_size**2,
             P2=32*3*self.block_size**2,
-            uniquenessRatio = 7,
-            speckleWindowSize = 125,
-            speckleRange = 1, 
-            #Consider MODE_SGBM for less memory consumption
-            mode=cv2.STEREO_SGBM_MODE_SGBM_3WAY
+            uniquenessRatio = uniqueness_ratio,
+            speckleWindowSize = speckle_window_size,
+            speckleRange = speckle_range,
+            #sgbm_tuner.py measures the speed/memory/accuracy trade-off of each mode
+            mode=SGBM_MODES[sgbm_mode]
         )
+        self.matcher_left = cv2.StereoSGBM_create(**self.sgbm_params)
+        self.matcher_right = None
         #self.matcher_right = cv2.ximgproc.createRightMatcher(self.matcher_left)
 
+        self.disparity_engine = self._create_disparity_engine(disparity_mode, disparity_bands)
+        self._depth_scratch = None
+
         #LRCThresh default is 24 (1.5 px)
         #Can use .getConfidenceMap() ***Still need to find a way to calculate LRC consistency check median value in px
         #Lambda and SigmaColor values per documentation recommendation
@@ -184,32 +391,263 @@ class StereoSystem:
         self.left_map2 = None
         self.right_map1 = None
         self.right_map2 = None
+        self.roi_left = None
+        self.roi_right = None
+        #Q for the full-size rectified images; self.Q matches what rectify_pair outputs
+        self.Q_full = None
         self.Q = None
 
-    def set_rectification(self, left_maps, right_maps, Q):
+        #Rectification stage settings (see configure_rectification)
+        self.rect_grayscale = False
+        self.rect_scale = self.preset_scale
+        self.rect_crop_to_roi = False
+        self.rect_parallel = True
+        self.rect_buffer_count = 1
+        self.rect_offset = (0, 0)
+        self._rect_maps = None
+        self._rect_buffers = []
+        self._rect_buffer_index = 0
+        self._rect_gray_inputs = None
+        self._rect_pool = None
+
+    def _create_disparity_engine(self, mode, bands):
+        if mode not in ("single", "tiled", "hierarchical", "temporal"):
+            raise ValueError(f"Unknown disparity mode: {mode}")
+        if mode == "hierarchical":
+            return HierarchicalDisparityEngine(self.sgbm_params, max_workers=bands)
+        if mode == "temporal":
+            return TemporalDisparityEngine(self.sgbm_params, max_workers=bands)
+        if mode == "tiled" or (mode == "single" and bands > 1):
+            return TiledDisparityEngine(self.sgbm_params, num_bands=bands if bands > 1 else None)
+        return None
+
+    def set_rectification(self, left_maps, right_maps, Q, roi_left=None, roi_right=None):
         self.left_map1, self.left_map2 = left_maps
         self.right_map1, self.right_map2 = right_maps
+        self.Q_full = Q
         self.Q = Q
+        self.roi_left = roi_left
+        self.roi_right = roi_right
+        self._prepare_rectification()
 
-    def rectify_pair(self, imgL, imgR):
-        imgL_rect = cv2.remap(imgL, self.left_map1, self.left_map2, cv2.INTER_LINEAR)
-        imgR_rect = cv2.remap(imgR, self.right_map1, self.right_map2, cv2.INTER_LINEAR)
+    def configure_rectification(self, grayscale=False, scale=None, crop_to_roi=False, parallel=True, buffer_count=1):
+        """
+        Configure what rectify_pair produces.
+        grayscale: output single channel images (what SGBM uses)
+        scale: output scale relative to the full rectified size (default: the preset's scale, else 1.0)
+        crop_to_roi: crop to the region that is valid in both rectified images
+        parallel: rectify the right image in a worker thread while the left is remapped
+        buffer_count: number of reusable output buffer pairs, cycled per call; use more than
+                      one if earlier results are still in use while the next pair is rectified
+        Crop and scale are folded into the remap tables, so each eye is a single remap,
+        and self.Q is updated to match the output geometry.
+        """
+        self.rect_grayscale = grayscale
+        self.rect_scale = self.preset_scale if scale is None else scale
+        self.rect_crop_to_roi = crop_to_roi
+        self.rect_parallel = parallel
+        self.rect_buffer_count = max(1, buffer_count)
+        self._prepare_rectification()
+
+    def _common_roi(self):
+        #Both eyes must be cropped identically to keep rows aligned and disparities unchanged
+        if self.roi_left is None or self.roi_right is None:
+            return None
+        xl, yl, wl, hl = self.roi_left
+        xr, yr, wr, hr = self.roi_right
+        x0, y0 = max(xl, xr), max(yl, yr)
+        x1, y1 = min(xl + wl, xr + wr), min(yl + hl, yr + hr)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return int(x0), int(y0), int(x1 - x0), int(y1 - y0)
+
+    def _prepare_rectification(self):
+        """
+        Build the remap tables for the configured crop/scale and matching Q.
+        """
+        self._rect_buffers = []
+        self._rect_buffer_index = 0
+        self._rect_gray_inputs = None
+        if self.left_map1 is None:
+            self._rect_maps = None
+            return
+
+        full_h, full_w = self.left_map1.shape[:2]
+        x0, y0, w, h = 0, 0, full_w, full_h
+        if self.rect_crop_to_roi:
+            roi = self._common_roi()
+            if roi is None:
+                print("No common valid ROI available, rectifying without cropping")
+            else:
+                x0, y0, w, h = roi
+        scale = self.rect_scale
+
+        if (x0, y0, w, h) == (0, 0, full_w, full_h) and scale == 1.0:
+            self._rect_maps = ((self.left_map1, self.left_map2), (self.right_map1, self.right_map2))
+        else:
+            out_size = (max(1, round(w * scale)), max(1, round(h * scale)))
+            maps = []
+            for map1, map2 in ((self.left_map1, self.left_map2), (self.right_map1, self.right_map2)):
+                map_x, map_y = cv2.convertMaps(map1, map2, cv2.CV_32FC1)
+                map_x, map_y = map_x[y0:y0 + h, x0:x0 + w], map_y[y0:y0 + h, x0:x0 + w]
+                if scale != 1.0:
+                    map_x = cv2.resize(map_x, out_size, interpolation=cv2.INTER_LINEAR)
+                    map_y = cv2.resize(map_y, out_size, interpolation=cv2.INTER_LINEAR)
+                maps.append(cv2.convertMaps(map_x, map_y, cv2.CV_16SC2))
+            self._rect_maps = tuple(maps)
+        self.rect_offset = (x0, y0)
+
+        if self.Q_full is not None:
+            #Shift the principal point by the crop offset, then scale pixel units (pixel centre aligned)
+            Q = np.array(self.Q_full, dtype=np.float64)
+            Q[0, 3] = scale * (Q[0, 3] + x0 - 0.5) + 0.5
+            Q[1, 3] = scale * (Q[1, 3] + y0 - 0.5) + 0.5
+            Q[2, 3] *= scale
+            Q[3, 3] *= scale
+            self.Q = Q
+
+    def _rect_output_buffers(self, imgL):
+        #Output pair to write into, allocated on first use and reused afterwards
+        channels = 1 if self.rect_grayscale or imgL.ndim == 2 else imgL.shape[2]
+        out_h, out_w = self._rect_maps[0][0].shape[:2]
+        shape = (out_h, out_w) if channels == 1 else (out_h, out_w, channels)
+        if not self._rect_buffers or self._rect_buffers[0][0].shape != shape or self._rect_buffers[0][0].dtype != imgL.dtype:
+            self._rect_buffers = [(np.empty(shape, imgL.dtype), np.empty(shape, imgL.dtype))
+                                  for _ in range(self.rect_buffer_count)]
+            self._rect_buffer_index = 0
+        out = self._rect_buffers[self._rect_buffer_index]
+        self._rect_buffer_index = (self._rect_buffer_index + 1) % len(self._rect_buffers)
+        return out
+
+    def _rectify_one(self, img, maps, dst, side):
+        map1, map2 = maps
+        if not self.rect_grayscale or img.ndim == 2:
+            return cv2.remap(img, map1, map2, cv2.INTER_LINEAR, dst=dst)
+        #Convert at whichever resolution is cheaper: remap 3 channels small then convert, or convert then remap 1 channel
+        if 3 * self.rect_scale ** 2 < 1.0:
+            return cv2.cvtColor(cv2.remap(img, map1, map2, cv2.INTER_LINEAR), cv2.COLOR_BGR2GRAY, dst=dst)
+        if self._rect_gray_inputs is None or self._rect_gray_inputs[0].shape != img.shape[:2]:
+            self._rect_gray_inputs = (np.empty(img.shape[:2], img.dtype), np.empty(img.shape[:2], img.dtype))
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=self._rect_gray_inputs[side])
+        return cv2.remap(gray, map1, map2, cv2.INTER_LINEAR, dst=dst)
+
+    def rectify_pair(self, imgL, imgR, out=None):
+        """
+        Rectify a stereo pair into reusable output buffers (or into out=(left, right)).
+        The returned arrays are overwritten after buffer_count further calls, so copy
+        them if they need to live longer.
+        """
+        if self._rect_maps is None:
+            raise ValueError("Rectification maps not set.")
+        dstL, dstR = out if out is not None else self._rect_output_buffers(imgL)
+        with stage("rectify"):
+            if self.rect_parallel:
+                if self._rect_pool is None:
+                    self._rect_pool = ThreadPoolExecutor(max_workers=1)
+                future = self._rect_pool.submit(self._rectify_one, imgR, self._rect_maps[1], dstR, 1)
+                imgL_rect = self._rectify_one(imgL, self._rect_maps[0], dstL, 0)
+                imgR_rect = future.result()
+            else:
+                imgL_rect = self._rectify_one(imgL, self._rect_maps[0], dstL, 0)
+                imgR_rect = self._rectify_one(imgR, self._rect_maps[1], dstR, 1)
         return imgL_rect, imgR_rect
 
+    def load_rectification(self, path="calibration_cache", key=None):
+        """
+        Set the rectification maps and Q from a saved calibration bundle.
+        path may be a bundle directory or a cache directory (uses key, or the latest bundle).
+        """
+        bundle = path if isinstance(path, CalibrationBundle) else CalibrationBundle.load(path, key)
+        if bundle is None:
+            raise FileNotFoundError(f"No calibration bundle found in {path}")
+        self.set_rectification(bundle.left_maps(), bundle.right_maps(), bundle.arrays["Q"],
+                               bundle.roi_left, bundle.roi_right)
+        return bundle
+
+    def compute_disparity_fixed(self, imgL, imgR):
+        """
+        Left disparity in StereoSGBM fixed point (int16, 4 fractional bits; invalid is (min_disp - 1) * 16).
+        May return a buffer that is reused on the next call.
+        """
+        with stage("disparity"):
+            if self.disparity_engine is not None:
+                return self.disparity_engine.compute_fixed(imgL, imgR)
+            return self.matcher_left.compute(imgL, imgR)
+
     def compute_disparity(self, imgL, imgR):
-        dispL = self.matcher_left.compute(imgL, imgR).astype(np.float32) / 16.0
+        with stage("disparity"):
+            if self.disparity_engine is not None:
+                dispL = self.disparity_engine.compute(imgL, imgR)
+            else:
+                dispL = self.matcher_left.compute(imgL, imgR).astype(np.float32) / 16.0
 
-        dispR = self.matcher_right.compute(imgR, imgL).astype(np.float32) / 16.0
+        dispR = None
+        if self.matcher_right is not None:
+            dispR = self.matcher_right.compute(imgR, imgL).astype(np.float32) / 16.0
 
         #dispL_filtered = self.wls_filter.filter(dispL, imgL, None, dispR)
         return "dispL_filtered", dispL, dispR
 
-    def disparity_to_depth(self, disparity):
+    def disparity_to_depth(self, disparity, out=None, dtype=np.float32, mm_per_unit=1.0, invalid=None):
+        """
+        Depth (Z) straight from disparity using Q: Z = Q[2,3] / (Q[3,2] * d + Q[3,3]),
+        without building the HxWx3 point image of reprojectImageTo3D.
+        disparity: float disparity in px, or int16 SGBM fixed point (4 fractional bits)
+        out: preallocated output of the disparity's shape and dtype; a new array is returned if None,
+             so results handed to other threads are never overwritten
+        dtype: float32, float16, or uint16 for millimetres (depth * mm_per_unit, clipped to 65535)
+        mm_per_unit: millimetres per calibration unit (square_size units), only used for uint16
+        invalid: value for pixels without a valid disparity (default NaN, 0 for uint16)
+        """
+        if self.Q is None:
+            raise ValueError("Reprojection matrix Q not set.")
+        with stage("depth"):
+            return self._disparity_to_depth(disparity, out, np.dtype(dtype), mm_per_unit, invalid)
+
+    def _disparity_to_depth(self, disparity, out, dtype, mm_per_unit, invalid):
+        fixed_point = disparity.dtype == np.int16
+        scale = 1.0 / 16.0 if fixed_point else 1.0
+        #SGBM marks invalid pixels with min_disp - 1 (times 16 in fixed point)
+        invalid_disparity = (self.min_disp - 1) / scale
+
+        #W = Q[3,2] * d + Q[3,3] computed in a reused float32 scratch buffer
+        if self._depth_scratch is None or self._depth_scratch[0].shape != disparity.shape:
+            self._depth_scratch = (np.empty(disparity.shape, np.float32), np.empty(disparity.shape, bool))
+        w, valid = self._depth_scratch
+        np.multiply(disparity, np.float32(self.Q[3,2] * scale), out=w, casting="unsafe")
+        w += np.float32(self.Q[3,3])
+        np.greater(disparity, invalid_disparity, out=valid)
+        valid &= w > 0
+
+        if invalid is None:
+            invalid = 0 if dtype.kind in "ui" else np.nan
+        if out is None:
+            out = np.empty(disparity.shape, dtype)
+        if dtype == np.float32:
+            out.fill(invalid)
+            np.divide(np.float32(self.Q[2,3]), w, out=out, where=valid)
+        else:
+            #Divide in place in the scratch buffer, then convert once into the output
+            numerator = self.Q[2,3] * (mm_per_unit if dtype.kind in "ui" else 1.0)
+            np.divide(np.float32(numerator), w, out=w, where=valid)
+            np.clip(w, 0, np.iinfo(dtype).max if dtype.kind in "ui" else np.finfo(dtype).max, out=w)
+            if dtype.kind in "ui":
+                np.rint(w, out=w)
+            w[~valid] = invalid
+            np.copyto(out, w, casting="unsafe")
+        return out
+
+    def export_point_cloud(self, path, disparity, color=None, voxel_size=None, max_depth=None):
+        """
+        Write the valid points of a disparity map to a binary PLY file using self.Q.
+        color: rectified left image for per-point colour
+        voxel_size: optional voxel-grid downsampling (in calibration units)
+        Returns the number of points written.
+        """
         if self.Q is None:
             raise ValueError("Reprojection matrix Q not set.")
-        points_3D = cv2.reprojectImageTo3D(disparity, self.Q)
-        depth_map = points_3D[:,:,2]
-        return depth_map
+        return write_ply(path, disparity, self.Q, color, voxel_size,
+                         min_disparity=self.min_disp - 1, max_depth=max_depth)
 
     def visualize_disparity(self, disparity):
         disp_vis = cv2.normalize(disparity, None, 0, 255, cv2.NORM_MINMAX)
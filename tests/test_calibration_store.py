@@ -0,0 +1,97 @@
+import json
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from calibration_store import (BUNDLE_VERSION, LATEST_FILE, MANIFEST_FILE, MAP_NAMES, MATRIX_NAMES,
+                               CalibrationBundle, calibration_key)
+from stereo_class import StereoSystem
+
+IMAGE_SIZE = (64, 48)
+
+
+def _bundle(key="abc123"):
+    rng = np.random.default_rng(0)
+    arrays = {name: rng.normal(size=(3, 3)) for name in MATRIX_NAMES}
+    arrays["Q"] = np.array([[1, 0, 0, -32.0], [0, 1, 0, -24.0], [0, 0, 0, 50.0], [0, 0, 0.1, 0]])
+    K = np.array([[50.0, 0, 32], [0, 50.0, 24], [0, 0, 1]])
+    left_map1, left_map2 = cv2.initUndistortRectifyMap(K, None, np.eye(3), K, IMAGE_SIZE, cv2.CV_16SC2)
+    arrays.update(left_map1=left_map1, left_map2=left_map2, right_map1=left_map1.copy(), right_map2=left_map2.copy())
+    return CalibrationBundle(key, IMAGE_SIZE, (7, 7), 25.0, 0.0, {"left": 0.2, "right": 0.3, "stereo": 0.4},
+                             arrays, roi_left=(1, 2, 60, 40), roi_right=(3, 1, 58, 44))
+
+
+def test_save_and_load_latest_bundle(tmp_path):
+    bundle = _bundle()
+    bundle_dir = bundle.save(tmp_path)
+    assert bundle_dir == os.path.join(tmp_path, "abc123")
+    assert (tmp_path / LATEST_FILE).read_text() == "abc123"
+
+    loaded = CalibrationBundle.load(tmp_path)
+    assert loaded.key == "abc123"
+    assert loaded.image_size == IMAGE_SIZE and loaded.chessboard_size == (7, 7)
+    assert loaded.rms == {"left": 0.2, "right": 0.3, "stereo": 0.4}
+    assert loaded.roi_left == (1, 2, 60, 40) and loaded.roi_right == (3, 1, 58, 44)
+    assert set(loaded.arrays) == set(MATRIX_NAMES + MAP_NAMES)
+    for name, array in bundle.arrays.items():
+        np.testing.assert_array_equal(loaded.arrays[name], array)
+    assert all(isinstance(loaded.arrays[name], np.memmap) for name in MAP_NAMES)
+    assert not any(isinstance(loaded.arrays[name], np.memmap) for name in MATRIX_NAMES)
+
+
+def test_load_by_key_and_by_directory(tmp_path):
+    _bundle("first").save(tmp_path)
+    _bundle("second").save(tmp_path)
+    assert CalibrationBundle.load(tmp_path).key == "second"
+    assert CalibrationBundle.load(tmp_path, key="first").key == "first"
+    assert CalibrationBundle.load(tmp_path / "first").key == "first"
+    assert CalibrationBundle.load(tmp_path, key="missing") is None
+    assert not any(name.endswith(".tmp" + str(os.getpid())) for name in os.listdir(tmp_path))
+
+
+def test_missing_or_outdated_bundles_are_ignored(tmp_path):
+    assert CalibrationBundle.load(tmp_path) is None
+    bundle_dir = _bundle().save(tmp_path)
+    manifest_path = os.path.join(bundle_dir, MANIFEST_FILE)
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    manifest["version"] = BUNDLE_VERSION - 1
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    assert CalibrationBundle.load(tmp_path) is None
+
+
+def test_stereo_system_loads_rectification_from_bundle(tmp_path):
+    _bundle().save(tmp_path)
+    stereo = StereoSystem()
+    stereo.load_rectification(str(tmp_path))
+    np.testing.assert_array_equal(stereo.Q_full, _bundle().arrays["Q"])
+    assert stereo.roi_left == (1, 2, 60, 40)
+    image = np.random.default_rng(2).integers(0, 255, IMAGE_SIZE[::-1], dtype=np.uint8)
+    left, right = stereo.rectify_pair(image, image)
+    np.testing.assert_array_equal(left, image)
+
+    with pytest.raises(FileNotFoundError):
+        StereoSystem().load_rectification(str(tmp_path / "empty"))
+
+
+def test_calibration_key_covers_inputs(tmp_path):
+    images = [(b"left0", b"right0"), (b"left1", b"right1")]
+    key = calibration_key(images, (7, 7), 25.0, IMAGE_SIZE, 0.0)
+    assert len(key) == 16
+    assert calibration_key(images, (7, 7), 25.0, IMAGE_SIZE, 0.0) == key
+    assert calibration_key(images, (7, 7), 25.0, IMAGE_SIZE, 1.0) != key
+    assert calibration_key(images, (9, 6), 25.0, IMAGE_SIZE, 0.0) != key
+    assert calibration_key(images, (7, 7), 20.0, IMAGE_SIZE, 0.0) != key
+    assert calibration_key(images[:1], (7, 7), 25.0, IMAGE_SIZE, 0.0) != key
+    assert calibration_key(images, (7, 7), 25.0, IMAGE_SIZE, 0.0, detection_scale=1.0) == key
+    assert calibration_key(images, (7, 7), 25.0, IMAGE_SIZE, 0.0, detection_scale=0.5) != key
+    assert calibration_key([(b"left0", b"right0"), (b"left1", b"right2")], (7, 7), 25.0, IMAGE_SIZE, 0.0) != key
+
+    path = tmp_path / "left.png"
+    path.write_bytes(b"image")
+    file_key = calibration_key([(path, path)], (7, 7), 25.0, IMAGE_SIZE, 0.0)
+    os.utime(path, ns=(0, 12345))
+    assert calibration_key([(path, path)], (7, 7), 25.0, IMAGE_SIZE, 0.0) != file_key
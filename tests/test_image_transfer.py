@@ -0,0 +1,137 @@
+import socket
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from encoding import CODEC_H264, CODEC_JPEG, CODEC_PNG, CODEC_RAW, CODEC_ZLIB, EncodedImage, decode_image, encode_image
+from image_transfer import (FLAG_KEYFRAME, FLAG_RECTIFIED, AsyncImageServerHost, ImageClient, _ClientSession,
+                            pack_stereo_pair, sendmsg_all)
+
+
+def _roundtrip(*args, receive="receive_frame", **kwargs):
+    server_sock, client_sock = socket.socketpair()
+    client = ImageClient(save_images=False)
+    client.sock = client_sock
+    buffers = pack_stereo_pair(*args, **kwargs)
+    # send from a thread so large pairs can't fill the socket buffer and block the test
+    sender = threading.Thread(target=sendmsg_all, args=(server_sock, buffers))
+    sender.start()
+    try:
+        return getattr(client, receive)()
+    finally:
+        sender.join()
+        server_sock.close()
+        client_sock.close()
+
+
+def test_raw_pair_roundtrip_keeps_metadata_and_geometry():
+    left = np.random.default_rng(0).integers(0, 255, (48, 64, 3), dtype=np.uint8)
+    right = (np.arange(48 * 64, dtype=np.int16) - 1000).reshape(48, 64)
+    frame = _roundtrip(left, right, seq=1234, timestamps=(111, 222), flags=FLAG_RECTIFIED)
+    with frame:
+        assert frame.version == 2
+        assert frame.seq == 1234
+        assert frame.flags == FLAG_RECTIFIED
+        assert frame.skew_ns == -111
+        assert frame.left.codec == CODEC_RAW
+        np.testing.assert_array_equal(frame.left.decode(), left)
+        np.testing.assert_array_equal(frame.right.decode(), right)
+
+
+def test_encoded_pair_roundtrip():
+    image = np.tile(np.arange(64, dtype=np.uint8) * 4, (32, 1))
+    jpeg = encode_image(image, CODEC_JPEG, quality=95)
+    packed = encode_image(image, CODEC_ZLIB)
+    with _roundtrip(jpeg, packed, seq=7) as frame:
+        assert (frame.left.codec, frame.right.codec) == (CODEC_JPEG, CODEC_ZLIB)
+        assert np.abs(frame.left.decode(cv2.IMREAD_GRAYSCALE).astype(int) - image).max() <= 4
+        np.testing.assert_array_equal(frame.right.decode(), image)
+
+
+@pytest.mark.parametrize("codec", [CODEC_PNG, CODEC_RAW, CODEC_ZLIB])
+def test_padding_channel_is_dropped_before_encoding(codec):
+    image = np.random.default_rng(2).integers(0, 255, (16, 24, 4), dtype=np.uint8)
+    encoded = encode_image(image, codec)
+    assert encoded.shape == (16, 24, 3)
+    np.testing.assert_array_equal(decode_image(encoded.payload, codec, encoded.shape, encoded.dtype),
+                                  image[:, :, :3])
+
+
+def test_receive_images_returns_bytes():
+    left = encode_image(np.zeros((8, 8), np.uint8), CODEC_JPEG)
+    right = encode_image(np.ones((8, 8), np.uint8), CODEC_ZLIB)
+    left_bytes, right_bytes = _roundtrip(left, right, seq=1, receive="receive_images")
+    assert type(left_bytes) is bytes and type(right_bytes) is bytes
+    assert left_bytes == bytes(left.payload) and right_bytes == bytes(right.payload)
+
+
+def test_single_image_frame():
+    image = np.zeros((4, 4), np.uint8)
+    with _roundtrip(image, seq=3) as frame:
+        assert frame.right is None
+        assert frame.skew_ns == 0
+
+
+def test_broadcast_skips_dependent_h264_pairs_until_keyframe():
+    server = AsyncImageServerHost(queue_size=2)
+    requests = []
+    server.keyframe_requester = lambda: requests.append(True)
+    session = _ClientSession("client", 2)
+    server._sessions = {"writer": session}
+
+    # a client joining mid-stream waits for a keyframe
+    server._broadcast([b"p0"], True, True)
+    assert session.queue.qsize() == 0 and session.skipped == 1 and len(requests) == 1
+    server._broadcast([b"k1"], True, False)
+    server._broadcast([b"p2"], True, True)
+    assert session.queue.qsize() == 2
+
+    # the queue is full: the keyframe is dropped, so the following P-frames are skipped
+    server._broadcast([b"p3"], True, True)
+    assert session.dropped == 1 and session.skipped == 2
+    assert session.queue.qsize() == 1
+    assert len(requests) == 2
+    server._broadcast([b"k4"], True, False)
+    assert [session.queue.get_nowait()[0] for _ in range(2)] == [[b"p2"], [b"k4"]]
+
+
+def test_broadcast_drops_still_pairs_without_waiting_for_keyframes():
+    server = AsyncImageServerHost(queue_size=1)
+    session = _ClientSession("client", 1)
+    server._sessions = {"writer": session}
+    for index in range(3):
+        server._broadcast([bytes([index])], False, False)
+    assert session.dropped == 2 and session.skipped == 0
+    assert session.queue.get_nowait()[0] == [b"\x02"]
+
+
+def test_keyframe_flag_decides_dependency():
+    from image_transfer import _depends_on_previous
+    assert _depends_on_previous(EncodedImage(b"", CODEC_H264), None, 0)
+    assert not _depends_on_previous(EncodedImage(b"", CODEC_H264), None, FLAG_KEYFRAME)
+    assert not _depends_on_previous(EncodedImage(b"", CODEC_JPEG), None, 0)
+
+
+def test_disconnect_wakes_a_blocked_receive():
+    server_sock, client_sock = socket.socketpair()
+    client = ImageClient(save_images=False)
+    client.sock = client_sock
+    errors = []
+
+    def receive():
+        try:
+            client.receive_frame()
+        except Exception as e:
+            errors.append(e)
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+    time.sleep(0.05)
+    client.disconnect()
+    receiver.join(timeout=2)
+    server_sock.close()
+    assert not receiver.is_alive()
+    assert errors
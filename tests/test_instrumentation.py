@@ -0,0 +1,63 @@
+import json
+
+import instrumentation
+from instrumentation import MetricsExporter, MetricsRegistry
+
+
+def test_prometheus_text_format():
+    registry = MetricsRegistry()
+    hist = registry.histogram("encode_ms", buckets=(1, 5, 10))
+    for value in (0.5, 1, 3, 7, 20):
+        hist.observe(value)
+    registry.histogram("capture_ms", buckets=(2,)).observe(1.5)
+
+    lines = registry.prometheus_text().splitlines()
+    assert lines == [
+        "# TYPE stereo_capture_ms histogram",
+        'stereo_capture_ms_bucket{le="2"} 1',
+        'stereo_capture_ms_bucket{le="+Inf"} 1',
+        "stereo_capture_ms_sum 1.5",
+        "stereo_capture_ms_count 1",
+        "# TYPE stereo_encode_ms histogram",
+        'stereo_encode_ms_bucket{le="1"} 2',
+        'stereo_encode_ms_bucket{le="5"} 3',
+        'stereo_encode_ms_bucket{le="10"} 4',
+        'stereo_encode_ms_bucket{le="+Inf"} 5',
+        "stereo_encode_ms_sum 31.5",
+        "stereo_encode_ms_count 5",
+    ]
+    assert registry.prometheus_text(prefix="").startswith("# TYPE capture_ms histogram\n")
+
+
+def test_histogram_quantiles_and_snapshot():
+    registry = MetricsRegistry()
+    hist = registry.histogram("skew", buckets=(1, 2, 4))
+    assert registry.histogram("skew") is hist
+    for value in (0.5, 1.5, 1.5, 3, 9):
+        hist.observe(value)
+    assert hist.quantile(0.5) == 2
+    assert hist.quantile(0.99) == 9
+    snap = registry.snapshot()["histograms"]["skew"]
+    assert snap["buckets"] == {"1": 1, "2": 2, "4": 1, "+Inf": 1}
+    assert snap["max"] == 9 and snap["mean"] == 3.1
+
+
+def test_frame_traces_keep_recent_frames():
+    registry = MetricsRegistry()
+    registry.record_span(1, "encode", 200, 1.0)
+    registry.record_span(1, "capture", 100, 2.0)
+    assert registry.frame_trace(1) == [("capture", 100, 2.0), ("encode", 200, 1.0)]
+    for seq in range(2, instrumentation.TRACE_FRAMES + 2):
+        registry.record_span(seq, "capture", seq, 1.0)
+    assert registry.frame_trace(1) == []
+
+
+def test_exporter_writes_prometheus_or_json(tmp_path, monkeypatch):
+    registry = MetricsRegistry()
+    registry.histogram("send_ms", buckets=(1,)).observe(0.5)
+    monkeypatch.setattr(instrumentation, "METRICS", registry)
+
+    MetricsExporter(str(tmp_path / "metrics.prom")).write()
+    assert (tmp_path / "metrics.prom").read_text() == registry.prometheus_text()
+    MetricsExporter(str(tmp_path / "metrics.json")).write()
+    assert json.loads((tmp_path / "metrics.json").read_text())["histograms"]["send_ms"]["count"] == 1
@@ -0,0 +1,97 @@
+import queue
+import time
+
+import pytest
+
+from pipeline import StageStats, StreamingPipeline
+
+
+def _finite_source(count, delay=0.0):
+    frames = iter(range(count))
+
+    def source():
+        time.sleep(delay)
+        try:
+            return {"value": next(frames)}
+        except StopIteration:
+            time.sleep(0.01)
+            return None
+    return source
+
+
+def test_unknown_drop_policy():
+    with pytest.raises(ValueError):
+        StreamingPipeline(lambda: None, [], drop_policy="drop_random")
+
+
+@pytest.mark.parametrize("policy, kept", [("drop_oldest", [2, 3]), ("drop_newest", [0, 1])])
+def test_full_queue_drop_policies(policy, kept):
+    dropped = []
+    pipeline = StreamingPipeline(lambda: None, [], queue_size=2, drop_policy=policy, on_drop=dropped.append)
+    q, stats = queue.Queue(maxsize=2), StageStats("source")
+    for value in range(4):
+        pipeline._put(q, {"value": value}, stats)
+    assert [q.get_nowait()["value"] for _ in range(2)] == kept
+    assert sorted(frame["value"] for frame in dropped) == sorted({0, 1, 2, 3} - set(kept))
+    assert stats.dropped == 2
+
+
+def test_put_after_stop_releases_the_frame():
+    dropped = []
+    pipeline = StreamingPipeline(lambda: None, [], drop_policy="block", on_drop=dropped.append)
+    pipeline._stop.set()
+    q = queue.Queue(maxsize=1)
+    q.put_nowait({"value": 0})
+    pipeline._put(q, {"value": 1}, StageStats("source"))
+    assert dropped == [{"value": 1}]
+
+
+def test_block_policy_delivers_every_frame_in_order():
+    def slow_stage(frame):
+        time.sleep(0.002)
+        frame["double"] = frame["value"] * 2
+        return frame
+
+    pipeline = StreamingPipeline(_finite_source(30), [("double", slow_stage), ("identity", lambda f: f)],
+                                 queue_size=1, drop_policy="block")
+    pipeline.start()
+    try:
+        frames = [pipeline.get(timeout=2) for _ in range(30)]
+    finally:
+        pipeline.stop()
+    assert [f["value"] for f in frames] == list(range(30))
+    assert [f["seq"] for f in frames] == list(range(30))
+    assert all(f["double"] == 2 * f["value"] for f in frames)
+    report = pipeline.report()
+    assert report["delivered"] == 30
+    assert all(stage["dropped"] == 0 for stage in report["stages"])
+
+
+def test_drop_oldest_accounts_for_every_frame():
+    dropped, seen = [], []
+
+    def failing_stage(frame):
+        seen.append(frame["value"])
+        if len(seen) == 1:
+            raise RuntimeError("bad frame")
+        time.sleep(0.001)
+        return frame
+
+    pipeline = StreamingPipeline(_finite_source(40), [("stage", failing_stage)], queue_size=2,
+                                 drop_policy="drop_oldest", on_drop=dropped.append)
+    pipeline.start()
+    time.sleep(0.3)
+    delivered = []
+    while True:
+        frame = pipeline.get(timeout=0.05)
+        if frame is None:
+            break
+        delivered.append(frame["value"])
+    pipeline.stop()
+
+    dropped_values = [f["value"] for f in dropped]
+    assert seen[0] in dropped_values
+    assert sorted(delivered + dropped_values) == list(range(40))
+    # the newest frames survive and arrive in order
+    assert delivered == sorted(delivered) and delivered[-1] == 39
+    assert pipeline.stats[1].errors == 1
@@ -0,0 +1,103 @@
+import cv2
+import numpy as np
+import pytest
+
+from pointcloud import (COLOR_POINT_DTYPE, POINT_DTYPE, VoxelGrid, iter_points, read_ply, voxel_downsample,
+                        write_ply)
+
+Q = np.array([[1, 0, 0, -40.0], [0, 1, 0, -30.0], [0, 0, 0, 100.0], [0, 0, 1 / 60.0, 0.1]])
+
+
+def _disparity():
+    rng = np.random.default_rng(3)
+    disparity = rng.uniform(4, 40, (60, 80)).astype(np.float32)
+    disparity[rng.random(disparity.shape) < 0.2] = -1.0
+    return disparity
+
+
+def _expected(disparity, color=None, max_depth=None):
+    xyz = cv2.reprojectImageTo3D(disparity, Q)
+    valid = disparity > 0
+    if max_depth is not None:
+        valid &= xyz[:, :, 2] <= max_depth
+    return xyz[valid], None if color is None else color[valid]
+
+
+def test_ply_roundtrip_matches_reproject_image_to_3d(tmp_path):
+    disparity = _disparity()
+    color = np.random.default_rng(4).integers(0, 255, disparity.shape + (3,), dtype=np.uint8)
+    path = tmp_path / "cloud.ply"
+    count = write_ply(path, disparity, Q, color, band_rows=7)
+
+    points = read_ply(path)
+    xyz, bgr = _expected(disparity, color)
+    assert points.dtype == COLOR_POINT_DTYPE
+    assert count == points.size == len(xyz)
+    np.testing.assert_allclose(np.column_stack([points["x"], points["y"], points["z"]]), xyz, rtol=1e-5)
+    np.testing.assert_array_equal(np.column_stack([points["blue"], points["green"], points["red"]]), bgr)
+
+
+def test_ply_header_and_fixed_point_input(tmp_path):
+    disparity = _disparity()
+    fixed = np.where(disparity > 0, np.round(disparity * 16), -16).astype(np.int16)
+    path = tmp_path / "cloud.ply"
+    count = write_ply(path, fixed, Q, max_depth=1000.0)
+
+    with open(path, "rb") as f:
+        header = f.read().split(b"end_header\n")[0].decode("ascii").splitlines()
+    assert header[:2] == ["ply", "format binary_little_endian 1.0"]
+    assert int(header[2].split()[-1]) == count
+    assert header[3:] == ["property float x", "property float y", "property float z"]
+
+    points = read_ply(path)
+    xyz, _ = _expected(fixed.astype(np.float32) / 16.0, max_depth=1000.0)
+    assert points.dtype == POINT_DTYPE and points.size == len(xyz)
+    np.testing.assert_allclose(points["z"], xyz[:, 2], rtol=1e-5)
+
+
+def _points(coords, colors=None):
+    points = np.zeros(len(coords), POINT_DTYPE if colors is None else COLOR_POINT_DTYPE)
+    coords = np.asarray(coords, np.float32)
+    points["x"], points["y"], points["z"] = coords[:, 0], coords[:, 1], coords[:, 2]
+    if colors is not None:
+        colors = np.asarray(colors)
+        points["red"], points["green"], points["blue"] = colors[:, 0], colors[:, 1], colors[:, 2]
+    return points
+
+
+def test_voxel_grid_averages_points_per_voxel():
+    points = _points([(0.1, 0.1, 0.1), (0.3, 0.5, 0.9), (1.5, 0.2, 0.2), (-0.5, 0.0, 0.0)],
+                     [(10, 20, 30), (20, 40, 61), (5, 5, 5), (0, 0, 0)])
+    result = voxel_downsample(points, 1.0)
+    assert result.dtype == COLOR_POINT_DTYPE and result.size == 3
+    result = result[np.argsort(result["x"])]
+    np.testing.assert_allclose(result["x"], [-0.5, 0.2, 1.5], rtol=1e-6)
+    np.testing.assert_allclose(result["z"], [0.0, 0.5, 0.2], rtol=1e-6)
+    assert result[1][["red", "green", "blue"]].tolist() == (15, 30, 46)
+
+
+def test_voxel_grid_chunks_match_single_pass():
+    rng = np.random.default_rng(5)
+    points = _points(rng.normal(scale=5.0, size=(5000, 3)), rng.integers(0, 255, (5000, 3)))
+    grid = VoxelGrid(0.75)
+    for chunk in np.array_split(points, 7):
+        grid.add(chunk)
+    chunked = grid.result()
+    single = voxel_downsample(points, 0.75)
+    order_chunked, order_single = np.argsort(chunked, order=["x", "y", "z"]), np.argsort(single, order=["x", "y", "z"])
+    for name in COLOR_POINT_DTYPE.names:
+        np.testing.assert_allclose(chunked[name][order_chunked].astype(float), single[name][order_single].astype(float),
+                                   rtol=1e-5, atol=1)
+    # result() can be called again and keeps accumulating
+    grid.add(points[:10])
+    assert grid.result().size == chunked.size
+
+
+def test_voxel_write_ply_and_extent_limit(tmp_path):
+    disparity = _disparity()
+    count = write_ply(tmp_path / "voxels.ply", disparity, Q, voxel_size=50.0)
+    assert 0 < count < np.count_nonzero(disparity > 0)
+    assert len(list(iter_points(np.full((4, 4), -1.0, np.float32), Q))) == 1
+
+    with pytest.raises(ValueError):
+        voxel_downsample(_points([(0, 0, 0), (1e7, 0, 0)]), 1.0)
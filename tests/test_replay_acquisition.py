@@ -0,0 +1,107 @@
+import cv2
+import numpy as np
+import pytest
+
+from replay_acquisition import ReplayStereoAcquisition, load_pairs
+
+
+def _pairs(count, shape=(48, 64, 3)):
+    return [(np.full(shape, i, np.uint8), np.full(shape, 100 + i, np.uint8)) for i in range(count)]
+
+
+def test_replays_pairs_with_synthetic_timestamps():
+    replay = ReplayStereoAcquisition(_pairs(3), rate="max", fps=50, skew_ns=1500)
+    seen = []
+    for expected_seq in range(5):
+        reqL, reqR, info = replay.capture_stereo_image()
+        left, right = reqL.make_array(), reqR.make_array()
+        reqL.release()
+        assert reqL.released and info["seq"] == expected_seq and info["skew_ns"] == 1500
+        assert reqL.get_metadata()["FrameDuration"] == 20000
+        assert reqL.get_metadata()["SensorTimestamp"] - reqR.get_metadata()["SensorTimestamp"] == 1500
+        seen.append((left[0, 0, 0], right[0, 0, 0], reqL.get_metadata()["SensorTimestamp"]))
+    # the source loops, and timestamps advance at least one frame period per pair
+    assert [(left, right) for left, right, _ in seen] == [(0, 100), (1, 101), (2, 102), (0, 100), (1, 101)]
+    assert all(b[2] - a[2] >= 20_000_000 for a, b in zip(seen, seen[1:]))
+    assert replay.frames_delivered == 5
+    assert replay.skew_stats()["max_skew_us"] == 1.5
+
+
+def test_make_array_copies_the_stored_frame():
+    replay = ReplayStereoAcquisition(_pairs(1), rate="max")
+    reqL, _, _ = replay.capture_stereo_image()
+    reqL.make_array()[:] = 255
+    assert reqL.make_array()[0, 0, 0] == 0
+
+
+def test_exhausted_source_without_loop():
+    replay = ReplayStereoAcquisition(_pairs(2), rate="max", loop=False)
+    replay.capture_stereo_image()
+    replay.capture_stereo_image()
+    with pytest.raises(EOFError):
+        replay.capture_stereo_image()
+
+
+def test_get_latest_pair_reports_pair_info():
+    replay = ReplayStereoAcquisition(_pairs(2), rate="max", skew_ns=-200)
+    replay.start_continuous()
+    left, right, info = replay.get_latest_pair(copy=False)
+    assert left is replay.pairs[0][0] and right is replay.pairs[0][1]
+    assert info["left_seq"] == info["right_seq"] == info["seq"] == 0
+    assert info["left_timestamp"] - info["right_timestamp"] == -200
+    left, _, _ = replay.get_latest_pair()
+    assert left is not replay.pairs[1][0]
+    np.testing.assert_array_equal(left, replay.pairs[1][0])
+
+
+def test_fixed_rate_paces_pairs():
+    replay = ReplayStereoAcquisition(_pairs(1), rate="fixed", fps=100)
+    for _ in range(6):
+        replay.capture_stereo_image()
+    assert replay.achieved_fps() < 150
+
+
+def test_burst_pause_advances_the_timestamps():
+    replay = ReplayStereoAcquisition(_pairs(1), rate="burst", fps=100, burst_size=2, burst_interval=0.05)
+    stamps = []
+    for _ in range(5):
+        reqL, _, _ = replay.capture_stereo_image()
+        stamps.append(reqL.get_metadata()["SensorTimestamp"])
+    gaps = [b - a for a, b in zip(stamps, stamps[1:])]
+    assert gaps == [10_000_000, 60_000_000, 10_000_000, 60_000_000]
+
+
+def test_load_pairs_from_directory(tmp_path):
+    for i, (left, right) in enumerate(_pairs(3)):
+        cv2.imwrite(str(tmp_path / f"left_{i:03d}.png"), left)
+        cv2.imwrite(str(tmp_path / f"right_{i:03d}.png"), right)
+    pairs = load_pairs(str(tmp_path), max_frames=2, size=(32, 24))
+    assert len(pairs) == 2
+    assert pairs[1][0].shape == (24, 32, 3)
+    assert pairs[1][0][0, 0, 0] == 1 and pairs[1][1][0, 0, 0] == 101
+
+
+def test_invalid_sources_and_rates(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        load_pairs(str(tmp_path))
+    with pytest.raises(ValueError):
+        load_pairs([])
+    with pytest.raises(ValueError):
+        ReplayStereoAcquisition(_pairs(1), rate="sometimes")
+
+
+def test_capture_video_writes_decodable_streams(tmp_path):
+    pytest.importorskip("av")
+    from encoding import H264Decoder
+
+    replay = ReplayStereoAcquisition(_pairs(6), rate="max", fps=30, loop=False)
+    left_path, right_path = tmp_path / "left.h264", tmp_path / "right.h264"
+    replay.capture_video(str(left_path), str(right_path), duration=None)
+
+    pts = (tmp_path / "left.pts").read_text().splitlines()
+    assert pts[0] == "# timecode format v2" and len(pts) == 7
+    assert [float(t) for t in pts[1:]] == sorted(float(t) for t in pts[1:])
+    decoder = H264Decoder()
+    frame = decoder.decode(left_path.read_bytes())
+    assert frame is not None and frame.shape == (48, 64, 3)
+    assert right_path.stat().st_size > 0
@@ -0,0 +1,20 @@
+from sgbm_tuner import pareto_front
+
+
+def _row(p50_ms, bad_pixel_percent, peak_rss_mb):
+    return dict(p50_ms=p50_ms, bad_pixel_percent=bad_pixel_percent, peak_rss_mb=peak_rss_mb)
+
+
+def test_pareto_front_keeps_non_dominated_rows():
+    fast, accurate = _row(5.0, 10.0, 20.0), _row(20.0, 2.0, 20.0)
+    dominated = _row(25.0, 12.0, 30.0)
+    assert pareto_front([dominated, accurate, fast]) == [fast, accurate]
+
+
+def test_missing_memory_does_not_dominate():
+    measured = _row(10.0, 5.0, 400.0)
+    unmeasured = _row(10.0, 5.0, None)
+    assert pareto_front([measured, unmeasured]) == [measured]
+    # a row missing a value can still be on the front through its other objectives
+    faster = _row(8.0, 5.0, None)
+    assert pareto_front([measured, faster]) == [faster, measured]
@@ -0,0 +1,113 @@
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+from disparity import HierarchicalDisparityEngine, TiledDisparityEngine
+from stereo_class import SGBM_PRESETS, StereoSystem, load_sgbm_preset
+
+WIDTH, HEIGHT = 160, 120
+ROI_LEFT = (10, 6, 130, 100)
+ROI_RIGHT = (14, 4, 140, 98)
+# common ROI of the two eyes: x 14..140, y 6..102
+CROP = (14, 6, 126, 96)
+
+
+def _stereo_with_identity_maps(**kwargs):
+    stereo = StereoSystem(**kwargs)
+    K = np.array([[100.0, 0, WIDTH / 2], [0, 100.0, HEIGHT / 2], [0, 0, 1]])
+    maps = cv2.initUndistortRectifyMap(K, None, np.eye(3), K, (WIDTH, HEIGHT), cv2.CV_16SC2)
+    # a general Q: the right principal point differs, so Q[3, 3] is non-zero
+    Q = np.array([[1, 0, 0, -81.3], [0, 1, 0, -58.7], [0, 0, 0, 100.0], [0, 0, -1 / 60.0, -4.2 / 60.0]])
+    stereo.set_rectification(maps, maps, Q, ROI_LEFT, ROI_RIGHT)
+    return stereo
+
+
+def _reproject(Q, points):
+    return cv2.perspectiveTransform(points.reshape(-1, 1, 3), Q).reshape(-1, 3)
+
+
+@pytest.mark.parametrize("scale, crop", [(1.0, True), (0.5, False), (0.5, True), (0.3, True)])
+def test_adjusted_q_reprojects_to_the_same_points(scale, crop):
+    stereo = _stereo_with_identity_maps()
+    stereo.configure_rectification(scale=scale, crop_to_roi=crop)
+    x0, y0 = CROP[:2] if crop else (0, 0)
+    assert stereo.rect_offset == (x0, y0)
+
+    rng = np.random.default_rng(1)
+    full = np.column_stack([rng.uniform(20, 140, 50), rng.uniform(10, 100, 50), rng.uniform(2, 60, 50)])
+    # the same scene points in output pixels: pixel centres map through the crop and scale, disparities scale
+    out = np.column_stack([scale * (full[:, 0] - x0 + 0.5) - 0.5, scale * (full[:, 1] - y0 + 0.5) - 0.5,
+                           scale * full[:, 2]])
+    np.testing.assert_allclose(_reproject(stereo.Q, out), _reproject(stereo.Q_full, full), rtol=1e-9, atol=1e-9)
+
+
+def test_rectified_pixels_match_the_q_geometry():
+    stereo = _stereo_with_identity_maps()
+    stereo.configure_rectification(scale=0.5, crop_to_roi=True)
+    xs, ys = np.meshgrid(np.arange(WIDTH, dtype=np.float32), np.arange(HEIGHT, dtype=np.float32))
+    left, right = stereo.rectify_pair(xs, ys)
+    assert left.shape == (round(CROP[3] * 0.5), round(CROP[2] * 0.5))
+
+    # each output pixel samples the full-size coordinate the Q adjustment assumes
+    out_v, out_u = np.mgrid[2:left.shape[0] - 2, 2:left.shape[1] - 2]
+    np.testing.assert_allclose(left[2:-2, 2:-2], (out_u + 0.5) / 0.5 - 0.5 + CROP[0], atol=0.05)
+    np.testing.assert_allclose(right[2:-2, 2:-2], (out_v + 0.5) / 0.5 - 0.5 + CROP[1], atol=0.05)
+
+
+def test_full_size_rectification_keeps_q():
+    stereo = _stereo_with_identity_maps()
+    stereo.configure_rectification()
+    np.testing.assert_array_equal(stereo.Q, stereo.Q_full)
+
+
+@pytest.mark.parametrize("bands", [1, 4])
+def test_unknown_disparity_mode_is_rejected(bands):
+    with pytest.raises(ValueError):
+        StereoSystem(disparity_mode="tiles", disparity_bands=bands)
+
+
+def test_disparity_bands_select_the_engine():
+    assert StereoSystem().disparity_engine is None
+    assert isinstance(StereoSystem(disparity_bands=4).disparity_engine, TiledDisparityEngine)
+    assert isinstance(StereoSystem(disparity_mode="hierarchical", disparity_bands=4).disparity_engine,
+                      HierarchicalDisparityEngine)
+
+
+def test_builtin_preset_without_presets_file(tmp_path):
+    settings = load_sgbm_preset("balanced", tmp_path / "missing.json")
+    assert settings == SGBM_PRESETS["balanced"]
+    settings["num_disp"] = 1
+    assert SGBM_PRESETS["balanced"]["num_disp"] == 64
+
+
+def test_presets_file_overrides_builtin_presets(tmp_path):
+    path = tmp_path / "sgbm_presets.json"
+    tuned = dict(sgbm_mode="hh4", block_size=3, num_disp=48, speckle_window_size=0, speckle_range=1,
+                 uniqueness_ratio=5, scale=0.75, fps=31.0, epe_px=0.8)
+    path.write_text(json.dumps({"presets": {"balanced": tuned}}))
+    settings = load_sgbm_preset("balanced", path)
+    assert "fps" not in settings and "epe_px" not in settings
+    assert settings["sgbm_mode"] == "hh4" and settings["scale"] == 0.75
+    # presets missing from the file still come from the built-in table
+    assert load_sgbm_preset("quality", path) == SGBM_PRESETS["quality"]
+    with pytest.raises(KeyError):
+        load_sgbm_preset("nonexistent", path)
+
+
+def test_stereo_system_applies_preset(tmp_path):
+    stereo = StereoSystem(preset="realtime", presets_path=tmp_path / "missing.json")
+    assert stereo.sgbm_params["numDisparities"] == 32
+    assert stereo.sgbm_params["blockSize"] == 5
+    assert stereo.sgbm_params["mode"] == cv2.STEREO_SGBM_MODE_SGBM
+    assert stereo.preset_scale == stereo.rect_scale == 0.25
+
+
+def test_explicit_scale_overrides_preset_scale(tmp_path):
+    stereo = _stereo_with_identity_maps(preset="balanced", presets_path=tmp_path / "missing.json")
+    stereo.configure_rectification()
+    assert stereo.rect_scale == 0.5
+    assert stereo._rect_maps[0][0].shape[:2] == (HEIGHT // 2, WIDTH // 2)
+    stereo.configure_rectification(scale=1.0)
+    assert stereo._rect_maps[0][0].shape[:2] == (HEIGHT, WIDTH)
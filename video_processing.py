@@ -0,0 +1,223 @@
+import itertools
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from stereo_class import StereoSystem
+
+MANIFEST_FILE = "depth_video.json"
+MANIFEST_VERSION = 1
+
+#Per-process state for the worker pool, set once by _init_worker
+_worker_stereo = None
+_worker_options = None
+
+
+def read_pts(path):
+    """
+    Frame timestamps in ms from a pts file written next to a recording (None if there is none).
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return [float(line) for line in f if line.strip() and not line.startswith("#")]
+
+
+def pair_frames(pts_left, pts_right, max_skew_ms=None):
+    """
+    Match frame indices of the two streams by timestamp. A frame is skipped when the other
+    eye has no frame within max_skew_ms (default half the median frame interval).
+    Returns a list of (left_index, right_index, left_ms, right_ms).
+    """
+    if max_skew_ms is None:
+        intervals = np.diff(pts_left) if len(pts_left) > 1 else [1000.0 / 30]
+        max_skew_ms = float(np.median(intervals)) / 2
+    pairs = []
+    i = j = 0
+    while i < len(pts_left) and j < len(pts_right):
+        skew = pts_left[i] - pts_right[j]
+        if abs(skew) <= max_skew_ms:
+            pairs.append((i, j, pts_left[i], pts_right[j]))
+            i += 1
+            j += 1
+        elif skew < 0:
+            i += 1
+        else:
+            j += 1
+    return pairs
+
+
+def _decode_pairs(left_path, right_path, pairs):
+    """
+    Decode both streams in step, yielding (left, right, timestamps) for each matched pair.
+    pairs: iterable of (left_index, right_index, left_ms, right_ms); timestamps may be None.
+    """
+    capL, capR = cv2.VideoCapture(left_path), cv2.VideoCapture(right_path)
+    if not capL.isOpened() or not capR.isOpened():
+        raise FileNotFoundError(f"Could not open {left_path} / {right_path}")
+    posL = posR = -1
+    frameL = frameR = None
+    try:
+        for left_index, right_index, left_ms, right_ms in pairs:
+            while posL < left_index:
+                ok, frameL = capL.read()
+                if not ok:
+                    return
+                posL += 1
+            while posR < right_index:
+                ok, frameR = capR.read()
+                if not ok:
+                    return
+                posR += 1
+            timestamps = None if left_ms is None else (left_ms, right_ms)
+            yield frameL, frameR, timestamps
+    finally:
+        capL.release()
+        capR.release()
+
+
+def _init_worker(calibration_dir, scale, disparity_mode, depth_dtype, out_dir):
+    #Each worker loads the calibration bundle once (maps are memory-mapped, so the pages are shared)
+    global _worker_stereo, _worker_options
+    cv2.setNumThreads(1)
+    _worker_stereo = StereoSystem(disparity_mode=disparity_mode)
+    _worker_stereo.load_rectification(calibration_dir)
+    _worker_stereo.configure_rectification(grayscale=True, scale=scale, parallel=False)
+    _worker_options = (np.dtype(depth_dtype), out_dir)
+
+
+def _process_chunk(chunk_index, frames):
+    """
+    Worker task: rectify, match and reproject a chunk of pairs and write the depth stack
+    to its own .npy file. Returns (file name, frame count, Q of the output geometry).
+    """
+    depth_dtype, out_dir = _worker_options
+    engine = _worker_stereo.disparity_engine
+    if hasattr(engine, "reset"):
+        # a worker gets chunks from all over the recording; temporal state must not carry over
+        engine.reset()
+    stack = None
+    for index, (left, right) in enumerate(frames):
+        rectL, rectR = _worker_stereo.rectify_pair(left, right)
+        _, disparity, _ = _worker_stereo.compute_disparity(rectL, rectR)
+        if stack is None:
+            stack = np.empty((len(frames),) + disparity.shape, depth_dtype)
+        _worker_stereo.disparity_to_depth(disparity, out=stack[index], dtype=depth_dtype)
+    name = f"depth_{chunk_index:06d}.npy"
+    tmp_path = os.path.join(out_dir, name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, stack)
+    os.replace(tmp_path, os.path.join(out_dir, name))
+    return name, len(frames), _worker_stereo.Q.tolist()
+
+
+def _write_manifest(out_dir, manifest):
+    tmp_path = os.path.join(out_dir, MANIFEST_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(out_dir, MANIFEST_FILE))
+
+
+def process_stereo_video(left_path="left_video.h264", right_path="right_video.h264", out_dir="depth_video",
+                         calibration_dir="calibration_cache", scale=0.5, disparity_mode="single",
+                         chunk_size=16, max_workers=None, depth_dtype=np.float32, max_frames=None):
+    """
+    Convert a stereo recording into depth maps stored as one .npy file per chunk_size frames.
+    The main process decodes both streams and pairs frames by their pts files when present
+    (by frame index otherwise); chunks are rectified, matched and reprojected in a process
+    pool. At most two chunks per worker are in flight, so memory stays bounded for long
+    recordings, and the manifest lists chunks in recording order.
+    disparity_mode="temporal" only reuses disparity within a chunk (each chunk starts with a
+    full match), so use a larger chunk_size to get more out of it.
+    Returns the manifest dict.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    max_workers = max_workers or os.cpu_count() or 1
+    pts_left = read_pts(os.path.splitext(left_path)[0] + ".pts")
+    pts_right = read_pts(os.path.splitext(right_path)[0] + ".pts")
+    if pts_left is not None and pts_right is not None:
+        pairs = pair_frames(pts_left, pts_right)
+    else:
+        pairs = ((i, i, None, None) for i in itertools.count())
+    if max_frames is not None:
+        pairs = itertools.islice(pairs, max_frames)
+
+    manifest = {"version": MANIFEST_VERSION, "source": [left_path, right_path], "scale": scale,
+                "dtype": np.dtype(depth_dtype).str, "chunk_size": chunk_size, "frames": 0,
+                "chunks": [], "timestamps_ms": [], "Q": None}
+    start = time.perf_counter()
+    pending = deque()
+
+    def collect(future):
+        name, count, Q = future.result()
+        manifest["chunks"].append({"file": name, "start": manifest["frames"], "count": count})
+        manifest["frames"] += count
+        manifest["Q"] = Q
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(calibration_dir, scale, disparity_mode, depth_dtype, out_dir)) as pool:
+        chunk = []
+
+        def submit():
+            pending.append(pool.submit(_process_chunk, len(manifest["chunks"]) + len(pending), chunk))
+            while len(pending) > 2 * max_workers:
+                collect(pending.popleft())
+
+        for left, right, timestamps in _decode_pairs(left_path, right_path, pairs):
+            chunk.append((left, right))
+            manifest["timestamps_ms"].append(timestamps)
+            if len(chunk) == chunk_size:
+                submit()
+                chunk = []
+        if chunk:
+            submit()
+        while pending:
+            collect(pending.popleft())
+
+    if all(t is None for t in manifest["timestamps_ms"]):
+        manifest["timestamps_ms"] = None
+    _write_manifest(out_dir, manifest)
+    elapsed = time.perf_counter() - start
+    print(f"Processed {manifest['frames']} stereo frames in {elapsed:.1f} s "
+          f"({manifest['frames'] / elapsed if elapsed > 0 else 0.0:.1f} fps, {max_workers} workers)")
+    return manifest
+
+
+class DepthVideo:
+    """
+    Read-only view of a processed recording; depth frames are memory-mapped on access.
+    """
+    def __init__(self, out_dir="depth_video"):
+        self.out_dir = out_dir
+        with open(os.path.join(out_dir, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        self.Q = np.array(self.manifest["Q"]) if self.manifest["Q"] is not None else None
+        self._chunks = {}
+
+    def __len__(self):
+        return self.manifest["frames"]
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        chunk = self.manifest["chunks"][index // self.manifest["chunk_size"]]
+        if chunk["file"] not in self._chunks:
+            self._chunks[chunk["file"]] = np.load(os.path.join(self.out_dir, chunk["file"]), mmap_mode="r")
+        return self._chunks[chunk["file"]][index - chunk["start"]]
+
+    def timestamp(self, index):
+        timestamps = self.manifest["timestamps_ms"]
+        return None if timestamps is None else timestamps[index]
+
+
+if __name__ == "__main__":
+    #Usage: python video_processing.py left_video.h264 right_video.h264 [out_dir] [workers]
+    out_dir = sys.argv[3] if len(sys.argv) > 3 else "depth_video"
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    process_stereo_video(sys.argv[1], sys.argv[2], out_dir, max_workers=workers)